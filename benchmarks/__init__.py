@@ -0,0 +1 @@
+"""Scale benchmarks for captable.py. Run with `python -m benchmarks.run`."""
@@ -0,0 +1,122 @@
+"""Deterministic generator for realistic, synthetic cap table ledgers"""
+from __future__ import absolute_import
+
+import datetime
+import random
+
+from captable import CommonStock, Entity, NaturalPerson, Stock
+
+
+class SeriesAPreferred(Stock):
+    name = "Series A Preferred"
+
+
+class SeriesBPreferred(Stock):
+    name = "Series B Preferred"
+
+    class MetaState(Stock.MetaState):
+        DEAUTH_RETIRED = True
+
+
+CLASSES = [CommonStock, SeriesAPreferred, SeriesBPreferred]
+
+# Relative weights of each kind of entry after the initial authorizations
+WEIGHTS = [
+    ("issue", 85),
+    ("transfer", 9),
+    ("cancel", 3),
+    ("retire", 3),
+]
+
+START = datetime.datetime(2010, 1, 1)
+
+
+class Ledger(object):
+    """Generates a ledger of (datetime, [txns]) entries for
+    CapTable.record_many. The same seed and arguments always produce the
+    same ledger (though with new Person objects each time).
+
+    Args:
+        issuances (int) - Number of issuances in the ledger. Transfers,
+            cancellations and retirements are added in proportion.
+        holders (int) - Number of Persons to issue to, defaults to one for
+            every ten issuances
+        seed (int) - Seed for the random number generator
+
+    Properties:
+        holders (list) - Persons used as holders, roughly one Entity for every
+            four NaturalPersons
+        issued (int) - Number of issuances generated so far
+    """
+    def __init__(self, issuances, holders=None, seed=0):
+        self.issuances = issuances
+        self.random = random.Random(seed)
+        count = holders or max(issuances // 10, 1)
+        self.holders = [
+            (Entity("Entity %s" % n) if n % 5 == 0 else
+             NaturalPerson("Person %s" % n))
+            for n in range(count)
+        ]
+        self.issued = 0
+        self.datetime = START
+
+        # Live cert_nos of each class, and the total authorized so far
+        self._live = dict((cls, []) for cls in CLASSES)
+        self._authorized = dict((cls, 0) for cls in CLASSES)
+        self._issued = dict((cls, 0) for cls in CLASSES)
+
+    def __iter__(self):
+        for cls in CLASSES:
+            yield self._next_datetime(), [self._auth(cls)]
+        kinds = [kind for kind, weight in WEIGHTS for _ in range(weight)]
+        while self.issued < self.issuances:
+            kind = self.random.choice(kinds)
+            cls = self.random.choice(CLASSES)
+            if kind != "issue" and not self._live[cls]:
+                kind = "issue"
+            yield self._next_datetime(), getattr(self, "_" + kind)(cls)
+
+    def _next_datetime(self):
+        self.datetime += datetime.timedelta(
+            seconds=self.random.randint(0, 3600))
+        return self.datetime
+
+    def _auth(self, cls, amount=10 ** 7):
+        self._authorized[cls] += amount
+        return cls.auth(delta=amount)
+
+    def _issue(self, cls):
+        ret = []
+        amount = self.random.choice([100, 250, 1000, 5000, 10000, 50000])
+        if self._issued[cls] + amount >= self._authorized[cls]:
+            ret.append(self._auth(cls))
+        self._issued[cls] += amount
+        self.issued += 1
+        cert_no = "%s-%s" % (cls.name, self.issued)
+        self._live[cls].append((cert_no, amount))
+        ret.append(cls.issue(holder=self.random.choice(self.holders),
+                             amount=amount, cert_no=cert_no))
+        return ret
+
+    def _pop_live(self, cls):
+        live = self._live[cls]
+        index = self.random.randrange(len(live))
+        live[index], live[-1] = live[-1], live[index]
+        return live.pop()
+
+    def _transfer(self, cls):
+        live = self._live[cls]
+        cert_no, amount = live[self.random.randrange(len(live))]
+        return [cls.transfer(cert_no, self.random.choice(self.holders))]
+
+    def _cancel(self, cls):
+        cert_no, amount = self._pop_live(cls)
+        self._issued[cls] -= amount
+        return [cls.cancel(cert_no)]
+
+    def _retire(self, cls):
+        cert_no, amount = self._pop_live(cls)
+        self._issued[cls] -= amount
+        if cls.MetaState.DEAUTH_RETIRED:
+            self._authorized[cls] -= amount
+        return [cls.retire(cert_no)]
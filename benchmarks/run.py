@@ -0,0 +1,223 @@
+"""Times the hot paths of captable.py against synthetic ledgers of various
+sizes and prints the results as JSON.
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --output results.json
+
+Pass a previous results file as --baseline to exit with an error if any
+benchmark has become slower by more than --tolerance.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import datetime
+import gc
+import json
+import platform
+import random
+import sys
+import timeit
+
+from captable import CapTable, scenarios as scenario_runner
+from captable.validation import check_auth
+from .ledger import CLASSES, Ledger
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+# Number of times to repeat each query
+REPEAT = 1000
+
+# Number of what-if scenarios, and entries in each, for the scenarios
+# benchmark
+SCENARIOS = 8
+SCENARIO_ENTRIES = 200
+
+
+def _time(func, repeat=1):
+    """Returns the seconds taken to call func repeat times"""
+    gc.collect()
+    start = timeit.default_timer()
+    for _ in range(repeat):
+        func()
+    return timeit.default_timer() - start
+
+
+def _result(name, size, seconds, ops):
+    return {"name": name, "size": size, "seconds": seconds, "ops": ops,
+            "us_per_op": seconds * 1e6 / ops}
+
+
+def ingest_record(size, seed):
+    entries = list(Ledger(size, seed=seed))
+    table = CapTable()
+    def ingest():
+        for entry in entries:
+            table.record(entry[0], *entry[1])
+    return [_result("ingest_record", size, _time(ingest), len(entries))]
+
+
+def ingest_record_many(size, seed):
+    entries = list(Ledger(size, seed=seed))
+    table = CapTable()
+    seconds = _time(lambda: table.record_many(entries, deferred=True))
+    return [_result("ingest_record_many", size, seconds, len(entries))]
+
+
+def queries(size, seed):
+    """Rollbacks and aggregate queries against a table built from a
+    ledger"""
+    ledger = Ledger(size, seed=seed)
+    table = CapTable()
+    table.record_many(ledger, deferred=True)
+    ret = []
+
+    # Issuing more than authorized fails validation and is rolled back
+    cls = CLASSES[0]
+    too_many = cls.issue(holder=ledger.holders[0],
+                         amount=table[cls].authorized + 1)
+    def rollback():
+        try:
+            table.record(None, too_many)
+        except AssertionError:
+            pass
+        else:
+            raise RuntimeError("Transaction should have failed")
+    ret.append(_result("rollback", size, _time(rollback, REPEAT), REPEAT))
+
+    def outstanding():
+        for cls in CLASSES:
+            table[cls].outstanding
+    ret.append(_result("outstanding", size, _time(outstanding, REPEAT),
+                       REPEAT * len(CLASSES)))
+
+    holders = ledger.holders
+    def shares_held():
+        for holder in holders:
+            table.shares_held(holder)
+    ret.append(_result("shares_held", size, _time(shares_held),
+                       len(holders)))
+
+    seconds = _time(lambda: check_auth(table.state), REPEAT)
+    ret.append(_result("check_auth", size, seconds, REPEAT))
+
+    middle = table.transactions[len(table.transactions) // 2][0]
+    ret.append(_result("as_of", size, _time(lambda: table.as_of(middle), 10),
+                       10))
+    return ret
+
+
+def memory(size, seed):
+    """Memory allocated for a table built from a ledger, per issuance"""
+    if tracemalloc is None:
+        return []
+    entries = list(Ledger(size, seed=seed))
+    gc.collect()
+    tracemalloc.start()
+    try:
+        table = CapTable(checkpoint_interval=None)
+        table.record_many(entries, deferred=True)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return [{"name": "memory", "size": size, "bytes": current,
+             "peak_bytes": peak, "bytes_per_issuance": current / size}]
+
+
+def scenarios(size, seed):
+    """What-if scenarios recorded on forks of a table built from a ledger,
+    both in this process and in a pool of worker processes"""
+    ledger = Ledger(size, seed=seed)
+    table = CapTable()
+    table.record_many(ledger, deferred=True)
+
+    rand = random.Random(seed)
+    cls = CLASSES[0]
+    after = table.datetime + datetime.timedelta(days=1)
+    batches = [[(after, cls.auth(delta=10 ** 7))] + [
+        (after, cls.issue(holder=rand.choice(ledger.holders), amount=100))
+        for _ in range(SCENARIO_ENTRIES)
+    ] for _ in range(SCENARIOS)]
+
+    ret = []
+    for name, processes in [("scenarios_serial", 0),
+                            ("scenarios_parallel", None)]:
+        seconds = _time(lambda: scenario_runner.run(table, batches,
+                                                    processes=processes))
+        ret.append(_result(name, size, seconds, SCENARIOS))
+    return ret
+
+
+BENCHMARKS = [ingest_record, ingest_record_many, queries, memory, scenarios]
+
+
+def run(sizes, seed=0, names=None):
+    """Returns a dict of results for each benchmark (optionally only those
+    named) and size"""
+    results = []
+    for size in sizes:
+        for benchmark in BENCHMARKS:
+            if names and benchmark.__name__ not in names:
+                continue
+            for result in benchmark(size, seed):
+                print("%(name)s[%(size)s]" % result, file=sys.stderr)
+                results.append(result)
+    return {"python": platform.python_version(), "seed": seed,
+            "results": results}
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a list of messages for each result slower (or larger) than
+    the same result in baseline by more than tolerance (a fraction)"""
+    ret = []
+    previous = dict(((r["name"], r["size"]), r) for r in baseline["results"])
+    for result in results["results"]:
+        old = previous.get((result["name"], result["size"]))
+        if old is None:
+            continue
+        for key in ("us_per_op", "bytes_per_issuance"):
+            if key in result and key in old and \
+                    result[key] > old[key] * (1 + tolerance):
+                ret.append("%s[%s] %s: %.2f -> %.2f" % (
+                    result["name"], result["size"], key, old[key],
+                    result[key]))
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="Numbers of issuances to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="+", metavar="NAME",
+                        help="Only run these benchmarks")
+    parser.add_argument("--output", help="Write results to this file")
+    parser.add_argument("--baseline", help="Compare against these results")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown relative to the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.seed, args.only)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file_:
+            file_.write(data)
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline) as file_:
+            baseline = json.load(file_)
+        slower = regressions(results, baseline, args.tolerance)
+        for message in slower:
+            print("Regression: " + message, file=sys.stderr)
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 from __future__ import absolute_import
 
-from .table import CapTable
+from .table import CapTable, RecordError
 from .persons import Person, NaturalPerson, Entity
 from .securities import Security, Stock, CommonStock
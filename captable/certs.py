@@ -0,0 +1,291 @@
+"""Sorted index of the certificate numbers of a class of securities.
+
+Security.MetaState.cert_no_lookups maps each cert_no to its issuance, but
+can't answer ordered questions without sorting every key. The MetaState's
+cert_index keeps the cert_nos in natural order -- runs of digits compare as
+numbers, so CS-9 comes before CS-10 -- for range and prefix queries, and
+for picking the next free number in a series:
+
+    index = table[CommonStock].cert_index
+    index.between("CS-1000", "CS-1999")     # CS-1000 through CS-1999
+    index.prefixed("PA-", live=True)        # Uncancelled PA- certificates
+    index.next_cert_no("CS-")               # e.g. "CS-2000"
+
+Each query takes logarithmic time plus the time to read what it returns.
+The uncancelled cert_nos are indexed separately, so skipping cancelled
+certificates doesn't mean reading them.
+"""
+from __future__ import absolute_import
+
+import bisect
+import itertools
+import re
+
+from .journal import active
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_key(cert_no):
+    """Returns a key sorting cert_no in natural order. The first item is a
+    tuple alternating between runs of text and numbers (always starting and
+    ending with text, maybe empty). cert_nos differing only in leading zeros
+    are ordered by the cert_nos themselves."""
+    parts = _DIGITS.split(cert_no)
+    parts[1::2] = [int(digits) for digits in parts[1::2]]
+    return tuple(parts), cert_no
+
+
+class SortedKeys(object):
+    """A sorted list of keys, stored as a list of sorted chunks so adding and
+    removing a key only moves the keys in its chunk. Changes aren't
+    journaled -- see CertIndex.
+
+    Forking (see journal.forked) shares the chunks, and each copy copies a
+    chunk the first time it changes it.
+    """
+    # Chunks are split in two once they grow past twice this size
+    CHUNK_SIZE = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        size = self.CHUNK_SIZE
+        self._chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+
+        # Whether each chunk belongs to this list alone, so can be modified
+        self._own = [True] * len(self._chunks)
+        self._length = len(keys)
+
+    def __fork__(self):
+        ret = object.__new__(self.__class__)
+        ret._chunks = list(self._chunks)
+        ret._maxes = list(self._maxes)
+        ret._length = self._length
+        ret._own = [False] * len(self._chunks)
+        self._own = list(ret._own)
+        return ret
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(list(self._chunks))
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        return i < len(self._maxes) and self._find(i, key) is not None
+
+    def _find(self, i, key):
+        chunk = self._chunks[i]
+        j = bisect.bisect_left(chunk, key)
+        if j < len(chunk) and chunk[j] == key:
+            return j
+        return None
+
+    def _writable(self, i):
+        """Returns chunk i, copying it first if shared"""
+        if not self._own[i]:
+            self._chunks[i] = list(self._chunks[i])
+            self._own[i] = True
+        return self._chunks[i]
+
+    def add(self, key):
+        maxes = self._maxes
+        if not maxes:
+            self._chunks.append([key])
+            maxes.append(key)
+            self._own.append(True)
+            self._length += 1
+            return
+        i = min(bisect.bisect_left(maxes, key), len(maxes) - 1)
+        chunk = self._writable(i)
+        bisect.insort(chunk, key)
+        maxes[i] = chunk[-1]
+        self._length += 1
+
+        size = self.CHUNK_SIZE
+        if len(chunk) > 2 * size:
+            self._chunks[i:i + 1] = [chunk[:size], chunk[size:]]
+            maxes[i:i + 1] = [chunk[size - 1], chunk[-1]]
+            self._own[i:i + 1] = [True, True]
+
+    def remove(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        j = self._find(i, key) if i < len(self._maxes) else None
+        if j is None:
+            raise ValueError("%r not in index" % (key,))
+        chunk = self._writable(i)
+        del chunk[j]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i], self._maxes[i], self._own[i]
+        self._length -= 1
+
+    def irange(self, start=None):
+        """Yields the keys from the first one not less than start"""
+        chunks = list(self._chunks)
+        i = j = 0
+        if start is not None:
+            i = bisect.bisect_left(self._maxes, start)
+            if i < len(chunks):
+                j = bisect.bisect_left(chunks[i], start)
+        for chunk in itertools.islice(chunks, i, None):
+            for key in itertools.islice(chunk, j, None):
+                yield key
+            j = 0
+
+    def before(self, key):
+        """Returns the last key less than key, or None if there isn't one"""
+        i = bisect.bisect_left(self._maxes, key)
+        if i < len(self._maxes):
+            chunk = self._chunks[i]
+            j = bisect.bisect_left(chunk, key)
+            if j:
+                return chunk[j - 1]
+        return self._maxes[i - 1] if i else None
+
+
+def _unadd(index, key, live):
+    index._all.remove(key)
+    if live:
+        index._live.remove(key)
+
+
+class CertIndex(object):
+    """The cert_nos of a class of securities in natural order (see
+    natural_key), with the uncancelled ones indexed separately. Changes made
+    through add and cancel are journaled.
+
+    Args:
+        items - (cert_no, cancelled) 2-tuples to start with
+    """
+    def __init__(self, items=()):
+        items = [(natural_key(cert_no), cancelled)
+                 for cert_no, cancelled in items]
+        self._all = SortedKeys(key for key, _ in items)
+        self._live = SortedKeys(key for key, cancelled in items
+                                if not cancelled)
+
+    def __fork__(self):
+        ret = object.__new__(self.__class__)
+        ret._all = self._all.__fork__()
+        ret._live = self._live.__fork__()
+        return ret
+
+    def __len__(self):
+        return len(self._all)
+
+    def __iter__(self):
+        return (cert_no for _, cert_no in self._all)
+
+    def __contains__(self, cert_no):
+        return natural_key(cert_no) in self._all
+
+    def add(self, cert_no, cancelled=False):
+        key = natural_key(cert_no)
+        self._all.add(key)
+        if not cancelled:
+            self._live.add(key)
+        journal = active()
+        if journal is not None:
+            journal.record(_unadd, self, key, not cancelled)
+
+    def cancel(self, cert_no):
+        key = natural_key(cert_no)
+        self._live.remove(key)
+        journal = active()
+        if journal is not None:
+            journal.record(self._live.add, key)
+
+    def live(self):
+        """Returns an iterator over the uncancelled cert_nos"""
+        return (cert_no for _, cert_no in self._live)
+
+    def between(self, first=None, last=None, live=False):
+        """Returns an iterator over the cert_nos from first through last
+        (both included, and either may be omitted) in natural order.
+
+        Args:
+            first, last (str) - cert_nos bounding the range. Need not be
+                in the index.
+            live (bool) - If True, skip cancelled certificates
+        """
+        keys = self._live if live else self._all
+        start = None if first is None else natural_key(first)
+        stop = None if last is None else natural_key(last)
+        for key in keys.irange(start):
+            if stop is not None and key > stop:
+                return
+            yield key[1]
+
+    def prefixed(self, prefix, live=False):
+        """Returns an iterator over the cert_nos starting with prefix in
+        natural order, e.g. prefixed("CS-1") yields CS-1, CS-10 to CS-19,
+        CS-100 to CS-199 and so on.
+
+        A prefix ending in digits with a leading zero (e.g. "CS-0") matches
+        by reading every cert_no with the text before them (e.g. "CS-")
+        instead.
+        """
+        keys = self._live if live else self._all
+        parts = natural_key(prefix)[0]
+        if len(parts) == 1 or parts[-1]:
+            # Ends in text, so matches have it at the start of the same part
+            head, text = parts[:-1], parts[-1]
+            size = len(head)
+            ranges = [((parts,), lambda p: p[size].startswith(text))]
+        else:
+            head = parts[:-2]
+            size = len(head)
+            digits = _DIGITS.split(prefix)[-2]
+            if digits.startswith("0"):
+                ranges = [((head + (0,),), lambda p: True)]
+            else:
+                ranges = _digit_ranges(head, parts[-2])
+
+        for start, accept in ranges:
+            found = False
+            for key in keys.irange(start):
+                key_parts = key[0]
+                if len(key_parts) <= size or key_parts[:size] != head:
+                    if not found:
+                        return
+                    break
+                found = True
+                if not accept(key_parts):
+                    break
+                if key[1].startswith(prefix):
+                    yield key[1]
+            if not found:
+                return
+
+    def next_cert_no(self, prefix, start=1):
+        """Returns prefix followed by the number after the highest number any
+        cert_no (cancelled or not) has right after prefix, or by start if
+        there isn't one. Zero-padding of the highest number is kept, e.g.
+        CS-0099 is followed by CS-0100.
+
+        Raises a ValueError if prefix ends with a digit.
+        """
+        parts = natural_key(prefix)[0]
+        if parts[-1] == "" and len(parts) > 1:
+            raise ValueError("Prefix %r can't end with a digit" % prefix)
+        size = len(parts)
+        key = self._all.before((parts + (float('inf'),),))
+        if key is None or len(key[0]) <= size or key[0][:size] != parts:
+            return "%s%s" % (prefix, start)
+        width = len(_DIGITS.split(key[1])[size])
+        return "%s%0*d" % (prefix, width, max(key[0][size] + 1, start))
+
+
+def _digit_ranges(head, number):
+    """Yields (start, accept) 2-tuples for the runs of keys whose parts
+    start with head followed by a number beginning with the digits of
+    number: number itself, then number * 10 to number * 10 + 9, and so on"""
+    size = len(head)
+    for power in itertools.count():
+        low = number * 10 ** power
+        high = (number + 1) * 10 ** power
+        yield (head + (low,),), lambda p, high=high: p[size] < high
@@ -0,0 +1,617 @@
+"""Compact, array-backed storage for Stock issuances.
+
+By default, each issuance of a class of Stock is a full Python object. For
+classes with very many certificates, mix Columnar into the class's MetaState
+to store issuances in parallel typed arrays instead:
+
+    class CommonStock(captable.CommonStock):
+        class MetaState(Columnar, captable.CommonStock.MetaState):
+            pass
+
+Issuances are still created and issued as Stock instances, but are then
+stored as rows and handed back (via the MetaState's issuances sequence,
+__getitem__, cert_no_lookups, and held_by) as lightweight IssuanceProxy
+objects that read and write the underlying arrays.
+"""
+from __future__ import absolute_import
+
+from array import array
+from itertools import compress
+import copy
+import datetime
+import operator
+
+from .journal import (ForkedDict, JournaledDict, JournaledList, active,
+                      shared)
+from .securities import _load_lock
+
+# Issue datetimes are stored as microseconds since EPOCH
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Marker in the issued_on column for issuances without a datetime (or whose
+# datetime can't be stored as a timestamp, in which case it lives in extras)
+NO_DATE = -2 ** 63
+
+# Typecode for 64-bit integer columns (Python 2 lacks 'q', but 'l' is 64-bit
+# on most 64-bit platforms)
+try:
+    array('q')
+    INT64 = 'q'
+except ValueError:
+    INT64 = 'l'
+
+# Attributes with dedicated columns
+FIELDS = frozenset(['holder', 'amount', 'cancelled', 'issued_on', 'cert_no',
+                    'cert_name'])
+
+# IssuanceColumns containers a fork shares until it modifies them
+SHARED = frozenset(['amounts', 'issued_on', 'cancelled', 'holder_ids',
+                    'class_ids', 'cert_nos', 'cert_names', 'extras',
+                    'holders', '_holder_lookups', 'classes',
+                    '_class_lookups'])
+
+
+def _to_micros(value):
+    if type(value) is not datetime.datetime or value.tzinfo is not None:
+        return NO_DATE
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+class IssuanceColumns(object):
+    """Parallel arrays holding one row per issuance. Holders and Security
+    classes are interned, with rows storing an integer id for each. Holder id
+    0 is reserved for None (treasury).
+
+    Changes made through append and set are journaled.
+
+    A copy made for a fork (see __fork__) shares the original's containers,
+    copying each the first time it's modified.
+    """
+    # Names of containers shared with the original this was forked from
+    _shared = frozenset()
+
+    def __init__(self):
+        self.amounts = array(INT64)
+        self.issued_on = array(INT64)
+        self.cancelled = array('b')
+        self.holder_ids = array('i')
+        self.class_ids = array('H')
+        self.cert_nos = []
+        self.cert_names = []
+
+        # Maps row index to a dict of any other attributes set on the issuance
+        self.extras = {}
+
+        self.holders = [None]
+        self._holder_lookups = {}
+        self.classes = []
+        self._class_lookups = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getstate__(self):
+        # Copies made via pickle share nothing
+        state = dict(self.__dict__)
+        state.pop('_shared', None)
+        return state
+
+    def __fork__(self):
+        """Returns a copy sharing every container with this one, which must
+        not be modified afterwards"""
+        ret = object.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret._shared = SHARED
+        return ret
+
+    def _own(self, *names):
+        """Replace any of the named containers still shared with the
+        original with copies of their own"""
+        shared = self._shared
+        for name in names:
+            if name not in shared:
+                continue
+            value = getattr(self, name)
+            if isinstance(value, array):
+                value = array(value.typecode, value)
+            elif name == 'extras':
+                value = dict((index, JournaledDict(extras))
+                             for index, extras in value.items())
+            else:
+                value = copy.copy(value)
+            setattr(self, name, value)
+            shared = self._shared = shared - set([name])
+
+    def __deepcopy__(self, memo):
+        ret = object.__new__(self.__class__)
+        memo[id(self)] = ret
+        for name in ('amounts', 'issued_on', 'cancelled', 'holder_ids',
+                     'class_ids'):
+            column = getattr(self, name)
+            setattr(ret, name, array(column.typecode, column))
+        ret.cert_nos = list(self.cert_nos)
+        ret.cert_names = list(self.cert_names)
+        ret.extras = copy.deepcopy(self.extras, memo)
+
+        # Holders and classes are identifiers and are shared with the copy
+        ret.holders = list(self.holders)
+        ret._holder_lookups = dict(self._holder_lookups)
+        ret.classes = list(self.classes)
+        ret._class_lookups = dict(self._class_lookups)
+        return ret
+
+    def holder_id(self, holder):
+        """Returns the interned id for holder"""
+        if holder is None:
+            return 0
+        ret = self._holder_lookups.get(holder)
+        if ret is None:
+            self._own('holders', '_holder_lookups')
+            ret = len(self.holders)
+            self.holders.append(holder)
+            self._holder_lookups[holder] = ret
+        return ret
+
+    def class_id(self, cls):
+        """Returns the interned id for a Security class"""
+        ret = self._class_lookups.get(cls)
+        if ret is None:
+            self._own('classes', '_class_lookups')
+            ret = len(self.classes)
+            self.classes.append(cls)
+            self._class_lookups[cls] = ret
+        return ret
+
+    def append(self, issuance):
+        """Add a row copied from an issuance object. Returns the row index."""
+        self._own('amounts', 'issued_on', 'cancelled', 'holder_ids',
+                  'class_ids', 'cert_nos', 'cert_names')
+        index = len(self.amounts)
+        self.amounts.append(issuance.amount)
+        micros = _to_micros(issuance.issued_on)
+        self.issued_on.append(micros)
+        self.cancelled.append(1 if issuance.cancelled else 0)
+        self.holder_ids.append(self.holder_id(issuance.holder))
+        self.cert_nos.append(issuance.cert_no)
+        self.cert_names.append(issuance.cert_name)
+        if isinstance(issuance, IssuanceProxy):
+            self.class_ids.append(self.class_id(issuance.security_class))
+            extras = issuance._columns.extras.get(issuance._index, {})
+        else:
+            self.class_ids.append(self.class_id(issuance.__class__))
+            extras = vars(issuance)
+        extras = dict((k, v) for k, v in extras.items() if k not in FIELDS)
+        if micros == NO_DATE and issuance.issued_on is not None:
+            extras['issued_on'] = issuance.issued_on
+        if extras:
+            self._own('extras')
+            self.extras[index] = extras
+
+        journal = active()
+        if journal is not None:
+            journal.record(self._truncate, index)
+        return index
+
+    def _truncate(self, length):
+        for column in (self.amounts, self.issued_on, self.cancelled,
+                       self.holder_ids, self.class_ids, self.cert_nos,
+                       self.cert_names):
+            del column[length:]
+        for index in [i for i in self.extras if i >= length]:
+            del self.extras[index]
+
+    def set(self, name, index, value):
+        """Set a value in the named column"""
+        self._own(name)
+        column = getattr(self, name)
+        journal = active()
+        if journal is not None:
+            journal.record(column.__setitem__, index, column[index])
+        column[index] = value
+
+    def set_extra(self, index, name, value):
+        """Set an attribute that doesn't have a dedicated column"""
+        self._own('extras')
+        extras = self.extras.setdefault(index, JournaledDict())
+        if not isinstance(extras, JournaledDict):
+            extras = self.extras[index] = JournaledDict(extras)
+        extras[name] = value
+
+    def datetime(self, index):
+        """Returns the issued_on datetime for a row"""
+        micros = self.issued_on[index]
+        if micros == NO_DATE:
+            return self.extras.get(index, {}).get('issued_on')
+        return EPOCH + datetime.timedelta(microseconds=micros)
+
+    def totals(self):
+        """Returns (issued, outstanding, cancelled) share totals. Sums are
+        computed with C-level iteration over the arrays rather than by
+        visiting each row in Python."""
+        amounts = self.amounts
+        cancelled = sum(compress(amounts, self.cancelled))
+        issued = sum(amounts) - cancelled
+
+        # Outstanding excludes uncancelled treasury (holder id 0) rows
+        treasury = list(map(operator.not_, self.holder_ids))
+        treasury_cancelled = list(map(operator.and_, treasury, self.cancelled))
+        outstanding = issued - (sum(compress(amounts, treasury)) -
+                                sum(compress(amounts, treasury_cancelled)))
+        return issued, outstanding, cancelled
+
+
+class IssuanceProxy(object):
+    """Stands in for a Stock instance stored as a row in IssuanceColumns.
+    Supports the same attributes as the Stock instance, plus:
+
+    Properties:
+        security_class (class) - The class of the original Stock instance
+    """
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        object.__setattr__(self, '_columns', columns)
+        object.__setattr__(self, '_index', index)
+
+    @property
+    def holder(self):
+        c = self._columns
+        return c.holders[c.holder_ids[self._index]]
+
+    @holder.setter
+    def holder(self, value):
+        c = self._columns
+        c.set('holder_ids', self._index, c.holder_id(value))
+
+    @property
+    def amount(self):
+        return self._columns.amounts[self._index]
+
+    @amount.setter
+    def amount(self, value):
+        self._columns.set('amounts', self._index, value)
+
+    @property
+    def cancelled(self):
+        return bool(self._columns.cancelled[self._index])
+
+    @cancelled.setter
+    def cancelled(self, value):
+        self._columns.set('cancelled', self._index, 1 if value else 0)
+
+    @property
+    def issued_on(self):
+        return self._columns.datetime(self._index)
+
+    @issued_on.setter
+    def issued_on(self, value):
+        c = self._columns
+        micros = _to_micros(value)
+        if micros == NO_DATE and value is not None:
+            c.set_extra(self._index, 'issued_on', value)
+        c.set('issued_on', self._index, micros)
+
+    @property
+    def cert_no(self):
+        return self._columns.cert_nos[self._index]
+
+    @cert_no.setter
+    def cert_no(self, value):
+        self._columns.set('cert_nos', self._index, value)
+
+    @property
+    def cert_name(self):
+        return self._columns.cert_names[self._index]
+
+    @cert_name.setter
+    def cert_name(self, value):
+        self._columns.set('cert_names', self._index, value)
+
+    @property
+    def security_class(self):
+        c = self._columns
+        return c.classes[c.class_ids[self._index]]
+
+    def __getattr__(self, name):
+        extras = self._columns.extras.get(self._index)
+        if extras and name in extras:
+            return extras[name]
+        # Fall back to class-level defaults, e.g. Stock.vesting
+        if not name.startswith('_'):
+            try:
+                return getattr(self.security_class, name)
+            except AttributeError:
+                pass
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in FIELDS:
+            object.__setattr__(self, name, value)
+        else:
+            self._columns.set_extra(self._index, name, value)
+
+    def __eq__(self, other):
+        return (isinstance(other, IssuanceProxy) and
+                self._columns is other._columns and
+                self._index == other._index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._columns), self._index))
+
+    def __repr__(self):
+        return "<%s #%s (%s)>" % (self.security_class.__name__, self._index,
+                                  self.cert_no)
+
+    def materialize(self):
+        """Returns a regular Stock instance with this issuance's attributes"""
+        ret = object.__new__(self.security_class)
+        ret.__dict__.update(holder=self.holder,
+                            amount=self.amount,
+                            cancelled=self.cancelled,
+                            issued_on=self.issued_on,
+                            cert_no=self.cert_no,
+                            cert_name=self.cert_name)
+        extras = self._columns.extras.get(self._index, {})
+        ret.__dict__.update((k, v) for k, v in extras.items()
+                            if k != 'issued_on')
+        return ret
+
+
+class ColumnarIssuances(object):
+    """Read-only sequence of IssuanceProxy objects for each row in columns"""
+
+    def __init__(self, columns):
+        self._columns = columns
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return IssuanceProxy(self._columns, index)
+
+    def __iter__(self):
+        columns = self._columns
+        for index in range(len(columns)):
+            yield IssuanceProxy(columns, index)
+
+    def append(self, issuance):
+        """Rows are added by Columnar.issue, so appending only checks that
+        issuance is the most recently added row"""
+        assert issuance._columns is self._columns and \
+            issuance._index == len(self._columns) - 1, \
+            "Only the newest row can be appended"
+
+
+class CertNoLookups(JournaledDict):
+    """Maps cert_no to row index, but returns IssuanceProxy objects"""
+
+    def __init__(self, columns):
+        super(CertNoLookups, self).__init__()
+        self._columns = columns
+
+    def __setitem__(self, key, issuance):
+        if isinstance(issuance, IssuanceProxy):
+            issuance = issuance._index
+        JournaledDict.__setitem__(self, key, issuance)
+
+    def __getitem__(self, key):
+        return IssuanceProxy(self._columns, dict.__getitem__(self, key))
+
+    def __reduce__(self):
+        # Copy and pickle the row indexes rather than proxies
+        return (_cert_no_lookups, (self._columns, dict(dict.items(self))))
+
+    def _fork(self, columns):
+        """Returns a copy for a fork with the given columns, layered over
+        this one (see journal.ForkedDict)"""
+        return ForkedCertNoLookups(self, columns)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+
+class ForkedCertNoLookups(ForkedDict, CertNoLookups):
+    """CertNoLookups layered over the row indexes of another"""
+
+    def __init__(self, base, columns):
+        super(ForkedCertNoLookups, self).__init__(base)
+        self._columns = columns
+
+    def _layer(self, base):
+        return ForkedCertNoLookups(base, self._columns)
+
+    def _fork(self, columns):
+        ret = self.__fork__()
+        ret._columns = columns
+        return ret
+
+    def __setitem__(self, key, issuance):
+        if isinstance(issuance, IssuanceProxy):
+            issuance = issuance._index
+        ForkedDict.__setitem__(self, key, issuance)
+
+    def __getitem__(self, key):
+        return IssuanceProxy(self._columns, ForkedDict.__getitem__(self, key))
+
+    def __reduce__(self):
+        return (_cert_no_lookups,
+                (self._columns, dict(ForkedDict.iteritems(self))))
+
+    def __eq__(self, other):
+        # Compares row indexes, like CertNoLookups
+        if isinstance(other, dict):
+            return dict(ForkedDict.iteritems(self)) == other
+        return NotImplemented
+
+    get = CertNoLookups.__dict__['get']
+    values = CertNoLookups.__dict__['values']
+    items = CertNoLookups.__dict__['items']
+    itervalues = CertNoLookups.__dict__['itervalues']
+    iteritems = CertNoLookups.__dict__['iteritems']
+
+
+def _cert_no_lookups(columns, rows):
+    ret = CertNoLookups(columns)
+    dict.update(ret, rows)
+    return ret
+
+
+class Columnar(object):
+    """Mixin for Stock MetaState classes storing issuances in IssuanceColumns.
+    Must precede the Stock MetaState in the list of base classes.
+
+    A copy made for a fork (see __fork__) shares the columns and indexes
+    with the original, copying each only when it's first modified.
+
+    Properties:
+        columns (IssuanceColumns) - Underlying storage
+    """
+
+    @classmethod
+    def __migrate__(cls, old_state):
+        ret = cls()
+        attrs = dict(old_state.__export__())
+        issuances = attrs.pop('issuances')
+        for name in ('cert_no_lookups', 'holdings', 'holder_amounts',
+                     'columns', '_live', '_writable', '_issuance_positions',
+                     '_owned_rows'):
+            attrs.pop(name, None)
+        ret.__dict__.update(attrs)
+        for issuance in issuances:
+            index = ret.columns.append(issuance)
+            if issuance.cert_no:
+                ret.cert_no_lookups[issuance.cert_no] = index
+        ret._reindex()
+        if '_issued' not in attrs:
+            ret._recount()
+        return ret
+
+    def __export__(self):
+        self._load()
+        attrs = dict(self.__dict__)
+        for name in ('columns', 'holdings', 'holder_amounts', '_live'):
+            del attrs[name]
+        attrs.pop('_owned_rows', None)
+        attrs['issuances'] = issuances = JournaledList()
+        attrs['cert_no_lookups'] = cert_no_lookups = JournaledDict()
+        for proxy in self.issuances:
+            issuance = proxy.materialize()
+            issuances.append(issuance)
+            if issuance.cert_no:
+                cert_no_lookups[issuance.cert_no] = issuance
+        return attrs
+
+    def __deepcopy__(self, memo):
+        # Unlike object storage, there are no Snowflake issuances to clone
+        ret = object.__new__(self.__class__)
+        memo[id(self)] = ret
+        ret.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        # The copy shares nothing, so owns every holder's rows
+        ret.__dict__.pop('_owned_rows', None)
+        return ret
+
+    def __fork__(self):
+        """Returns a copy for a fork of a table (see journal.forked), sharing
+        the columns, cert_no_lookups and holder index with this MetaState"""
+        ret = object.__new__(self.__class__)
+        with _load_lock:
+            attrs = dict(self.__dict__)
+        attrs.pop('_owned_rows', None)
+        columns = attrs.pop('columns', None)
+        if columns is not None:
+            columns = ret.__dict__['columns'] = columns.__fork__()
+            ret.__dict__['issuances'] = ColumnarIssuances(columns)
+            ret.__dict__['cert_no_lookups'] = \
+                attrs.pop('cert_no_lookups')._fork(columns)
+            del attrs['issuances']
+            # Holders whose arrays of rows this copy may append to
+            ret.__dict__['_owned_rows'] = JournaledDict()
+        for name, value in attrs.items():
+            ret.__dict__[name] = shared(value)
+        return ret
+
+    def __init__(self):
+        super(Columnar, self).__init__()
+        self.columns = IssuanceColumns()
+        self.issuances = ColumnarIssuances(self.columns)
+        self.cert_no_lookups = CertNoLookups(self.columns)
+
+        # Number of live rows per holder
+        self._live = JournaledDict()
+
+    def _reindex(self):
+        self._live = JournaledDict()
+        super(Columnar, self)._reindex()
+
+    # The holder index maps each holder to an array of the rows it has held,
+    # plus a count of how many of those rows are still live. Rows are not
+    # removed from the array when released, but skipped when read.
+    def _add_holding(self, holder, issuance):
+        rows = self.holdings.get(holder)
+        owned = self.__dict__.get('_owned_rows')
+        if rows is None or owned is not None and holder not in owned:
+            # Arrays shared with the original of a fork are copied first
+            rows = self.holdings[holder] = array('i', rows or ())
+            if owned is not None:
+                owned[holder] = True
+        rows.append(issuance._index)
+        journal = active()
+        if journal is not None:
+            journal.record(rows.pop)
+        self._live[holder] = self._live.get(holder, 0) + 1
+
+    def _remove_holding(self, holder, issuance):
+        live = self._live[holder] - 1
+        if live:
+            self._live[holder] = live
+        else:
+            del self._live[holder]
+            del self.holdings[holder]
+
+    def held_by(self, holder):
+        columns = self.columns
+        holder_id = columns._holder_lookups.get(holder)
+        ret = []
+        seen = set()
+        for row in self.holdings.get(holder, ()):
+            if row not in seen and columns.holder_ids[row] == holder_id and \
+                    not columns.cancelled[row]:
+                seen.add(row)
+                ret.append(IssuanceProxy(columns, row))
+        return ret
+
+    def _count(self):
+        return self.columns.totals()
+
+    def issue(self, issuance):
+        if not isinstance(issuance, IssuanceProxy) or \
+                issuance._columns is not self.columns:
+            issuance = IssuanceProxy(self.columns,
+                                     self.columns.append(issuance))
+        return super(Columnar, self).issue(issuance)
@@ -0,0 +1,177 @@
+"""What changed on a table between two points in time (see CapTable.diff).
+
+A diff is worked out by replaying the transactions recorded in between on a
+copy of the earlier state while a Tracker is active. MetaStates report each
+certificate they issue, transfer or cancel to the active Tracker (see
+Security.MetaState.issue), which notes what the certificate looked like
+before its first change. So a diff costs time in proportion to the number of
+transactions in between, rather than the size of the table.
+
+    changes = table.diff(datetime.datetime(2015, 12, 31),
+                         datetime.datetime(2016, 3, 31))
+    for change in changes.transferred:
+        print(change.cert_no, change.old_holder, change.holder)
+
+Changes are net -- a certificate transferred and then transferred back
+isn't reported as transferred, and a certificate issued in between is only
+reported as issued (and cancelled, if it was), to its final holder.
+"""
+from __future__ import absolute_import
+
+import threading
+
+# Trackers are per thread, like journals
+_local = threading.local()
+
+
+def tracker():
+    """Returns the Tracker collecting changes for this thread, or None"""
+    return getattr(_local, 'tracker', None)
+
+
+def _security_name(issuance):
+    # Columnar issuances stand in for an instance of their security_class
+    return getattr(issuance, 'security_class', type(issuance)).name
+
+
+class Tracker(object):
+    """Collects the certificates MetaStates change while active. Use as a
+    context manager to activate."""
+
+    def __init__(self):
+        # Maps (security name, cert_no) -- or (security name, issuance) for
+        # issuances without a cert_no -- to (holder, cancelled) before the
+        # first change, or None if issued while active
+        self._before = {}
+
+        # (security name, cert_no, issuance if no cert_no) 3-tuples, in order
+        # of first change
+        self._order = []
+
+    def __enter__(self):
+        self._previous = tracker()
+        _local.tracker = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.tracker = self._previous
+
+    def _note(self, issuance, before):
+        name, cert_no = _security_name(issuance), issuance.cert_no
+        key = (name, cert_no or issuance)
+        if key not in self._before:
+            self._before[key] = before
+            self._order.append((name, cert_no, None if cert_no else issuance))
+
+    def issued(self, issuance):
+        """Called when issuance is issued"""
+        self._note(issuance, None)
+
+    def changing(self, issuance):
+        """Called before issuance's holder or cancelled attributes change"""
+        self._note(issuance, (issuance.holder, issuance.cancelled))
+
+    def changes(self, securities):
+        """Returns a list of CertChanges for the certificates changed (on
+        net) as of the securities dict of a table's state"""
+        ret = []
+        for name, cert_no, issuance in self._order:
+            before = self._before[(name, cert_no or issuance)]
+            if cert_no:
+                issuance = securities[name].cert_no_lookups[cert_no]
+            change = CertChange(name, cert_no, issuance, before)
+            if change.issued or change.cancelled or change.transferred:
+                ret.append(change)
+        return ret
+
+
+def authorizations(securities):
+    """Returns a dict mapping the name of each class in the securities dict
+    of a table's state to its authorized amount, or None if the class doesn't
+    have one"""
+    return dict((name, getattr(metastate, 'authorized', None))
+                for name, metastate in securities.items())
+
+
+class CertChange(object):
+    """How one certificate changed
+
+    Properties:
+        security (str) - Name of the certificate's class of securities
+        cert_no (str) - The certificate's cert_no, if any
+        issuance (Security) - The certificate as of the end of the diff.
+            Usually a copy, since the diff replays transactions on a copy of
+            the table's state.
+        old_holder, holder - Holders at the start and end of the diff. The
+            old holder of a certificate issued in between is None.
+        issued (bool) - True if issued in between
+        cancelled (bool) - True if cancelled in between
+        transferred (bool) - True if held by someone else at the end than at
+            the start. Always False for certificates issued in between.
+    """
+    def __init__(self, security, cert_no, issuance, before):
+        self.security = security
+        self.cert_no = cert_no
+        self.issuance = issuance
+        self.holder = issuance.holder
+        self.issued = before is None
+        if self.issued:
+            self.old_holder = None
+            self.cancelled = bool(issuance.cancelled)
+            self.transferred = False
+        else:
+            self.old_holder, was_cancelled = before
+            self.cancelled = bool(issuance.cancelled) and not was_cancelled
+            self.transferred = self.holder is not self.old_holder
+
+    def __repr__(self):
+        return "<CertChange %s %s: %s>" % (
+            self.security, self.cert_no or "(no cert_no)",
+            ", ".join(kind for kind in ("issued", "transferred", "cancelled")
+                      if getattr(self, kind)))
+
+
+class ChangeSet(object):
+    """What changed on a table between two points in time. Returned by
+    CapTable.diff.
+
+    Properties:
+        start, end (datetime) - The points in time compared
+        certificates (list) - A CertChange for each certificate changed, in
+            order of first change
+        issued, cancelled, transferred (list) - The CertChanges of the
+            certificates issued, cancelled or transferred
+        authorized (dict) - Maps the name of each class whose authorized
+            amount changed to an (old amount, new amount) 2-tuple. Classes
+            authorized in between have an old amount of None, as do classes
+            without an authorized amount.
+    """
+    def __init__(self, start, end, certificates, authorized):
+        self.start = start
+        self.end = end
+        self.certificates = certificates
+        self.authorized = authorized
+
+    @property
+    def issued(self):
+        return [change for change in self.certificates if change.issued]
+
+    @property
+    def cancelled(self):
+        return [change for change in self.certificates if change.cancelled]
+
+    @property
+    def transferred(self):
+        return [change for change in self.certificates if change.transferred]
+
+    def __bool__(self):
+        return bool(self.certificates or self.authorized)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "<ChangeSet %s to %s: %s issued, %s transferred, " \
+            "%s cancelled, %s authorizations>" % (
+                self.start, self.end, len(self.issued),
+                len(self.transferred), len(self.cancelled),
+                len(self.authorized))
@@ -0,0 +1,856 @@
+"""Undo journal used to make CapTable transactions atomic without copying the
+entire table state.
+
+While a Journal is active (see `Journal.__enter__`), every mutation made to a
+Journaled object or to a JournaledDict / JournaledList is recorded along with
+enough information to undo it. Rolling back the journal replays those undo
+records in reverse order, so the cost of a commit or rollback is proportional
+to the size of the transaction rather than the size of the table.
+
+State that is not tracked (e.g. plain lists or dicts that a custom transaction
+stores in the table's state dict) is copied on first access through a
+StateDict instead, so arbitrary transactions remain atomic.
+
+The same objects support forking (see `forked` and CapTable.fork): a forked
+StateDict shares its values with the original until either one accesses
+them while applying transactions (see `writing`), and then only copies what
+it accessed, one level at a time. Large
+containers can instead be layered over the original (see `shared`), storing
+only what changed since the fork.
+"""
+from __future__ import absolute_import
+
+import copy
+import datetime
+import itertools
+import threading
+
+from .mixins import Snowflake
+
+# Journals are tracked per thread so that objects can find the active journal
+# without having it passed around explicitly
+_local = threading.local()
+
+# Sentinel for attributes or keys that did not exist prior to a mutation
+MISSING = object()
+
+
+def active():
+    """Returns the Journal currently recording mutations for this thread, or
+    None if no journal is active"""
+    return getattr(_local, 'journal', None)
+
+
+class Journal(object):
+    """Records undo information for mutations made while active. Use as a
+    context manager to activate.
+
+    Properties:
+        entries (list) - List of (undo callable, args) 2-tuples in the order
+            the mutations were made
+        copied (dict) - Maps the id of each StateDict to the set of its keys
+            whose values have already been copied for this journal
+        touched (dict) - Maps the id of each StateDict to the set of its keys
+            accessed or modified while this journal was active
+    """
+    def __init__(self):
+        self.entries = []
+        self.copied = {}
+        self.touched = {}
+        self._previous = []
+
+    def __enter__(self):
+        self._previous.append(active())
+        _local.journal = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.journal = self._previous.pop()
+
+    def record(self, undo, *args):
+        """Add an undo callable (and args) to this journal"""
+        self.entries.append((undo, args))
+
+    def savepoint(self):
+        """Returns a marker that can be passed to rollback to only undo
+        mutations made after this call"""
+        return len(self.entries)
+
+    def rollback(self, savepoint=0):
+        """Undo all mutations made since savepoint (defaults to undoing
+        everything recorded by this journal)"""
+        entries = self.entries
+        while len(entries) > savepoint:
+            undo, args = entries.pop()
+            undo(*args)
+
+    def commit(self):
+        """Discard undo information"""
+        del self.entries[:]
+        self.copied.clear()
+        self.touched.clear()
+
+
+class untracked(object):
+    """Context manager suspending the active journal, e.g. while building
+    brand new objects that nothing else refers to yet and that therefore
+    don't need their changes undone"""
+
+    def __enter__(self):
+        self._previous = active()
+        _local.journal = None
+
+    def __exit__(self, *exc_info):
+        _local.journal = self._previous
+
+
+class writing(object):
+    """Context manager marking that this thread is applying transactions to
+    a table's state. Values shared with a fork are only copied when accessed
+    while writing, so threads merely reading a forked state (see
+    CapTable.committed) never modify it."""
+
+    def __enter__(self):
+        self._previous = is_writing()
+        _local.writing = True
+
+    def __exit__(self, *exc_info):
+        _local.writing = self._previous
+
+
+def is_writing():
+    """True if this thread is inside a `writing` block"""
+    return getattr(_local, 'writing', False)
+
+
+def _restore_attr(obj, name, old):
+    if old is MISSING:
+        object.__delattr__(obj, name)
+    else:
+        object.__setattr__(obj, name, old)
+
+
+class Journaled(object):
+    """Mixin for objects whose attribute assignments should be undone if the
+    transaction that made them fails"""
+
+    def __setattr__(self, name, value):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_attr,
+                (self, name, self.__dict__.get(name, MISSING))))
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_attr,
+                (self, name, self.__dict__.get(name, MISSING))))
+        object.__delattr__(self, name)
+
+
+def _restore_key(dict_, key, old):
+    if old is MISSING:
+        dict.pop(dict_, key, None)
+    else:
+        dict.__setitem__(dict_, key, old)
+
+def _restore_dict(dict_, old):
+    dict.clear(dict_)
+    dict.update(dict_, old)
+
+
+class JournaledDict(dict):
+    """A dict whose mutations are undone if the transaction that made them
+    fails"""
+
+    def __setitem__(self, key, value):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_key,
+                (self, key, dict.get(self, key, MISSING))))
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_key,
+                (self, key, dict.__getitem__(self, key))))
+        dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_key, (self, key, value)))
+        return key, value
+
+    def update(self, *args, **kwds):
+        for key, value in dict(*args, **kwds).items():
+            self[key] = value
+
+    def clear(self):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_dict, (self, dict(self))))
+        dict.clear(self)
+
+
+def _pop_list(list_):
+    list.pop(list_)
+
+def _restore_list(list_, old):
+    list.__setitem__(list_, slice(None), old)
+
+
+class JournaledList(list):
+    """A list whose mutations are undone if the transaction that made them
+    fails. Appends (the common case) are cheap to undo -- other mutations
+    may snapshot the entire list.
+    """
+
+    def __getstate__(self):
+        # Leave out the cache of positions kept by ForkedList.index
+        return dict((name, value) for name, value in self.__dict__.items()
+                    if name != '_positions') or None
+
+    def _snapshot(self):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_list, (self, list(self))))
+
+    def append(self, value):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_pop_list, (self,)))
+        list.append(self, value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __setitem__(self, index, value):
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            if isinstance(index, slice):
+                self._snapshot()
+            else:
+                journal.entries.append((list.__setitem__,
+                    (self, index, self[index])))
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._snapshot()
+        list.__delitem__(self, index)
+
+    # Python 2 routes simple slicing through these
+    def __setslice__(self, i, j, values):
+        self._snapshot()
+        list.__setslice__(self, i, j, values)
+
+    def __delslice__(self, i, j):
+        self._snapshot()
+        list.__delslice__(self, i, j)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def insert(self, index, value):
+        self._snapshot()
+        list.insert(self, index, value)
+
+    def pop(self, *args):
+        self._snapshot()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self._snapshot()
+        list.remove(self, value)
+
+    def reverse(self):
+        self._snapshot()
+        list.reverse(self)
+
+    def sort(self, *args, **kwds):
+        self._snapshot()
+        list.sort(self, *args, **kwds)
+
+
+# Values of these types are never mutated in place, so there's no need to
+# copy them before handing them to a transaction
+_ATOMIC = (type(None), bool, int, float, complex, str, bytes, type,
+           datetime.date, datetime.time, datetime.timedelta,
+           Journaled, JournaledDict, JournaledList, Snowflake)
+try:
+    _ATOMIC += (long, unicode)
+except NameError:
+    pass
+
+
+# Values of these types are immutable, so can be shared by forks
+_IMMUTABLE = tuple(t for t in _ATOMIC if not issubclass(
+    t, (Journaled, JournaledDict, JournaledList, Snowflake)))
+
+# Values of these types are copied one level at a time by forked
+_FORKABLE = (Journaled, JournaledDict, JournaledList)
+
+
+def _forkable(value):
+    return isinstance(value, _FORKABLE) and not isinstance(value, Snowflake)
+
+def _any_forkable(values):
+    # Containers usually hold many values of a few types, so check the types
+    # rather than each value
+    return any(issubclass(t, _FORKABLE) and not issubclass(t, Snowflake)
+               for t in set(map(type, values)))
+
+
+def forked(value):
+    """Returns a copy of value for a fork of a table, sharing as much as
+    possible with the original. Snowflakes and immutable values are shared.
+    Journaled objects and containers are copied one level at a time -- their
+    contents are shared unless themselves Journaled. Anything else is
+    deep-copied. Classes can define a __fork__ method to do something else.
+
+    The original should not be modified afterwards, since the copy may share
+    parts of it.
+    """
+    method = getattr(type(value), '__fork__', None)
+    if method is not None:
+        return method(value)
+    if isinstance(value, _IMMUTABLE) or isinstance(value, Snowflake):
+        return value
+
+    if isinstance(value, JournaledDict):
+        ret = type(value).__new__(type(value))
+        dict.update(ret, value)
+        if _any_forkable(dict.values(value)):
+            for key, item in dict.items(value):
+                if _forkable(item):
+                    dict.__setitem__(ret, key, forked(item))
+        ret.__dict__.update(value.__dict__)
+        return ret
+
+    if isinstance(value, JournaledList):
+        ret = type(value).__new__(type(value))
+        list.extend(ret, value)
+        if _any_forkable(value):
+            for index, item in enumerate(value):
+                if _forkable(item):
+                    list.__setitem__(ret, index, forked(item))
+        ret.__dict__.update(value.__dict__)
+        return ret
+
+    if isinstance(value, Journaled):
+        ret = object.__new__(type(value))
+        ret.__dict__.update((name, forked(item))
+                            for name, item in value.__dict__.items())
+        return ret
+
+    return copy.deepcopy(value)
+
+
+# JournaledDicts and JournaledLists with fewer entries than this are simply
+# copied by shared
+SHARE_MIN = 64
+
+
+def shared(value):
+    """Like forked, but large JournaledDicts and JournaledLists are layered
+    over the original (see ForkedDict and ForkedList) rather than copied, so
+    the copy takes constant time and space until modified. Smaller
+    JournaledDicts are copied, sharing any large containers they hold (e.g.
+    the issuances of a class with only a few holders)."""
+    if type(value) is JournaledDict:
+        if dict.__len__(value) >= SHARE_MIN:
+            return ForkedDict(value)
+        ret = JournaledDict()
+        dict.update(ret, value)
+        if _any_forkable(dict.values(value)):
+            for key, item in dict.items(value):
+                if _forkable(item):
+                    dict.__setitem__(ret, key, shared(item))
+        ret.__dict__.update(value.__dict__)
+        return ret
+    if type(value) is JournaledList and list.__len__(value) >= SHARE_MIN \
+            and not _any_forkable(value):
+        return ForkedList(value)
+    return forked(value)
+
+
+def _discard(set_, key, journal):
+    if key in set_:
+        set_.discard(key)
+        if journal is not None:
+            journal.entries.append((set_.add, (key,)))
+
+def _add(set_, key, journal):
+    if key not in set_:
+        set_.add(key)
+        if journal is not None:
+            journal.entries.append((set_.discard, (key,)))
+
+
+class ForkedDict(JournaledDict):
+    """A JournaledDict layered over another (its base), which it shares with
+    a fork. The dict itself only stores what's been set since, and deleted
+    keys are recorded in a set. The base must not be modified afterwards.
+
+    Values read from the base are forked (see shared) the first time they're
+    accessed by key while writing, as with StateDict. Iterating over values or items
+    returns them without copying, so shouldn't be used to modify them.
+
+    Note that Python 2's dict() and dict.update() read the stored entries
+    directly, so copy a ForkedDict via items() instead.
+    """
+    # Forking flattens the layers into a new base once changes exceed this
+    # fraction of the base's entries
+    MAX_CHANGES = 0.125
+
+    def __init__(self, base):
+        dict.__init__(self)
+        self._base = base
+        self._deleted = set()
+
+    # Flattened copy of the layers, made by the first fork needing one and
+    # shared by every later fork
+    _flattened = None
+
+    def __fork__(self):
+        base, deleted = self._base, self._deleted
+        flattened = self._flattened
+        if flattened is None and dict.__len__(self) + len(deleted) > \
+                dict.__len__(base) * self.MAX_CHANGES:
+            flattened = dict(dict.items(base))
+            for key in deleted:
+                del flattened[key]
+            flattened.update(dict.items(self))
+            # The layers themselves are left alone, since other threads may
+            # be reading them through a committed view
+            self._flattened = flattened
+        if flattened is not None:
+            return self._layer(flattened)
+        ret = self._layer(base)
+        ret._deleted = set(deleted)
+        for key, value in dict.items(self):
+            dict.__setitem__(ret, key,
+                             shared(value) if _forkable(value) else value)
+        return ret
+
+    def _layer(self, base):
+        """Returns an empty ForkedDict over base for a fork of this one.
+        Subclasses should override this to return their own type."""
+        return ForkedDict(base)
+
+    def _peek(self, key):
+        """Returns the value under key without forking it"""
+        value = dict.get(self, key, MISSING)
+        if value is MISSING:
+            value = dict.__getitem__(self._base, key)
+        return value
+
+    def __getitem__(self, key):
+        value = dict.get(self, key, MISSING)
+        if value is not MISSING:
+            return value
+        if key in self._deleted:
+            raise KeyError(key)
+        value = dict.__getitem__(self._base, key)
+        if _forkable(value) and getattr(_local, 'writing', False):
+            value = shared(value)
+            JournaledDict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (
+            dict.__contains__(self._base, key) and key not in self._deleted)
+
+    def __setitem__(self, key, value):
+        if self._deleted:
+            _discard(self._deleted, key, getattr(_local, 'journal', None))
+        JournaledDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        in_base = dict.__contains__(self._base, key) and \
+            key not in self._deleted
+        if dict.__contains__(self, key):
+            JournaledDict.__delitem__(self, key)
+        elif not in_base:
+            raise KeyError(key)
+        if in_base:
+            _add(self._deleted, key, getattr(_local, 'journal', None))
+
+    def popitem(self):
+        for key in self:
+            return key, self.pop(key)
+        raise KeyError("popitem(): dictionary is empty")
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def __len__(self):
+        base = self._base
+        return dict.__len__(base) - len(self._deleted) + sum(
+            1 for key in dict.__iter__(self)
+            if not dict.__contains__(base, key))
+
+    def __iter__(self):
+        base, deleted = self._base, self._deleted
+        for key in dict.__iter__(base):
+            if key not in deleted:
+                yield key
+        for key in dict.__iter__(self):
+            if not dict.__contains__(base, key):
+                yield key
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self:
+            yield self._peek(key)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self._peek(key)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.iteritems()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __reduce__(self):
+        # Copies made via pickle or the copy module are plain JournaledDicts
+        return (JournaledDict, (), None, None, self.iteritems())
+
+
+def _restore_layers(list_, base, replaced, own):
+    list_._base, list_._replaced = base, replaced
+    list.__setitem__(list_, slice(None), own)
+
+
+class ForkedList(JournaledList):
+    """A JournaledList layered over another (its base), which it shares with
+    a fork. The list itself only stores entries appended since, and entries
+    of the base replaced since are stored in a dict keyed by index. The base
+    must not be modified afterwards.
+
+    Appending and replacing entries is cheap. Other mutations first copy the
+    base into the list itself.
+    """
+    MAX_CHANGES = ForkedDict.MAX_CHANGES
+
+    def __init__(self, base):
+        list.__init__(self)
+        self._base = base
+        self._replaced = JournaledDict()
+
+    # As for ForkedDict
+    _flattened = None
+
+    def __fork__(self):
+        base, replaced = self._base, self._replaced
+        flattened = self._flattened
+        if flattened is None and list.__len__(self) + len(replaced) > \
+                list.__len__(base) * self.MAX_CHANGES:
+            flattened = self._flattened = JournaledList(self)
+        if flattened is not None:
+            return ForkedList(flattened)
+        ret = ForkedList(base)
+        list.extend(ret, list.__iter__(self))
+        dict.update(ret._replaced, replaced)
+        return ret
+
+    def _flatten(self):
+        """Copy the base into the list itself, e.g. before inserting"""
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((_restore_layers, (
+                self, self._base, self._replaced, list(list.__iter__(self)))))
+        list.__setitem__(self, slice(None), list(self))
+        self._base, self._replaced = JournaledList(), JournaledDict()
+
+    def _offset(self, index):
+        """Returns index counting from the start, or raises an IndexError"""
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError("list index out of range")
+        return index
+
+    def __len__(self):
+        return list.__len__(self._base) + list.__len__(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        index = self._offset(index)
+        size = list.__len__(self._base)
+        if index >= size:
+            return list.__getitem__(self, index - size)
+        value = dict.get(self._replaced, index, MISSING)
+        if value is MISSING:
+            value = list.__getitem__(self._base, index)
+        return value
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._flatten()
+            return JournaledList.__setitem__(self, index, value)
+        index = self._offset(index)
+        size = list.__len__(self._base)
+        if index >= size:
+            index -= size
+            journal = getattr(_local, 'journal', None)
+            if journal is not None:
+                journal.entries.append((list.__setitem__,
+                    (self, index, list.__getitem__(self, index))))
+            list.__setitem__(self, index, value)
+        else:
+            self._replaced[index] = value
+
+    def __iter__(self):
+        replaced = self._replaced
+        if replaced:
+            base = (dict.get(replaced, index, value) for index, value in
+                    enumerate(list.__iter__(self._base)))
+        else:
+            base = list.__iter__(self._base)
+        return itertools.chain(base, list.__iter__(self))
+
+    def __reversed__(self):
+        return reversed(list(self))
+
+    def __contains__(self, value):
+        return any(item is value or item == value for item in self)
+
+    def index(self, value):
+        """Returns the index of value. Entries of the base are looked up by
+        identity first, via a dict cached on the base (so shared by every
+        fork of it), and then compared as with list.index."""
+        base = self._base
+        positions = base.__dict__.get('_positions')
+        if positions is None:
+            positions = base._positions = dict(
+                zip(map(id, base), itertools.count()))
+        index = positions.get(id(value))
+        if index is not None and self[index] is value:
+            return index
+        for index, item in enumerate(self):
+            if item is value or item == value:
+                return index
+        raise ValueError("%r is not in list" % (value,))
+
+    def count(self, value):
+        return sum(1 for item in self if item is value or item == value)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __reduce__(self):
+        return (JournaledList, (), None, iter(self))
+
+    def __delitem__(self, index):
+        self._flatten()
+        JournaledList.__delitem__(self, index)
+
+    def __setslice__(self, i, j, values):
+        self._flatten()
+        JournaledList.__setslice__(self, i, j, values)
+
+    def __delslice__(self, i, j):
+        self._flatten()
+        JournaledList.__delslice__(self, i, j)
+
+    def __getslice__(self, i, j):
+        return list(self)[i:j]
+
+    def insert(self, index, value):
+        self._flatten()
+        JournaledList.insert(self, index, value)
+
+    def pop(self, *args):
+        if args or not list.__len__(self):
+            self._flatten()
+            return JournaledList.pop(self, *args)
+        value = list.pop(self)
+        journal = getattr(_local, 'journal', None)
+        if journal is not None:
+            journal.entries.append((list.append, (self, value)))
+        return value
+
+    def remove(self, value):
+        self._flatten()
+        JournaledList.remove(self, value)
+
+    def reverse(self):
+        self._flatten()
+        JournaledList.reverse(self)
+
+    def sort(self, *args, **kwds):
+        self._flatten()
+        JournaledList.sort(self, *args, **kwds)
+
+
+def _uncopy(dict_, key, old, copied):
+    copied.discard(key)
+    _restore_key(dict_, key, old)
+
+def _reshare(dict_, key, old, copied):
+    copied.discard(key)
+    dict.__setitem__(dict_, key, old)
+    dict_._shared.add(key)
+
+
+class StateDict(JournaledDict):
+    """The top-level state dict of a CapTable. Values that do not track their
+    own mutations (e.g. a plain list) are copied the first time they are
+    accessed by key while a journal is active, so that changes to them can be
+    discarded on rollback. Transactions should access state by key (rather
+    than by iterating over values) to benefit from this.
+
+    Keys accessed while a journal is active are recorded in the journal's
+    touched dict so validators can limit themselves to what may have changed.
+
+    After forking, values are shared with the fork until accessed by key
+    while transactions are being applied (see `writing`), whether or not a
+    journal is active. Each is then replaced with a forked copy, which is
+    what gets returned. Reading outside of that returns the shared value.
+    """
+    # Keys whose values are shared with a fork, if any
+    _shared = None
+
+    def __fork__(self):
+        """Returns a StateDict sharing this one's values"""
+        ret = StateDict()
+        dict.update(ret, self)
+        ret._shared = set(dict.keys(self))
+        self._shared = set(ret._shared)
+        return ret
+
+    def __getstate__(self):
+        # Copies made via pickle or the copy module share nothing
+        return {}
+
+    def _unshare(self, key, value, journal):
+        """Replace a value shared with a fork with a copy of its own"""
+        new_value = forked(value)
+        dict.__setitem__(self, key, new_value)
+        self._shared.discard(key)
+        if journal is not None:
+            copied = journal.copied.setdefault(id(self), set())
+            copied.add(key)
+            journal.entries.append((_reshare, (self, key, value, copied)))
+        return new_value
+
+    def _owned(self, key, value):
+        """Returns a version of value under key that is safe to mutate"""
+        journal = getattr(_local, 'journal', None)
+        shared = self._shared
+        if shared and key in shared and getattr(_local, 'writing', False):
+            value = self._unshare(key, value, journal)
+        if journal is None:
+            return value
+        journal.touched.setdefault(id(self), set()).add(key)
+        if isinstance(value, _ATOMIC):
+            return value
+        copied = journal.copied.setdefault(id(self), set())
+        if key in copied:
+            return value
+        new_value = copy.deepcopy(value)
+        dict.__setitem__(self, key, new_value)
+        copied.add(key)
+        journal.entries.append((_uncopy, (self, key, value, copied)))
+        return new_value
+
+    def _unmark(self, key, journal):
+        """Stop treating the value under key as shared, e.g. after replacing
+        it"""
+        shared = self._shared
+        if shared and key in shared:
+            shared.discard(key)
+            if journal is not None:
+                journal.entries.append((shared.add, (key,)))
+
+    def __getitem__(self, key):
+        return self._owned(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        JournaledDict.__setitem__(self, key, value)
+
+        journal = getattr(_local, 'journal', None)
+        self._unmark(key, journal)
+        if journal is not None:
+            journal.touched.setdefault(id(self), set()).add(key)
+
+            # Newly set values are already owned by the current transaction
+            if not isinstance(value, _ATOMIC):
+                copied = journal.copied.setdefault(id(self), set())
+                if key not in copied:
+                    copied.add(key)
+                    journal.entries.append((copied.discard, (key,)))
+
+    def __delitem__(self, key):
+        JournaledDict.__delitem__(self, key)
+        journal = getattr(_local, 'journal', None)
+        self._unmark(key, journal)
+        if journal is not None:
+            journal.touched.setdefault(id(self), set()).add(key)
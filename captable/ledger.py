@@ -0,0 +1,323 @@
+"""Transaction history kept in a file rather than in memory.
+
+A table's transactions attribute normally holds every entry ever recorded.
+A table created with a Ledger instead appends each entry to the ledger's
+file, and only keeps the most recent entries (the window) in memory, along
+with where each segment of entries starts in the file. Older entries are
+read back one segment at a time when needed, e.g. by as_of or insert, so
+memory use doesn't grow with the length of the history beyond a few bytes
+per segment.
+
+    table = CapTable(ledger=Ledger("table.ledger"))
+    table.record_many(read_events())    # e.g. a generator
+
+    # Later, e.g. after a restart, replays the ledger to rebuild the state
+    table = CapTable(ledger=Ledger("table.ledger"))
+
+The file uses the same format as a TransactionLog (see captable.persistence)
+but only holds entries in the order of the table's transactions, so
+inserting an entry into the past rewrites the file. As with a log, every
+transaction must be picklable, and Persons (and other Snowflakes) are read
+back as the same objects every time.
+"""
+from __future__ import absolute_import
+
+import bisect
+import collections
+import itertools
+import os
+import weakref
+
+from .persistence import TransactionLog
+from .table import History, RECORD
+
+
+class Ledger(object):
+    """A list of a table's transactions stored in a file. Supports the same
+    operations as the History a table uses by default: len, indexing,
+    slicing (which returns a list), iteration, comparison, append and insert.
+
+    Args:
+        path (str) - Path to the ledger file. Created if it doesn't exist.
+        window (int) - Number of the most recent entries kept in memory
+        segment_size (int) - Number of entries read from the file at a time
+
+    Properties:
+        path, window, segment_size - As above
+        datetimes - Read-only sequence of the datetime of each entry
+
+    An existing file is read when the ledger is first used, or by replay.
+    """
+    def __init__(self, path, window=1000, segment_size=1000):
+        self.path = path
+        self.window = window
+        self.segment_size = segment_size
+        self.datetimes = Datetimes(self)
+
+        # Forks (see fork) reading entries from the file, which must be
+        # read into memory before it's rewritten
+        self._views = weakref.WeakSet()
+        self._load(TransactionLog(path))
+
+    def _load(self, log):
+        """Start over with the entries in log's file, which are read by
+        _read (or replay)"""
+        self._log = log
+        self._length = 0
+        self._offsets = []
+        self._firsts = []
+        self._recent = collections.deque(maxlen=self.window)
+        self._cached = (None, [])
+        self._reader = self._scan(log)
+
+    def _scan(self, log):
+        """Yields the entries in log's file, finding where each segment
+        starts as it goes"""
+        start = 0
+        for _, entry in log.read():
+            self._add(start, entry)
+            start = log.tell()
+            yield entry
+        self._reader = None
+
+    def _read(self):
+        """Finish reading the file, if not done yet"""
+        if self._reader is not None:
+            for _ in self._reader:
+                pass
+
+    def replay(self):
+        """Returns an iterator over the entries, for rebuilding a table's
+        state (see CapTable). If the file hasn't been read yet, reading it
+        is left to the iterator, so each entry is only unpickled once. The
+        ledger shouldn't be used otherwise until the iterator is done."""
+        if self._reader is not None:
+            return self._reader
+        return self.iterate()
+
+    def _add(self, offset, entry):
+        if not self._length % self.segment_size:
+            self._offsets.append(offset)
+            self._firsts.append(entry[0])
+        self._length += 1
+        self._recent.append(entry)
+
+    def __len__(self):
+        self._read()
+        return self._length
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, start=0, stop=None):
+        """Yields the entries from index start up to stop, reading older
+        ones from the file a segment at a time"""
+        self._read()
+        stop = self._length if stop is None else min(stop, self._length)
+        recent = self._length - len(self._recent)
+        if start < min(stop, recent):
+            segment = start // self.segment_size
+            skip = start - segment * self.segment_size
+            count = min(stop, recent) - start
+            entries = self._log.scan(self._offsets[segment])
+            try:
+                for _, entry, _ in itertools.islice(entries, skip,
+                                                     skip + count):
+                    yield entry
+            finally:
+                entries.close()
+        for entry in itertools.islice(self._recent, max(start - recent, 0),
+                                      max(stop - recent, 0)):
+            yield entry
+
+    def _segment(self, segment):
+        """Returns the list of entries in a segment, keeping the last one
+        read in memory"""
+        cached, entries = self._cached
+        start = segment * self.segment_size
+        if cached != segment or \
+                len(entries) < min(self.segment_size, self._length - start):
+            entries = list(self.iterate(start, start + self.segment_size))
+            self._cached = (segment, entries)
+        return entries
+
+    def __getitem__(self, index):
+        self._read()
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return list(self)[index]
+            return list(self.iterate(start, stop))
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Ledger index out of range")
+        recent = self._length - len(self._recent)
+        if index >= recent:
+            return self._recent[index - recent]
+        segment, offset = divmod(index, self.segment_size)
+        return self._segment(segment)[offset]
+
+    def bisect_right(self, datetime_):
+        """Returns the number of entries at or before datetime_, reading at
+        most one segment"""
+        self._read()
+        segment = bisect.bisect_right(self._firsts, datetime_) - 1
+        if segment < 0:
+            return 0
+        entries = self._segment(segment)
+        return segment * self.segment_size + bisect.bisect_right(
+            [entry[0] for entry in entries], datetime_)
+
+    def encode(self, entry):
+        """Returns the bytes storing entry, for append. As with
+        TransactionLog.encode, call discard instead if the entry is
+        abandoned."""
+        return self._log.encode(RECORD, entry[0], entry[1:])
+
+    def discard(self):
+        """Forget Snowflakes encoded since the last append"""
+        self._log.discard()
+
+    def append(self, entry, data=None):
+        """Append entry to the file. data is what encode returned for it, if
+        already encoded."""
+        self._read()
+        log = self._log
+        if data is None:
+            data = self.encode(entry)
+        offset = log.tell()
+        log.write(data)
+        self._add(offset, entry)
+
+    def insert(self, index, entry):
+        """Insert entry before index, rewriting the file"""
+        self._read()
+        for view in list(self._views):
+            view.materialize()
+
+        path = self.path + ".tmp"
+        if os.path.exists(path):
+            os.remove(path)
+        log = TransactionLog(path)
+        entries = itertools.chain(self.iterate(0, index), [entry],
+                                  self.iterate(index))
+        while True:
+            chunk = list(itertools.islice(entries, self.segment_size))
+            if not chunk:
+                break
+            log.write([log.encode(RECORD, item[0], item[1:])
+                       for item in chunk])
+        log.close()
+        self._log.close()
+        getattr(os, "replace", os.rename)(path, self.path)
+        log.path = self.path
+        self._load(log)
+        self._read()
+
+    def fork(self):
+        """Returns a History (see CapTable.fork) with the same entries, which
+        reads them from this ledger's file"""
+        return History.of(self._view())
+
+    def _view(self, datetimes=False):
+        self._read()
+        view = _View(self, self._length, datetimes)
+        self._views.add(view)
+        return view
+
+    def close(self):
+        """Close the file. It will be reopened on the next append."""
+        self._log.close()
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Ledger %s: %s entries>" % (self.path, len(self))
+
+
+class Datetimes(object):
+    """Read-only sequence of the datetimes of a Ledger's entries. Appending
+    and inserting do nothing, since the ledger keeps them in step."""
+
+    def __init__(self, ledger):
+        self._ledger = ledger
+
+    def __len__(self):
+        return len(self._ledger)
+
+    def __iter__(self):
+        return (entry[0] for entry in self._ledger)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [entry[0] for entry in self._ledger[index]]
+        return self._ledger[index][0]
+
+    def bisect_right(self, datetime_):
+        return self._ledger.bisect_right(datetime_)
+
+    def append(self, datetime_):
+        pass
+
+    def insert(self, index, datetime_):
+        pass
+
+    def fork(self):
+        return History.of(self._ledger._view(datetimes=True))
+
+
+class _View(object):
+    """Read-only sequence of the first length entries of a ledger (or their
+    datetimes), read from the ledger until it's rewritten"""
+
+    def __init__(self, ledger, length, datetimes):
+        self._ledger = ledger
+        self._length = length
+        self._datetimes = datetimes
+        self._entries = None
+
+    def materialize(self):
+        """Read the entries into memory"""
+        if self._entries is None:
+            self._entries = list(self.iterate())
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, start=0, stop=None):
+        stop = self._length if stop is None else min(stop, self._length)
+        if self._entries is not None:
+            return iter(self._entries[start:stop])
+        entries = self._ledger.iterate(start, stop)
+        if self._datetimes:
+            return (entry[0] for entry in entries)
+        return entries
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return list(self)[index]
+            return list(self.iterate(start, stop))
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Ledger index out of range")
+        if self._entries is not None:
+            return self._entries[index]
+        entry = self._ledger[index]
+        return entry[0] if self._datetimes else entry
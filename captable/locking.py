@@ -0,0 +1,96 @@
+"""Locks for recording on a CapTable from several threads at once.
+
+A TableLock is held exclusively by a thread doing anything that may touch
+the whole table (e.g. recording a transaction that isn't known to only
+touch particular classes of securities, or forking), or shared by threads
+recording transactions on separate classes, which also hold a lock for each
+class they touch (see CapTable.record).
+"""
+from __future__ import absolute_import
+
+import threading
+
+
+class TableLock(object):
+    """A lock that is either held exclusively by one thread or shared by any
+    number of them. Use as a context manager to hold it exclusively, or via
+    shared(). Threads waiting for exclusive access keep new threads from
+    sharing it, so they aren't starved.
+
+    The thread holding the lock exclusively can acquire it again either way,
+    e.g. record_many calling record.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._sharing = 0
+        self._waiting = 0
+
+    def acquire(self):
+        """Wait for exclusive access"""
+        me = threading.current_thread()
+        with self._condition:
+            if self._owner is me:
+                self._depth += 1
+                return
+            self._waiting += 1
+            try:
+                while self._owner is not None or self._sharing:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._condition:
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire_shared(self):
+        """Wait until no thread has or wants exclusive access, then share
+        the lock"""
+        me = threading.current_thread()
+        with self._condition:
+            if self._owner is me:
+                self._depth += 1
+                return
+            while self._owner is not None or self._waiting:
+                self._condition.wait()
+            self._sharing += 1
+
+    def release_shared(self):
+        with self._condition:
+            if self._owner is threading.current_thread():
+                self._depth -= 1
+                return
+            self._sharing -= 1
+            if not self._sharing:
+                self._condition.notify_all()
+
+    def shared(self):
+        """Returns a context manager sharing the lock"""
+        return _Shared(self)
+
+
+class _Shared(object):
+    def __init__(self, lock):
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire_shared()
+        return self._lock
+
+    def __exit__(self, *exc_info):
+        self._lock.release_shared()
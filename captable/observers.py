@@ -0,0 +1,153 @@
+"""Instrumentation for CapTable recording.
+
+An observer is any callable passed to CapTable as `observer`. It's called with
+an Event for each phase of recording a transaction:
+
+    txn - Calling one transaction callable
+    validator - Calling one validator
+    rollback - Undoing the changes of a failed transaction
+    commit - Discarding the undo journal, writing the log and checkpointing
+    record - The entire record call (or each batch of record_many in deferred
+        mode), with counters describing the size of the change
+
+With no observer (the default), nothing is timed. The Aggregator observer
+collects the events into histograms.
+"""
+from __future__ import absolute_import
+
+import math
+import time
+import timeit
+
+from .transactions import Transaction
+
+try:
+    _cpu_time = time.process_time
+except AttributeError: # Python 2
+    _cpu_time = time.clock
+
+
+def txn_name(txn):
+    """Returns a name for a transaction (or validator) callable to report
+    events under"""
+    if isinstance(txn, Transaction):
+        return "%s.%s" % (txn.security.__name__, txn.name)
+    return getattr(txn, "__name__", txn.__class__.__name__)
+
+
+class Event(object):
+    """Something that happened while recording
+
+    Properties:
+        kind (str) - What phase of recording this event is for, see above
+        name (str) - Name of the transaction or validator, if applicable
+        wall (float) - Elapsed seconds
+        cpu (float) - CPU seconds used by this process
+        counters (dict) - Other measurements, e.g. journal_entries (number
+            of undo records), copied (number of state values copied on first
+            access), state_keys (number of top-level state keys), failed
+            (True if the transaction failed)
+    """
+    __slots__ = ("kind", "name", "wall", "cpu", "counters")
+
+    def __init__(self, kind, name, wall, cpu, counters=None):
+        self.kind = kind
+        self.name = name
+        self.wall = wall
+        self.cpu = cpu
+        self.counters = counters or {}
+
+    def __repr__(self):
+        return "Event(%r, %r, wall=%.6f, cpu=%.6f, %r)" % (
+            self.kind, self.name, self.wall, self.cpu, self.counters)
+
+
+class Timer(object):
+    """Measures wall and CPU time from when it's created"""
+    __slots__ = ("wall", "cpu")
+
+    def __init__(self):
+        self.wall = timeit.default_timer()
+        self.cpu = _cpu_time()
+
+    def event(self, kind, name=None, **counters):
+        """Returns an Event for the time elapsed so far"""
+        return Event(kind, name, timeit.default_timer() - self.wall,
+                     _cpu_time() - self.cpu, counters)
+
+
+class Histogram(object):
+    """Summary of the events of one kind and name. Wall times are counted
+    in buckets by power of two microseconds.
+
+    Properties:
+        count (int) - Number of events
+        wall, cpu (float) - Total seconds
+        max (float) - Longest wall time
+        buckets (dict) - Maps n to the number of events taking less than
+            2 ** n microseconds (and at least 2 ** (n - 1))
+        counters (dict) - Totals of each counter
+    """
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max = 0.0
+        self.buckets = {}
+        self.counters = {}
+
+    def add(self, event):
+        self.count += 1
+        self.wall += event.wall
+        self.cpu += event.cpu
+        self.max = max(self.max, event.wall)
+        micros = event.wall * 1e6
+        bucket = int(math.floor(math.log(micros, 2))) + 1 if micros >= 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        for name, value in event.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def percentile(self, fraction):
+        """Returns an upper bound on the wall time, in seconds, of the given
+        fraction (e.g. 0.99) of events"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+
+class Aggregator(object):
+    """Observer collecting events into a Histogram for each kind and name
+
+    Properties:
+        histograms (dict) - Maps (kind, name) 2-tuples to Histograms
+    """
+    def __init__(self):
+        self.histograms = {}
+
+    def __call__(self, event):
+        key = (event.kind, event.name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(event)
+
+    def count(self, kind, name=None):
+        """Number of events of a kind (and name)"""
+        histogram = self.histograms.get((kind, name))
+        return histogram.count if histogram else 0
+
+    def report(self):
+        """Returns a table of timings, in microseconds, as a string"""
+        lines = ["%-10s %-30s %8s %10s %10s %10s %10s %10s" % (
+            "kind", "name", "count", "mean", "cpu mean", "p50", "p99", "max")]
+        for (kind, name), h in sorted(self.histograms.items(),
+                                      key=lambda item: (item[0][0],
+                                                        item[0][1] or "")):
+            lines.append("%-10s %-30s %8d %10.1f %10.1f %10.1f %10.1f %10.1f"
+                         % (kind, name or "", h.count, h.wall / h.count * 1e6,
+                            h.cpu / h.count * 1e6, h.percentile(0.5) * 1e6,
+                            h.percentile(0.99) * 1e6, h.max * 1e6))
+        return "\n".join(lines)
@@ -0,0 +1,127 @@
+"""Ownership reports -- how many shares of stock each holder owns and what
+percentage of the company that represents.
+
+Reports are built from the per-holder share totals each Stock MetaState
+maintains, so their cost scales with the number of holders rather than the
+number of issuances. Shares of each class are weighted by the class's
+CONVERSION_RATIO when computing percentages.
+
+Percentages are computed two ways:
+
+    basic - Out of all outstanding shares
+    fully diluted - Out of all outstanding shares plus shares reserved for
+        later issuance (e.g. an option pool)
+"""
+from __future__ import absolute_import
+
+
+from .securities import Security
+
+
+class Ownership(object):
+    """Ownership of a table's stock at a point in time. Holders may be
+    grouped (see report), in which case each key is a group rather than a
+    Person.
+
+    Properties:
+        datetime (datetime) - Datetime of the state reported on
+        shares (dict) - Maps each key to a dict mapping the name of each class
+            of stock to the number of outstanding shares held
+        ratios (dict) - Maps the name of each class of stock to its
+            conversion ratio
+        outstanding (number) - As-converted outstanding shares
+        fully_diluted (number) - As-converted outstanding and reserved shares
+    """
+    def __init__(self, datetime_, shares, ratios, outstanding, fully_diluted):
+        self.datetime = datetime_
+        self.shares = shares
+        self.ratios = ratios
+        self.outstanding = outstanding
+        self.fully_diluted = fully_diluted
+
+    def as_converted(self, key):
+        """Number of as-converted shares held by key"""
+        ratios = self.ratios
+        return sum(amount * ratios[name]
+                   for name, amount in self.shares.get(key, {}).items())
+
+    def percentage(self, key):
+        """Basic ownership of key, as a fraction of 1"""
+        if not self.outstanding:
+            return 0.0
+        return self.as_converted(key) / float(self.outstanding)
+
+    def fully_diluted_percentage(self, key):
+        """Fully diluted ownership of key, as a fraction of 1"""
+        if not self.fully_diluted:
+            return 0.0
+        return self.as_converted(key) / float(self.fully_diluted)
+
+    def rows(self):
+        """Returns a list of (key, as-converted shares, basic percentage, fully
+        diluted percentage) 4-tuples, largest holding first"""
+        ret = [(key, self.as_converted(key), self.percentage(key),
+                self.fully_diluted_percentage(key)) for key in self.shares]
+        ret.sort(key=lambda row: -row[1])
+        return ret
+
+
+def report(view, by=None):
+    """Returns an Ownership for a CapTable or TableView (e.g. as returned by
+    as_of)
+
+    Args:
+        view (TableView) - The table to report on
+        by (callable) - If provided, holders are grouped by the value this
+            returns for each. E.g. pass `type` to group into NaturalPersons and
+            Entities.
+    """
+    shares = {}
+    ratios = {}
+    outstanding = fully_diluted = 0
+    for name, metastate in view.state.get(Security.STATE_KEY, {}).items():
+        amounts = getattr(metastate, "holder_amounts", None)
+        if amounts is None:
+            continue
+
+        ratio = ratios[name] = metastate.CONVERSION_RATIO
+        outstanding += metastate.outstanding * ratio
+        fully_diluted += (metastate.outstanding + metastate.reserved) * ratio
+        for holder, amount in amounts.items():
+            key = holder if by is None else by(holder)
+            held = shares.get(key)
+            if held is None:
+                held = shares[key] = {}
+            held[name] = held.get(name, 0) + amount
+    return Ownership(view.datetime, shares, ratios, outstanding,
+                     fully_diluted)
+
+
+def reports(table, datetimes, by=None):
+    """Returns a list with an Ownership for each datetime, as of that
+    datetime. Rather than rebuilding the state for each datetime, the state
+    for the earliest is rebuilt once and transactions are replayed forward
+    from there.
+
+    Args:
+        table (CapTable) - The table to report on
+        datetimes (list) - Datetimes to report as of, in any order
+        by (callable) - As for report
+    """
+    if not datetimes:
+        return []
+    order = sorted(range(len(datetimes)), key=lambda i: datetimes[i])
+    ret = [None] * len(datetimes)
+
+    view = table.as_of(datetimes[order[0]])
+    replay = table.__class__(validators=[], checkpoint_interval=None)
+    replay.state = view.state
+    position = table._count_at(datetimes[order[0]])
+    for i in order:
+        count = table._count_at(datetimes[i])
+        for entry in table.transactions.iterate(position, count):
+            replay.state = replay._apply(entry[0], entry[1:])
+            view.state, view._datetime = replay.state, entry[0]
+        position = count
+        ret[i] = report(view, by)
+    return ret
@@ -0,0 +1,296 @@
+"""Append-only on-disk log of a CapTable's transactions.
+
+A CapTable created with a TransactionLog (see `load`) appends each entry to
+the log file as it's committed. The file is a series of pickles, one per
+record:
+
+    ("record", datetime, txns) - An entry recorded via record or record_many
+    ("insert", datetime, txns) - An entry recorded via insert
+    ("define", pid, state) - The __dict__ of a Snowflake (e.g. a Person)
+
+Snowflakes are compared by identity, so rather than being pickled anew with
+every entry that refers to them, each one is defined once and referred to by
+a persistent id thereafter. Loading the log therefore gives back a single
+object for each Person no matter how many entries refer to them.
+
+Transactions must be picklable, e.g. the Transaction instances returned by
+Security class methods for module-level Security classes.
+"""
+from __future__ import absolute_import
+
+import io
+import itertools
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .mixins import Snowflake
+from .table import CapTable, INSERT
+
+# Protocol 2 is the newest one readable by both Python 2 and 3
+PROTOCOL = 2
+
+DEFINE = "define"
+
+# Read buffer size used when loading a log
+BUFFER_SIZE = 1 << 20
+
+
+class TransactionLog(object):
+    """Writes entries to (and reads them back from) a log file. Entries are
+    encoded while the transaction that produced them can still be rolled
+    back, then written once it commits.
+
+    Args:
+        path (str) - Path to the log file. Created on first write if it does
+            not exist.
+
+    Properties:
+        path (str) - As above
+    """
+    def __init__(self, path):
+        self.path = path
+
+        # Maps the id of each Snowflake defined in the log to its persistent
+        # id, and each persistent id to its Snowflake (which also keeps the
+        # Snowflake alive so its id is not reused)
+        self._pids = {}
+        self._objects = {}
+
+        # Persistent ids of the Snowflakes whose state has been written or
+        # read, so reading part of the log again doesn't overwrite them
+        self._defined = set()
+
+        # Persistent ids are (number, class) 2-tuples. This is the next number.
+        self._next = 0
+
+        # Snowflakes encoded since the last write, as (object, pid) 2-tuples
+        self._pending = []
+        self._pending_pids = {}
+
+        # Offset just past the last complete record read, if any
+        self._end = None
+
+        self._file = None
+        self._buffer = io.BytesIO()
+        self._pickler = pickle.Pickler(self._buffer, PROTOCOL)
+        self._pickler.persistent_id = self._persistent_id
+
+    def _persistent_id(self, obj):
+        if not isinstance(obj, Snowflake):
+            return None
+        key = id(obj)
+        pid = self._pids.get(key) or self._pending_pids.get(key)
+        if pid is None:
+            # The class is part of the id so an object can be created as
+            # soon as any record refers to it
+            pid = (self._next + len(self._pending), obj.__class__)
+            self._pending_pids[key] = pid
+            self._pending.append((obj, pid))
+        return pid
+
+    def _open(self):
+        """Opens the log file for appending if not already open"""
+        if self._file is not None:
+            return
+        if self._end is None and os.path.exists(self.path) and \
+                os.path.getsize(self.path):
+            raise ValueError("Log %s must be read before appending to it "
+                             "(see captable.persistence.load)" % self.path)
+        self._file = io.open(self.path, "ab")
+        if self._end is not None:
+            # Drop any incomplete record left by an interrupted write
+            self._file.truncate(self._end)
+
+    def _dump(self, record):
+        # Each record is pickled independently. Sharing the memo would make
+        # records smaller, but a mutable object logged twice would be read
+        # back as it was the first time.
+        self._pickler.clear_memo()
+        self._pickler.dump(record)
+
+    def encode(self, kind, datetime_, txns):
+        """Returns the bytes logging an entry. Snowflakes first seen in the
+        entry are defined along with it, but only become part of the log once
+        written -- call discard instead if the entry is abandoned.
+
+        Args:
+            kind (str) - RECORD or INSERT
+            datetime_ (datetime) - Datetime of the entry
+            txns (tuple) - Transactions in the entry
+        """
+        self._open()
+        buffer = self._buffer
+        buffer.seek(0)
+        buffer.truncate()
+        start = len(self._pending)
+        try:
+            self._dump((kind, datetime_, tuple(txns)))
+            entry = buffer.getvalue()
+
+            # Definitions go first. Defining an object may refer to yet more
+            # objects, which get appended to the list as we go.
+            buffer.seek(0)
+            buffer.truncate()
+            index = start
+            while index < len(self._pending):
+                obj, pid = self._pending[index]
+                self._dump((DEFINE, pid, obj.__dict__))
+                index += 1
+        except Exception:
+            for obj, pid in self._pending[start:]:
+                del self._pending_pids[id(obj)]
+            del self._pending[start:]
+            raise
+        return buffer.getvalue() + entry
+
+    def discard(self):
+        """Forget Snowflakes encoded since the last write"""
+        del self._pending[:]
+        self._pending_pids.clear()
+
+    def write(self, data):
+        """Append encoded entries (a byte string or list of byte strings) to
+        the log file and flush it"""
+        self._open()
+        if isinstance(data, bytes):
+            data = [data]
+        for chunk in data:
+            self._file.write(chunk)
+        self._file.flush()
+
+        for obj, pid in self._pending:
+            self.adopt(pid, obj)
+        self.discard()
+
+    def close(self):
+        """Close the log file. It will be reopened on the next write."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def tell(self):
+        """Returns the offset just past the last entry read or written"""
+        if self._file is not None:
+            return self._file.tell()
+        return self._end or 0
+
+    def objects(self):
+        """Returns a list of (persistent id, Snowflake) 2-tuples for each
+        Snowflake defined in the log so far"""
+        return list(self._objects.items())
+
+    def adopt(self, pid, obj):
+        """Use obj for the Snowflake with the given persistent id, e.g. when
+        skipping the start of the log in favor of a snapshot"""
+        self._register(pid, obj)
+        self._defined.add(pid)
+
+    def _register(self, pid, obj):
+        self._objects[pid] = obj
+        self._pids[id(obj)] = pid
+        self._next = max(self._next, pid[0] + 1)
+
+    def _persistent_load(self, pid):
+        obj = self._objects.get(pid)
+        if obj is None:
+            # Not defined yet, e.g. referred to by another Snowflake being
+            # defined, so create it now and fill it in when defined
+            cls = pid[1]
+            obj = cls.__new__(cls)
+            self._register(pid, obj)
+        return obj
+
+    def read(self, offset=0):
+        """Yields a (kind, entry) 2-tuple for each entry in the log file,
+        where entry is a datetime followed by the entry's transactions.
+        Stops at the end of the file, or at an incomplete last record.
+
+        Args:
+            offset (int) - Where to start reading, e.g. as returned by tell
+        """
+        for kind, entry, _ in self._read(offset, True):
+            yield kind, entry
+
+    def scan(self, offset=0):
+        """Like read, but yields (kind, entry, end) 3-tuples where end is the
+        offset just past the entry, and doesn't change where the next entry
+        is written. Use to read part of the log again."""
+        return self._read(offset, False)
+
+    def _read(self, offset, resume):
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, "rb", buffering=BUFFER_SIZE) as file_:
+            file_.seek(offset)
+            unpickler = pickle.Unpickler(file_)
+            unpickler.persistent_load = self._persistent_load
+            if resume:
+                self._end = offset
+            while True:
+                try:
+                    record = unpickler.load()
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError):
+                    # Treat a truncated record as the end of the log
+                    if file_.read(1):
+                        raise
+                    break
+                end = file_.tell()
+                if resume:
+                    self._end = end
+
+                kind = record[0]
+                if kind == DEFINE:
+                    pid = record[1]
+                    if pid not in self._defined:
+                        self._persistent_load(pid).__dict__.update(record[2])
+                        self._defined.add(pid)
+                else:
+                    yield kind, (record[1],) + tuple(record[2]), end
+
+
+def load(path, snapshot=None, **kwds):
+    """Returns a CapTable with the entries in the log file at path replayed,
+    which then continues appending to that log.
+
+    Entries were validated when first recorded, so they are replayed without
+    the undo journal and validators are only run once, on the final state.
+    Raises if any entry fails to replay.
+
+    Args:
+        path (str) - Path to the log file. If it doesn't exist, returns an
+            empty table that will create it.
+        snapshot (str) - Path to a snapshot saved from a table using this
+            log. If provided, the table starts from the snapshot and only
+            entries logged after it was saved are replayed.
+        kwds - Passed to the CapTable constructor
+    """
+    log = TransactionLog(path)
+    if snapshot is None:
+        table = CapTable(**kwds)
+        offset = 0
+    else:
+        table = CapTable.load_snapshot(snapshot, **kwds)
+        offset = table._snapshot.log_offset
+        if offset is None:
+            raise ValueError("Snapshot %s was saved from a table without a "
+                             "log" % snapshot)
+        for obj, pid in table._snapshot.log_pids:
+            log.adopt(pid, obj)
+
+    for kind, group in itertools.groupby(log.read(offset),
+                                         key=lambda r: r[0]):
+        entries = (entry for _, entry in group)
+        if kind == INSERT:
+            for entry in entries:
+                table.insert(*entry)
+        else:
+            table._replay(entries)
+    table._validate(table.state)
+    table.log = log
+    return table
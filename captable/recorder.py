@@ -0,0 +1,194 @@
+"""Recording transactions submitted from asyncio coroutines (Python 3 only).
+
+An AsyncRecorder collects submissions from any number of coroutines and
+records them on a table in batches, so the table goes through one journal
+commit and validation cycle per batch rather than one per submission:
+
+    recorder = AsyncRecorder(table)
+
+    async def handle(request):
+        await recorder.submit(request.datetime, CommonStock.issue(...))
+
+Submissions waiting to be recorded are sorted by datetime, and each caller
+gets a future that resolves once its submission is recorded, or raises the
+exception that made it roll back. A failed submission doesn't affect others
+in the same batch.
+
+By default, batches are recorded on the event loop's thread, so coroutines
+can read the table in between batches without locking, but nothing else runs
+on the loop while a batch records. With threaded=True, batches are recorded
+in an executor instead (one at a time, in order) and the loop carries on.
+Coroutines should then read the table through a view (see
+CapTable.committed), as with any table recorded on by another thread.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import datetime
+import functools
+import heapq
+import itertools
+
+from .table import RecordError
+
+
+class AsyncRecorder(object):
+    """Records (datetime, txns) submissions from coroutines on a table in
+    batches. See the module docstring.
+
+    Args:
+        table (CapTable) - The table to record on
+        batch_size (int) - Most submissions recorded in a single batch
+        delay (float) - Seconds to wait after a submission before recording,
+            to collect more submissions into the batch. By default, batches
+            are recorded as soon as the coroutines ready to run have had a
+            chance to submit.
+        loop - Event loop to use. Defaults to the current event loop when
+            first needed.
+        threaded (bool) - If True, record batches in executor rather than
+            on the event loop's thread
+        executor - concurrent.futures Executor to record batches in if
+            threaded. Defaults to the loop's default executor.
+
+    Properties:
+        table, batch_size, delay, threaded, executor - As above
+        pending (int) - Number of submissions waiting to be recorded
+    """
+    def __init__(self, table, batch_size=1000, delay=0, loop=None,
+                 threaded=False, executor=None):
+        self.table = table
+        self.batch_size = batch_size
+        self.delay = delay
+        self.threaded = threaded
+        self.executor = executor
+        self._loop = loop
+
+        # Heap of (datetime, submission number, entry, future) 4-tuples. The
+        # number keeps submissions with equal datetimes in order.
+        self._pending = []
+        self._count = itertools.count()
+        self._scheduled = False
+
+        # True while a batch is being recorded in the executor
+        self._running = False
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def submit(self, datetime_, *txns):
+        """Queue a transaction to be recorded, with the same arguments as
+        CapTable.record. Returns a future resolving to the datetime it was
+        recorded at.
+
+        Submissions are recorded in order of datetime, which must not be
+        older than the datetime of anything already recorded (see
+        CapTable.record). Like CapTable.record_many in deferred mode,
+        transactions may be called again if their batch fails, so must be
+        safe to call more than once.
+        """
+        if not txns:
+            raise ValueError("Must provide at least one transaction")
+        if not datetime_:
+            datetime_ = datetime.datetime.now()
+        future = self.loop.create_future()
+        heapq.heappush(self._pending, (datetime_, next(self._count),
+                                       (datetime_,) + txns, future))
+        self._schedule()
+        return future
+
+    def _schedule(self):
+        if self._scheduled or self._running or not self._pending:
+            return
+        self._scheduled = True
+        if self.delay:
+            self.loop.call_later(self.delay, self._flush)
+        else:
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if self.threaded:
+            batch = self._take(self.batch_size)
+            if batch:
+                entries = [entry for _, _, entry, _ in batch]
+                self._running = True
+                done = self.loop.run_in_executor(self.executor, self._record,
+                                                 entries)
+                done.add_done_callback(functools.partial(self._recorded,
+                                                         batch))
+                return
+        else:
+            self.flush(self.batch_size)
+        self._schedule()
+
+    def _recorded(self, batch, done):
+        """Called on the loop's thread once the executor has recorded a
+        batch"""
+        self._running = False
+        try:
+            errors = done.result()
+        except Exception as e:
+            errors = [e] * len(batch)
+        self._resolve(batch, errors)
+        self._schedule()
+
+    def _take(self, count):
+        """Remove up to count pending submissions and return the ones not
+        cancelled, in order"""
+        count = min(count, len(self._pending))
+        batch = [heapq.heappop(self._pending) for _ in range(count)]
+        return [item for item in batch if not item[3].cancelled()]
+
+    def flush(self, limit=None):
+        """Record up to limit (default all) pending submissions right away on
+        the calling thread, in batches of at most batch_size. Returns the
+        number recorded or failed."""
+        done = 0
+        while self._pending and (limit is None or done < limit):
+            count = min(self.batch_size, len(self._pending))
+            if limit is not None:
+                count = min(count, limit - done)
+            batch = self._take(count)
+            entries = [entry for _, _, entry, _ in batch]
+            self._resolve(batch, self._record(entries))
+            done += count
+        return done
+
+    def _record(self, entries):
+        """Record a sorted list of entries. Returns a list of the exception
+        each entry failed with, or None if it was recorded. Doesn't touch
+        the submissions' futures, so can run on any thread."""
+        errors = []
+        while len(errors) < len(entries):
+            rest = entries[len(errors):]
+            try:
+                self.table.record_many(rest, deferred=True,
+                                       batch_size=len(rest))
+            except RecordError as e:
+                # Entries before the failed one were recorded
+                errors.extend([None] * e.index + [e.error])
+            except Exception as e:
+                # Not a failed entry (e.g. the log couldn't be written), so
+                # there's no telling what was recorded
+                errors.extend([e] * len(rest))
+            else:
+                errors.extend([None] * len(rest))
+        return errors
+
+    def _resolve(self, batch, errors):
+        """Resolve the futures of a batch of submissions given what _record
+        returned for them"""
+        for (_, _, entry, future), error in zip(batch, errors):
+            if future.cancelled():
+                continue
+            if error is None:
+                future.set_result(entry[0])
+            else:
+                future.set_exception(error)
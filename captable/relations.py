@@ -0,0 +1,225 @@
+"""Related persons and voting control.
+
+Persons can be related to each other -- e.g. affiliates, an entity and the
+person controlling it, or parties to a voting agreement. Related persons form
+a control group (along with anyone related to them, and so on), whose voting
+power is the total of the votes carried by each member's stock (see
+VOTES_PER_SHARE on Stock.MetaState).
+
+The relationships are stored in the table's state as a Relations object,
+created by the first `relate` transaction. Each person is mapped directly to
+the root of their group, and merging two groups relabels the members of the
+smaller one, so finding a person's group takes constant time. Each group's
+votes are kept as a running total, adjusted whenever an issue, transfer or
+cancel moves a live issuance between holders, so looking up a group's voting
+power doesn't walk the group or its members' holdings.
+"""
+from __future__ import absolute_import
+
+from .journal import Journaled, JournaledDict
+from .securities import RELATIONS_KEY, Security
+from .transactions import Transaction
+
+
+def votes_held(state, holder):
+    """Number of votes carried by holder's live issuances of every class"""
+    return sum(metastate.votes_held(holder) for metastate in
+               state.get(Security.STATE_KEY, {}).values())
+
+
+def total_votes(state):
+    """Number of votes carried by all outstanding shares"""
+    return sum(metastate.outstanding * metastate.VOTES_PER_SHARE
+               for metastate in state.get(Security.STATE_KEY, {}).values()
+               if hasattr(metastate, "VOTES_PER_SHARE"))
+
+
+class Relations(Journaled):
+    """Graph of related persons, grouped by control
+
+    Properties:
+        edges (dict) - Maps each related person to a dict mapping each person
+            they're directly related to to the kind of relationship (e.g.
+            "affiliate", "controls" or "voting agreement")
+        roots (dict) - Maps each related person to their group's root
+        groups (dict) - Maps each root to a dict whose keys are the members
+            of its group
+        votes (dict) - Maps each root to its group's votes
+    """
+    STATE_KEY = RELATIONS_KEY
+
+    @classmethod
+    def __table_key__(cls, state):
+        """Relations can be used as a key in the CapTable state. Raises a
+        KeyError if no persons have been related yet."""
+        ret = state.get(cls.STATE_KEY)
+        if ret is not None:
+            return ret
+        raise KeyError("No related persons")
+
+    @classmethod
+    def relate(cls, person, other, kind="affiliate"):
+        """Returns a transaction relating two persons, placing them in the
+        same control group"""
+        return Transaction(cls, "relate", person, other, kind)
+
+    @classmethod
+    def _relate(cls, datetime_, state, person, other, kind="affiliate"):
+        relations = state.get(cls.STATE_KEY)
+        if relations is None:
+            relations = state[cls.STATE_KEY] = cls()
+        relations.add(state, person, other, kind)
+        return state
+
+    @classmethod
+    def unrelate(cls, person, other):
+        """Returns a transaction removing the relationship between two
+        persons. They remain in the same group if still related through
+        others."""
+        return Transaction(cls, "unrelate", person, other)
+
+    @classmethod
+    def _unrelate(cls, datetime_, state, person, other):
+        cls.__table_key__(state).remove(state, person, other)
+        return state
+
+    def __init__(self):
+        self.edges = JournaledDict()
+        self.roots = JournaledDict()
+        self.groups = JournaledDict()
+        self.votes = JournaledDict()
+
+    def find(self, person):
+        """Returns the root of person's group. Unrelated persons are the root
+        of their own group."""
+        return self.roots.get(person, person)
+
+    def group(self, person):
+        """Returns a list of the members of person's group"""
+        members = self.groups.get(self.find(person))
+        return list(members) if members else [person]
+
+    def related(self, person):
+        """Returns a dict mapping each person directly related to person to
+        the kind of relationship"""
+        return dict(self.edges.get(person, {}))
+
+    def _add_person(self, state, person):
+        if person not in self.roots:
+            self.edges[person] = JournaledDict()
+            self.roots[person] = person
+            self.groups[person] = JournaledDict({person: True})
+            self.votes[person] = votes_held(state, person)
+
+    def add(self, state, person, other, kind):
+        """Relate person and other, merging their groups"""
+        if person is other:
+            raise ValueError("A person can't be related to themselves")
+        self._add_person(state, person)
+        self._add_person(state, other)
+        self.edges[person][other] = kind
+        self.edges[other][person] = kind
+
+        root, other_root = self.roots[person], self.roots[other]
+        if root is other_root:
+            return
+        if len(self.groups[root]) < len(self.groups[other_root]):
+            root, other_root = other_root, root
+        members = self.groups[root]
+        for member in self.groups.pop(other_root):
+            self.roots[member] = root
+            members[member] = True
+        self.votes[root] += self.votes.pop(other_root)
+
+    def remove(self, state, person, other):
+        """Remove the relationship between person and other, splitting their
+        group if nothing else connects them. Splitting regroups the former
+        members, so costs time proportional to the size of the group."""
+        if other not in self.edges.get(person, {}):
+            raise KeyError("No relationship between %r and %r" %
+                           (person, other))
+        del self.edges[person][other]
+        del self.edges[other][person]
+
+        root = self.roots[person]
+        members = self.groups.pop(root)
+        del self.votes[root]
+        for member in members:
+            del self.roots[member]
+
+        for member in members:
+            if member in self.roots:
+                continue
+            if not self.edges[member]:
+                # No longer related to anyone
+                del self.edges[member]
+                continue
+            group = JournaledDict({member: True})
+            pending = [member]
+            while pending:
+                for related in self.edges[pending.pop()]:
+                    if related not in group:
+                        group[related] = True
+                        pending.append(related)
+            for related in group:
+                self.roots[related] = member
+            self.groups[member] = group
+            self.votes[member] = sum(votes_held(state, related)
+                                     for related in group)
+
+    def adjust(self, holder, votes):
+        """Add votes to the total of holder's group, if holder is related to
+        anyone"""
+        root = self.roots.get(holder)
+        if root is not None:
+            self.votes[root] += votes
+
+    def recount(self, state):
+        """Recompute each group's votes from the holdings in state, e.g.
+        after changing VOTES_PER_SHARE"""
+        for root, members in self.groups.items():
+            self.votes[root] = sum(votes_held(state, member)
+                                   for member in members)
+
+
+def voting_power(view, person):
+    """Votes held by person's control group in a CapTable or TableView"""
+    relations = view.state.get(RELATIONS_KEY)
+    if relations is not None and person in relations.roots:
+        return relations.votes[relations.roots[person]]
+    return votes_held(view.state, person)
+
+
+def control(view):
+    """Returns a list of (members, votes, fraction of all votes) 3-tuples for
+    each control group holding votes, largest first. Persons not related to
+    anyone form a group of their own."""
+    state = view.state
+    relations = state.get(RELATIONS_KEY)
+    total = total_votes(state)
+
+    # Related holders are already counted in their group's votes
+    holders = set()
+    for metastate in state.get(Security.STATE_KEY, {}).values():
+        holders.update(metastate.holders)
+    ret = []
+    if relations is not None:
+        holders.difference_update(relations.roots)
+        for root, members in relations.groups.items():
+            ret.append((list(members), relations.votes[root]))
+    for holder in holders:
+        ret.append(([holder], votes_held(state, holder)))
+
+    ret = [(members, votes, votes / float(total) if total else 0.0)
+           for members, votes in ret if votes]
+    ret.sort(key=lambda row: -row[1])
+    return ret
+
+
+def controlling(view, threshold=0.5):
+    """Returns the members of the control group holding more than threshold
+    of all votes, or None"""
+    for members, votes, fraction in control(view):
+        if fraction > threshold:
+            return members
+    return None
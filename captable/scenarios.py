@@ -0,0 +1,193 @@
+"""Evaluating many what-if scenarios (e.g. different round sizes or option
+pool top-ups) against a table in parallel.
+
+    results = scenarios.run(table, [
+        [(closing, SeriesA.auth(n), SeriesA.issue(holder=fund, amount=n))]
+        for n in (1000000, 1500000, 2000000)
+    ])
+
+The table's state is saved to a snapshot file (see captable.snapshot) once,
+and each worker process loads it once. Every scenario is then recorded on a
+fork of the loaded table (see CapTable.fork), with the normal record
+semantics -- each entry is atomic and validated -- and only a small summary
+of the result is sent back.
+
+Persons (and other Snowflakes) in the table's state are sent to and from the
+workers by reference, so the Persons in scenarios and results are the same
+objects as in the table. Security classes, transactions and summarize
+callables must be picklable, i.e. defined at module level.
+"""
+from __future__ import absolute_import
+
+import gc
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .mixins import Snowflake
+from .ownership import report
+from .securities import Security
+from .table import CapTable, RecordError
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+
+class Result(object):
+    """Summary of the table after recording a scenario
+
+    Properties:
+        index (int) - Index of the scenario in the list passed to run
+        failed (int) - Index of the entry that failed, or None if every
+            entry was recorded. Entries before it remain recorded, so the
+            rest of the result describes the table as of the failure.
+        error (str) - Description of the error raised by the failed entry,
+            or None
+        datetime (datetime) - Datetime of the table's last transaction
+        outstanding (dict) - Maps the name of each class of stock to its
+            outstanding shares
+        ownership (Ownership) - Ownership report (see captable.ownership)
+        summary - Whatever the summarize callable passed to run returned for
+            the table, or None
+    """
+    def __init__(self, index, failed, error, datetime_, outstanding,
+                 ownership, summary=None):
+        self.index = index
+        self.failed = failed
+        self.error = error
+        self.datetime = datetime_
+        self.outstanding = outstanding
+        self.ownership = ownership
+        self.summary = summary
+
+    @property
+    def ok(self):
+        """True if every entry in the scenario was recorded"""
+        return self.failed is None
+
+    def __repr__(self):
+        return "<Result %s %s>" % (
+            self.index, "ok" if self.ok else "failed at %s" % self.failed)
+
+
+def evaluate(table, index, entries, summarize=None):
+    """Records a scenario's entries on table (which should be a fork) and
+    returns its Result
+
+    Args:
+        table (CapTable) - Table to record on
+        index (int) - Index of the scenario
+        entries (list) - Entries as for CapTable.record_many
+        summarize (callable) - Optional callable returning extra summary data
+            for the table
+    """
+    failed = error = None
+    try:
+        table.record_many(entries)
+    except RecordError as e:
+        failed, error = e.index, repr(e.error)
+    outstanding = dict(
+        (name, metastate.outstanding) for name, metastate in
+        table.state.get(Security.STATE_KEY, {}).items()
+        if hasattr(metastate, "holder_amounts"))
+    return Result(index, failed, error, table.datetime, outstanding,
+                  report(table),
+                  summarize(table) if summarize is not None else None)
+
+
+def _dumps(obj, ids):
+    """Pickle obj, referring to the Snowflakes whose ids are keys of ids by
+    the index they map to"""
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, PROTOCOL)
+    def persistent_id(value):
+        if isinstance(value, Snowflake) and not isinstance(value, Security):
+            return ids.get(id(value))
+        return None
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return buffer.getvalue()
+
+def _loads(data, snowflakes):
+    """Unpickle data from _dumps, given the Snowflakes it refers to"""
+    unpickler = pickle.Unpickler(io.BytesIO(data))
+    unpickler.persistent_load = snowflakes.__getitem__
+    return unpickler.load()
+
+def _ids(snowflakes):
+    return dict((id(obj), i) for i, obj in enumerate(snowflakes))
+
+
+# State of each worker process, set by _init
+_worker = {}
+
+def _init(path, validators, summarize):
+    table = CapTable.load_snapshot(path, validators=validators,
+                                   checkpoint_interval=None)
+
+    # Load every class up front, so that forks share the loaded issuances
+    # rather than each loading their own
+    for metastate in table.state.get(Security.STATE_KEY, {}).values():
+        metastate._load()
+
+    # The base table is never modified, so stop the garbage collector from
+    # scanning it over and over (Python 3.7+)
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    snowflakes = table._snapshot.snowflakes
+    _worker.update(table=table, snowflakes=snowflakes,
+                   ids=_ids(snowflakes), summarize=summarize)
+
+def _evaluate(args):
+    index, data = args
+    entries = _loads(data, _worker["snowflakes"])
+    result = evaluate(_worker["table"].fork(), index, entries,
+                      _worker["summarize"])
+    return _dumps(result, _worker["ids"])
+
+
+def run(table, scenarios, processes=None, summarize=None, chunksize=1):
+    """Record each scenario on its own fork of table, in a pool of worker
+    processes. Returns a list with a Result for each scenario, in order.
+
+    Args:
+        table (CapTable) - The base table. Scenarios can't record
+            transactions older than its datetime.
+        scenarios (list) - Each scenario is a list of entries as for
+            CapTable.record_many
+        processes (int) - Number of worker processes. Defaults to the number
+            of CPUs. Pass 0 to record the scenarios in this process instead,
+            e.g. when debugging.
+        summarize (callable) - Optional callable taking the table after each
+            scenario and returning extra data for its Result. The returned
+            data must be picklable.
+        chunksize (int) - Number of scenarios sent to a worker at a time
+    """
+    if processes == 0:
+        return [evaluate(table.fork(), index, list(entries), summarize)
+                for index, entries in enumerate(scenarios)]
+
+    directory = tempfile.mkdtemp(prefix="captable-")
+    try:
+        path = os.path.join(directory, "base.snapshot")
+        snowflakes = table.save_snapshot(path)
+        ids = _ids(snowflakes)
+        jobs = [(index, _dumps(list(entries), ids))
+                for index, entries in enumerate(scenarios)]
+        pool = multiprocessing.Pool(processes, _init,
+                                    (path, table.validators, summarize))
+        try:
+            results = pool.map(_evaluate, jobs, chunksize)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return [_loads(data, snowflakes) for data in results]
@@ -3,10 +3,26 @@
 from __future__ import absolute_import
 
 from . import mixins
+from .certs import CertIndex
+from .diff import tracker
+import copy
+import itertools
+from .journal import (Journaled, JournaledDict, JournaledList, StateDict,
+                      is_writing, shared, untracked)
 from .misc import classproperty
+from .transactions import Transaction
+import threading
 
+# Key in a CapTable's state dict under which related persons are tracked (see
+# captable.relations). Told whenever a live issuance's votes change hands.
+RELATIONS_KEY = 'relations'
 
-class Security(mixins.Snowflake):
+# Held while loading a MetaState from a snapshot, since threads reading the
+# same committed state (see CapTable.committed) may trigger the load at once
+_load_lock = threading.Lock()
+
+
+class Security(mixins.Snowflake, Journaled):
     """Represents a class or type of Security
 
     Args:
@@ -67,50 +83,301 @@ class Security(mixins.Snowflake):
         Security's class, the MetaState will be updated to the new class
         while preserving the __dict__ of the old class.
         """
-        def txn(datetime_, state):
-            securities_dict = state.setdefault(cls.STATE_KEY, {})
-            current_state = securities_dict.get(cls.name, None)
-            if not current_state:
-                securities_dict[cls.name] = cls.MetaState()
-            elif not isinstance(current_state, cls.MetaState):
-                securities_dict[cls.name] = \
-                    cls.MetaState.__migrate__(current_state)
-            return state
-        return txn
-
-    class MetaState(mixins.EqualityMixin):
+        return Transaction(cls, "auth")
+
+    @classmethod
+    def _auth(cls, datetime_, state):
+        securities_dict = state.setdefault(cls.STATE_KEY, StateDict())
+        current_state = securities_dict.get(cls.name, None)
+        if not current_state:
+            securities_dict[cls.name] = cls.MetaState()
+        elif not isinstance(current_state, cls.MetaState):
+            securities_dict[cls.name] = \
+                cls.MetaState.__migrate__(current_state)
+        return state
+
+    class MetaState(mixins.EqualityMixin, Journaled):
         """A class containing information about an entire *class* of securities
         as opposed to just one instance (issuance). Used by auth. Can be sub-
         classed or overriden as appropriate, but should have a __migrate__ 
         classmethod.
 
+        MetaState is journaled -- attribute assignments, and changes to the
+        issuances and cert_no_lookups containers, are undone automatically if
+        the transaction making them fails. Subclasses adding mutable
+        containers should use JournaledList / JournaledDict as well.
+
+        A MetaState read from a snapshot (see captable.snapshot) may load its
+        containers only when they're first accessed. Code that reads the
+        __dict__ directly should call _load first.
+
+        A MetaState copied for a fork of a table (see __fork__) shares its
+        issuances with the original until they're modified. Transactions
+        should get the issuances they modify via __getitem__ (i.e. by
+        cert_no), which swaps in a private copy first.
+
+        The cert_index (see captable.certs) is only built when first used,
+        and kept up to date by issue and cancel from then on.
+
         """
         @classmethod
         def __migrate__(cls, old_state):
             """Returns an instance of this class instantiated from a
             pre-decessor MetaState"""
             ret = cls()
-            ret.__dict__ = old_state.__dict__
+            attrs = old_state.__export__()
+            ret.__dict__.update(attrs)
+            if 'holdings' not in attrs:
+                ret._reindex()
+            return ret
+
+        def __export__(self):
+            """Returns a dict of attributes for a successor MetaState to
+            __migrate__ from. Storage-specific indexes may be omitted, in which
+            case the successor rebuilds them."""
+            self._load()
+            return self.__dict__
+
+        def __deepcopy__(self, memo):
+            # Security instances are Snowflakes and would otherwise be shared
+            # with the copy. Clone them up front so every reference to an
+            # issuance within this MetaState points to the same clone. If
+            # not loaded yet, the copy just loads its own issuances later.
+            if '_loader' not in self.__dict__:
+                for issuance in self.issuances:
+                    if id(issuance) not in memo:
+                        memo[id(issuance)] = issuance._clone()
+            ret = object.__new__(self.__class__)
+            memo[id(self)] = ret
+            ret.__dict__.update(copy.deepcopy(self.__dict__, memo))
+            # The copy shares nothing, so can modify any issuance
+            ret.__dict__.pop('_writable', None)
+            return ret
+
+        def __fork__(self):
+            """Returns a copy for a fork of a table (see journal.forked).
+            Large containers are layered over the originals (see
+            journal.shared), and the issuances in them are shared until
+            accessed via __getitem__ by a transaction."""
+            ret = object.__new__(self.__class__)
+            if '_loader' not in self.__dict__:
+                # Built here (this MetaState is no longer modified) rather
+                # than by each fork modifying an issuance, so forks share it
+                with untracked():
+                    self._positions()
+            with _load_lock:
+                attrs = list(self.__dict__.items())
+            for name, value in attrs:
+                if name != '_writable':
+                    ret.__dict__[name] = shared(value)
+            if '_loader' not in ret.__dict__:
+                # Issuances this copy may modify in place, as keys
+                ret.__dict__['_writable'] = JournaledDict()
             return ret
 
         def __init__(self):
             # Used to store issuances in order
-            self.issuances = []
+            self.issuances = JournaledList()
 
             # Used to reference issuances by certifiate number (if applicable)
-            self.cert_no_lookups = {}
+            self.cert_no_lookups = JournaledDict()
+
+            # Maps each holder to a dict whose keys are the holder's live
+            # (uncancelled) issuances
+            self.holdings = JournaledDict()
+
+        def __getattr__(self, name):
+            # Only called for missing attributes, which may not be loaded yet
+            if name.startswith('__') or '_loader' not in self.__dict__:
+                raise AttributeError(name)
+            self._load()
+            return getattr(self, name)
+
+        def __setattr__(self, name, value):
+            # Don't let a later load clobber the new value
+            if name not in self.__dict__ and '_loader' in self.__dict__:
+                self._load()
+            Journaled.__setattr__(self, name, value)
+
+        def __delattr__(self, name):
+            if name not in self.__dict__ and '_loader' in self.__dict__:
+                self._load()
+            Journaled.__delattr__(self, name)
+
+        def __eq__(self, other):
+            if isinstance(other, Security.MetaState):
+                self._load()
+                other._load()
+                attrs, other_attrs = dict(vars(self)), dict(vars(other))
+                for name in ('_writable', '_cert_index',
+                             '_issuance_positions', '_owned_rows'):
+                    attrs.pop(name, None)
+                    other_attrs.pop(name, None)
+                return attrs == other_attrs
+            return super(Security.MetaState, self).__eq__(other)
+
+        def _load(self):
+            """Read any attributes not yet loaded from a snapshot. The
+            snapshot's loader is a callable returning a dict of attributes."""
+            if '_loader' not in self.__dict__:
+                return
+            with _load_lock:
+                loader = self.__dict__.get('_loader')
+                if loader is not None:
+                    with untracked():
+                        self.__dict__.update(loader())
+                    # Removed last, so other threads find either the loader
+                    # or the loaded attributes
+                    del self.__dict__['_loader']
+
+        def _reindex(self):
+            """Rebuild the holder index from the issuances"""
+            self.holdings = JournaledDict()
+            for issuance in self.issuances:
+                if issuance.holder and not issuance.cancelled:
+                    self._hold(issuance.holder, issuance)
+
+        def _hold(self, holder, issuance):
+            """Called when holder starts holding a live issuance. Subclasses
+            tracking per-holder information can extend this."""
+            self._add_holding(holder, issuance)
+
+        def _release(self, holder, issuance):
+            """Called when holder stops holding a live issuance"""
+            self._remove_holding(holder, issuance)
+
+        def _add_holding(self, holder, issuance):
+            """Add issuance to the holder index under holder"""
+            self.holdings.setdefault(holder, JournaledDict())[issuance] = True
+
+        def _remove_holding(self, holder, issuance):
+            """Remove issuance from the holder index under holder"""
+            held = self.holdings[holder]
+            del held[issuance]
+            if not held:
+                del self.holdings[holder]
 
         def issue(self, issuance):
             self.issuances.append(issuance)
+            writable = self.__dict__.get('_writable')
+            if writable is not None:
+                writable[issuance] = True
+            positions = self.__dict__.get('_issuance_positions')
+            if positions is not None:
+                positions[issuance] = len(self.issuances) - 1
             if issuance.cert_no:
                 if issuance.cert_no in self.cert_no_lookups:
                     raise ValueError("cert_no %s already in use" % 
                                      issuance.cert_no)
                 else:
                     self.cert_no_lookups[issuance.cert_no] = issuance
+                    index = self.__dict__.get('_cert_index')
+                    if index is not None:
+                        index.add(issuance.cert_no, issuance.cancelled)
+            if issuance.holder and not issuance.cancelled:
+                self._hold(issuance.holder, issuance)
+            track = tracker()
+            if track is not None:
+                track.issued(issuance)
+
+        def transfer(self, cert_no, to):
+            """Change the holder of the certificate with the given cert_no.
+            Subclasses tracking per-holder information should override this
+            rather than having transactions change the holder directly."""
+            issuance = self[cert_no]
+            track = tracker()
+            if track is not None:
+                track.changing(issuance)
+            if not issuance.cancelled:
+                if issuance.holder:
+                    self._release(issuance.holder, issuance)
+                if to:
+                    self._hold(to, issuance)
+            issuance.holder = to
+            return issuance
+
+        def cancel(self, cert_no):
+            """Mark the certificate with the given cert_no as cancelled"""
+            issuance = self[cert_no]
+            track = tracker()
+            if track is not None:
+                track.changing(issuance)
+            if not issuance.cancelled:
+                if issuance.holder:
+                    self._release(issuance.holder, issuance)
+                index = self.__dict__.get('_cert_index')
+                if index is not None and issuance.cert_no:
+                    index.cancel(issuance.cert_no)
+            issuance.cancelled = True
+            return issuance
+
+        def held_by(self, holder):
+            """Returns a list of live (uncancelled) issuances held by holder"""
+            return list(self.holdings.get(holder, ()))
+
+        def votes(self, issuance):
+            """Number of votes carried by a live issuance of this class"""
+            return 0
+
+        def votes_held(self, holder):
+            """Number of votes carried by holder's live issuances"""
+            return sum(self.votes(i) for i in self.held_by(holder))
+
+        @property
+        def cert_index(self):
+            """CertIndex of the cert_nos of this class, for ordered queries
+            (see captable.certs)"""
+            index = self.__dict__.get('_cert_index')
+            if index is None:
+                self._load()
+                index = CertIndex((cert_no, issuance.cancelled) for
+                                  cert_no, issuance in
+                                  self.cert_no_lookups.items())
+                self._cert_index = index
+            return index
+
+        @property
+        def holders(self):
+            """List of Persons currently holding a live issuance"""
+            return list(self.holdings)
 
         def __getitem__(self, key):
-            return self.cert_no_lookups[key]
+            issuance = self.cert_no_lookups[key]
+            writable = self.__dict__.get('_writable')
+            if writable is not None and issuance not in writable and \
+                    is_writing():
+                issuance = self._make_writable(issuance)
+            return issuance
+
+        def _make_writable(self, issuance):
+            """Replace an issuance shared with another table with a clone
+            that this MetaState can modify. Subclasses indexing issuances
+            should extend this to update their indexes."""
+            ret = issuance._clone()
+            writable = self._writable
+            positions = self._positions()
+            index = positions[issuance]
+            self.issuances[index] = ret
+            positions[ret] = index
+            if issuance.cert_no:
+                self.cert_no_lookups[issuance.cert_no] = ret
+            if issuance.holder and not issuance.cancelled:
+                held = self.holdings[issuance.holder]
+                del held[issuance]
+                held[ret] = True
+            writable[ret] = True
+            return ret
+
+        def _positions(self):
+            """Returns a dict mapping each issuance to its index in the
+            issuances list, built when first needed and kept up to date by
+            issue from then on"""
+            positions = self.__dict__.get('_issuance_positions')
+            if positions is None:
+                positions = JournaledDict(
+                    zip(self.issuances, itertools.count()))
+                self._issuance_positions = positions
+            return positions
 
         def __contains__(self, key):
             return key in self.cert_no_lookups
@@ -118,17 +385,24 @@ class Security(mixins.Snowflake):
     @classmethod
     def issue(cls, *args, **kwds):
         """Returns a callable issuing stock to a holder"""
-        def txn(datetime_, state):
-            try:
-                metastate = cls._in(state)
-            except KeyError:
-                raise RuntimeError("Need to authorize security before issuing")
+        return Transaction(cls, "issue", *args, **kwds)
 
+    @classmethod
+    def _issue(cls, datetime_, state, *args, **kwds):
+        try:
+            metastate = cls._in(state)
+        except KeyError:
+            raise RuntimeError("Need to authorize security before issuing")
+
+        # New issuance isn't part of state until issued, so no need to
+        # journal its initialization
+        with untracked():
             security = cls(*args, **kwds)
             security.issued_on = datetime_
-            metastate.issue(security)
-            return state
-        return txn
+        metastate.issue(security)
+        if not security.cancelled:
+            cls._moved(state, metastate, security, None, security.holder)
+        return state
 
     @classmethod
     def transfer(cls, cert_no, to):
@@ -136,24 +410,54 @@ class Security(mixins.Snowflake):
         another. A transfer does not change the name or values on the
         certificate. It only changes the holder. 
         """
-        def txn(datetime_, state):
-            metastate = cls._in(state)
-            issuance = metastate[cert_no]
-            issuance.holder = to
-            return state
-        return txn
+        return Transaction(cls, "transfer", cert_no, to)
+
+    @classmethod
+    def _transfer(cls, datetime_, state, cert_no, to):
+        metastate = cls._in(state)
+        issuance = metastate[cert_no]
+        holder = issuance.holder
+        metastate.transfer(cert_no, to)
+        if not issuance.cancelled:
+            cls._moved(state, metastate, issuance, holder, to)
+        return state
 
     @classmethod
     def cancel(cls, cert_no):
         """Returns a transaction cancelling a particular certificate. A
         cancelled security is simply one no longer recognized by the issuer.
         """
-        def txn(datetime_, state):
-            metastate = cls._in(state)
-            issuance = metastate[cert_no]
-            issuance.cancelled = True
-            return state
-        return txn
+        return Transaction(cls, "cancel", cert_no)
+
+    @classmethod
+    def _cancel(cls, datetime_, state, cert_no):
+        metastate = cls._in(state)
+        issuance = metastate[cert_no]
+        if not issuance.cancelled:
+            cls._moved(state, metastate, issuance, issuance.holder, None)
+        metastate.cancel(cert_no)
+        return state
+
+    @classmethod
+    def _moved(cls, state, metastate, issuance, from_, to):
+        """Called when a live issuance moves from one holder to another (or
+        None for the issuer) to keep per-group vote totals up to date"""
+        relations = state.get(RELATIONS_KEY)
+        if relations is None:
+            return
+        votes = metastate.votes(issuance)
+        if votes:
+            if from_:
+                relations.adjust(from_, -votes)
+            if to:
+                relations.adjust(to, votes)
+
+    def _clone(self):
+        """Returns a distinct copy of this issuance. Copying via the copy
+        module returns this instance since Security is a Snowflake."""
+        ret = object.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        return ret
 
     def __init__(self, holder, cert_no=None, cert_name=None):
         self.holder = holder
@@ -173,6 +477,9 @@ class Stock(Security):
         amount (int) - The integer amount of shares
         cert_no (str) - Optional user-assigned sring identifier for this 
             Security, defaults to None
+        vesting (Schedule) - Optional vesting schedule (see captable.vesting)
+        plan (str) - Optional name of the plan (see reserve) this Security is
+            issued under
 
     Properties:
         holder (Person) - The legal Person holding this Security
@@ -180,31 +487,71 @@ class Stock(Security):
         amount (int) - The integer amount of shares
         cert_no (str) - User-assigned sring identifier for this Security, if
             provided
+        vesting (Schedule) - Vesting schedule, or None if fully vested when
+            issued
+        accelerations (tuple) - (datetime, trigger name) 2-tuples for each
+            time vesting was accelerated (see accelerate)
+        plan (str) - Name of the plan issued under, or None
     """
+    # Defaults for issuances without a vesting schedule or plan. Only set on
+    # instances that have one.
+    vesting = None
+    accelerations = ()
+    plan = None
+
     @classmethod
     def auth(cls, amount=None, delta=None):
         """Return tranaction authorizing a certain number of shares of stock for
         issuance"""
-        def txn(datetime_, state):
-            state = super(Stock, cls).auth()(datetime_, state)
-            metastate = cls._in(state)
+        return Transaction(cls, "auth", amount=amount, delta=delta)
+
+    @classmethod
+    def _auth(cls, datetime_, state, amount=None, delta=None):
+        state = super(Stock, cls)._auth(datetime_, state)
+        metastate = cls._in(state)
+
+        # If both supplied, validate (amount var will alter state in below)
+        if type(amount) == int and type(delta) == int:
+            assert metastate.authorized + delta == amount, \
+            "Authorization amount inconsistent delta: %s + %s != %s" % \
+            (metastate.authorized, delta, amount)
 
-            # If both supplied, validate (amount var will alter state in below)
-            if type(amount) == int and type(delta) == int:
-                assert metastate.authorized + delta == amount, \
-                "Authorization amount inconsistent delta: %s + %s != %s" % \
-                (metastate.authorized, delta, amount)
+        # If amount, replace
+        if type(amount) == int:
+            metastate.authorized = amount
 
-            # If amount, replace
-            if type(amount) == int:
-                metastate.authorized = amount
+        # If only delta, increment
+        elif type(delta) == int:
+            metastate.authorized += delta
 
-            # If only delta, increment
-            elif type(delta) == int:
-                metastate.authorized += delta
+        return state
+
+    @classmethod
+    def reserve(cls, plan, amount=None, delta=None):
+        """Returns a transaction reserving shares for later issuance under a
+        plan (e.g. an option pool). Like auth, either sets the total number of
+        shares reserved for the plan (including those already issued under
+        it) to amount, or changes it by delta."""
+        return Transaction(cls, "reserve", plan, amount=amount, delta=delta)
 
-            return state
-        return txn
+    @classmethod
+    def _reserve(cls, datetime_, state, plan, amount=None, delta=None):
+        try:
+            metastate = cls._in(state)
+        except KeyError:
+            raise RuntimeError("Need to authorize security before reserving")
+
+        if amount is None and delta is None:
+            raise ValueError("Must provide amount or delta to reserve")
+        current = metastate.plans.get(plan, 0)
+        if type(amount) == int and type(delta) == int:
+            assert current + delta == amount, \
+            "Reservation amount inconsistent delta: %s + %s != %s" % \
+            (current, delta, amount)
+        if type(amount) != int:
+            amount = current + delta
+        metastate.reserve(plan, amount)
+        return state
 
     class MetaState(Security.MetaState):
         """Track authorized number of shares in addition to other security info
@@ -213,30 +560,174 @@ class Stock(Security):
         # authorized shares
         DEAUTH_RETIRED = False
 
+        # If set to True, the running share counts are cross-checked against
+        # a full recount of the issuances each time they are read. Useful for
+        # debugging code that modifies issuances without going through the
+        # MetaState's issue, transfer, and cancel methods.
+        CHECK_COUNTS = False
+
+        # Number of common shares each share of this class is counted as for
+        # as-converted calculations (e.g. ownership percentages) or converts
+        # into in a liquidation
+        CONVERSION_RATIO = 1
+
+        # Liquidation terms (see captable.waterfall). LIQUIDATION_PREFERENCE
+        # is the amount per share paid before any junior class, with classes
+        # of higher SENIORITY paid first. PARTICIPATING classes also share in
+        # what's left after preferences, up to a total of PARTICIPATION_CAP
+        # per share (None for no cap). Non-participating classes receive the
+        # greater of their preference and what they'd get by converting.
+        LIQUIDATION_PREFERENCE = 0
+        SENIORITY = 0
+        PARTICIPATING = False
+        PARTICIPATION_CAP = None
+
+        # Votes carried by each outstanding share (see captable.relations)
+        VOTES_PER_SHARE = 1
+
+        @classmethod
+        def __migrate__(cls, old_state):
+            ret = super(Stock.MetaState, cls).__migrate__(old_state)
+            if not hasattr(old_state, '_issued'):
+                ret._recount()
+            return ret
+
         def __init__(self):
             super(Stock.MetaState, self).__init__()
             self.authorized = 0
 
+            # Running share counts, updated as issuances change
+            self._issued = 0
+            self._outstanding = 0
+            self._cancelled = 0
+
+            # Maps each holder to the number of outstanding shares it holds
+            self.holder_amounts = JournaledDict()
+
+            # Maps each plan to the total number of shares reserved for it,
+            # and to the number of live shares issued under it
+            self.plans = JournaledDict()
+            self.plan_issued = JournaledDict()
+
+            # Running count of shares reserved but not yet issued, across
+            # every plan
+            self._reserved = 0
+
+        def _reindex(self):
+            self.holder_amounts = JournaledDict()
+            super(Stock.MetaState, self)._reindex()
+
+        def _hold(self, holder, issuance):
+            super(Stock.MetaState, self)._hold(holder, issuance)
+            self.holder_amounts[holder] = \
+                self.holder_amounts.get(holder, 0) + issuance.amount
+
+        def _release(self, holder, issuance):
+            super(Stock.MetaState, self)._release(holder, issuance)
+            amount = self.holder_amounts[holder] - issuance.amount
+            if amount or holder in self.holdings:
+                self.holder_amounts[holder] = amount
+            else:
+                del self.holder_amounts[holder]
+
+        def shares_held(self, holder):
+            """Number of outstanding shares held by holder"""
+            return self.holder_amounts.get(holder, 0)
+
+        def votes(self, issuance):
+            return issuance.amount * self.VOTES_PER_SHARE
+
+        def votes_held(self, holder):
+            return self.holder_amounts.get(holder, 0) * self.VOTES_PER_SHARE
+
+        def _count(self):
+            """Returns (issued, outstanding, cancelled) share counts computed
+            by walking all issuances"""
+            issued = outstanding = cancelled = 0
+            for i in self.issuances:
+                if i.cancelled:
+                    cancelled += i.amount
+                else:
+                    issued += i.amount
+                    if i.holder:
+                        outstanding += i.amount
+            return issued, outstanding, cancelled
+
+        def _count_plans(self):
+            """Returns (plan_issued, reserved) computed by walking all
+            issuances, where plan_issued is a dict as for the attribute"""
+            plan_issued = {}
+            for i in self.issuances:
+                if i.plan is not None and not i.cancelled:
+                    plan_issued[i.plan] = plan_issued.get(i.plan, 0) + i.amount
+            reserved = sum(amount - plan_issued.get(plan, 0)
+                           for plan, amount in self.plans.items())
+            return plan_issued, reserved
+
+        def _recount(self):
+            """Reset running share counts from the issuances"""
+            self._issued, self._outstanding, self._cancelled = self._count()
+            plan_issued, self._reserved = self._count_plans()
+            self.plan_issued = JournaledDict(plan_issued)
+
+        def _check_counts(self):
+            counts = (self._issued, self._outstanding, self._cancelled)
+            assert counts == self._count(), \
+                "Share counts out of sync: %s != %s" % (counts, self._count())
+            plan_issued, reserved = self._count_plans()
+            # Plans whose shares were all cancelled are left at 0
+            running = dict((plan, amount) for plan, amount
+                           in self.plan_issued.items() if amount)
+            assert running == plan_issued, \
+                "Plan counts out of sync: %s != %s" % (running, plan_issued)
+            assert self._reserved == reserved, \
+                "Reserved count out of sync: %s != %s" % (
+                self._reserved, reserved)
+
         @property
         def outstanding(self):
             """Number of shares issued and outstanding"""
-            return sum(map(
-                    (lambda i: i.amount if i.holder and not i.cancelled 
-                                        else 0), 
-                    self.issuances))
+            if self.CHECK_COUNTS:
+                self._check_counts()
+            return self._outstanding
 
         @property
         def issued(self):
             """Number of shares issued, which may or may not be outstanding"""
-            return sum(map(
-                    (lambda i: 0 if i.cancelled else i.amount), 
-                    self.issuances))
+            if self.CHECK_COUNTS:
+                self._check_counts()
+            return self._issued
+
+        @property
+        def cancelled(self):
+            """Number of shares issued and then cancelled (or retired)"""
+            if self.CHECK_COUNTS:
+                self._check_counts()
+            return self._cancelled
 
         @property
         def reserved(self):
-            """Number of shares reserved for later issuance"""
-            return 0 #TODO
-            
+            """Number of shares reserved for later issuance, across all plans
+            """
+            if self.CHECK_COUNTS:
+                self._check_counts()
+            return self._reserved
+
+        def available(self, plan):
+            """Number of shares reserved for plan and still available for
+            issuance under it"""
+            return self.plans.get(plan, 0) - self.plan_issued.get(plan, 0)
+
+        def reserve(self, plan, amount):
+            """Set the total number of shares reserved for plan, including
+            shares already issued under it"""
+            issued = self.plan_issued.get(plan, 0)
+            assert amount >= issued, \
+                "Reservation for %s below shares issued: %s < %s" % (
+                plan, amount, issued)
+            self._reserved += amount - self.plans.get(plan, 0)
+            self.plans[plan] = amount
+
         @property
         def issuable(self):
             """Number of shares available for issuance"""
@@ -249,28 +740,108 @@ class Stock(Security):
             return self.issuable - self.reserved
 
         def issue(self, issuance):
-            assert self.issued + issuance.amount < self.authorized, \
-                "Insufficient authorized: %s < %s + %s" % (
-                self.authorized, issuance.amount, self.issued)
-            return super(Stock.MetaState, self).issue(issuance)
+            # Use the running count directly since subclasses may have already
+            # stored the issuance (see columnar.Columnar). Shares issued under
+            # a plan come out of its reservation, others can't use reserved
+            # shares.
+            plan = issuance.plan
+            reserved = self._reserved if plan is None else 0
+            assert self._issued + reserved + issuance.amount < \
+                self.authorized, "Insufficient authorized: %s < %s + %s" % (
+                self.authorized, issuance.amount, self._issued + reserved)
+            if plan is not None and not issuance.cancelled:
+                if plan not in self.plans:
+                    raise ValueError("No shares reserved for plan %s" % plan)
+                assert issuance.amount <= self.available(plan), \
+                    "Insufficient reserved for %s: %s < %s" % (
+                    plan, self.available(plan), issuance.amount)
+            super(Stock.MetaState, self).issue(issuance)
+            if not issuance.cancelled:
+                self._issued += issuance.amount
+                if issuance.holder:
+                    self._outstanding += issuance.amount
+                if plan is not None:
+                    self._draw(plan, issuance.amount)
+            else:
+                self._cancelled += issuance.amount
+
+        def _draw(self, plan, amount):
+            """Count amount shares (negative to return them) as issued under
+            plan"""
+            self.plan_issued[plan] = self.plan_issued.get(plan, 0) + amount
+            self._reserved -= amount
+
+        def transfer(self, cert_no, to):
+            issuance = self[cert_no]
+            if not issuance.cancelled:
+                if issuance.holder and not to:
+                    self._outstanding -= issuance.amount
+                elif to and not issuance.holder:
+                    self._outstanding += issuance.amount
+            return super(Stock.MetaState, self).transfer(cert_no, to)
+
+        def cancel(self, cert_no):
+            issuance = self[cert_no]
+            if not issuance.cancelled:
+                self._issued -= issuance.amount
+                self._cancelled += issuance.amount
+                if issuance.holder:
+                    self._outstanding -= issuance.amount
+                # Cancelled shares return to the plan's reservation
+                if issuance.plan is not None:
+                    self._draw(issuance.plan, -issuance.amount)
+            return super(Stock.MetaState, self).cancel(cert_no)
 
     @classmethod
     def retire(cls, cert_no=None):
         """Retire a particular certificate of stock. If DEAUTH_RETIRED is 
         true, then retirement is the same as cancellation.
         """
-        def txn(datetime_, state):
-            state = cls.cancel(cert_no)(datetime_, state)
-            metastate = cls._in(state)
-            if metastate.DEAUTH_RETIRED:
-                cert = metastate[cert_no]
-                metastate.authorized -= cert.amount
-            return state
-        return txn
+        return Transaction(cls, "retire", cert_no)
+
+    @classmethod
+    def _retire(cls, datetime_, state, cert_no=None):
+        state = cls._cancel(datetime_, state, cert_no)
+        metastate = cls._in(state)
+        if metastate.DEAUTH_RETIRED:
+            cert = metastate[cert_no]
+            metastate.authorized -= cert.amount
+
+            # Cancelling returned the shares to the plan's reservation, but
+            # retired shares no longer exist to be reissued
+            if cert.plan is not None:
+                metastate.reserve(cert.plan,
+                                  metastate.plans[cert.plan] - cert.amount)
+        return state
 
-    def __init__(self, holder, amount, cert_no=None):
+    @classmethod
+    def accelerate(cls, cert_no, trigger):
+        """Returns a transaction accelerating the vesting of a certificate,
+        e.g. on a change of control. The trigger must be one of the
+        certificate's vesting schedule's triggers.
+        """
+        return Transaction(cls, "accelerate", cert_no, trigger)
+
+    @classmethod
+    def _accelerate(cls, datetime_, state, cert_no, trigger):
+        metastate = cls._in(state)
+        issuance = metastate[cert_no]
+        if issuance.vesting is None:
+            raise ValueError("cert_no %s has no vesting schedule" % cert_no)
+        if trigger not in issuance.vesting.triggers:
+            raise ValueError("cert_no %s has no acceleration trigger %r" %
+                             (cert_no, trigger))
+        issuance.accelerations += ((datetime_, trigger),)
+        return state
+
+    def __init__(self, holder, amount, cert_no=None, vesting=None,
+                 plan=None):
         super(Stock, self).__init__(holder=holder, cert_no=cert_no)
         self.amount = amount
+        if vesting is not None:
+            self.vesting = vesting
+        if plan is not None:
+            self.plan = plan
     
 
 class CommonStock(Stock):
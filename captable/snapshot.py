@@ -0,0 +1,302 @@
+"""Binary snapshots of a CapTable's state (see CapTable.save_snapshot and
+CapTable.load_snapshot).
+
+A snapshot file is laid out as:
+
+    header - MAGIC, VERSION (uint32) and the offset of the index (uint64)
+    blobs - Pickles and raw array data, referred to by (offset, length)
+    index - Pickled dict describing the rest of the file
+
+Snapshot files are memory-mapped when opened and read lazily. Only the index,
+Persons (and other Snowflakes) and the top level of the state are read up
+front. Each MetaState is written with its simple attributes (e.g. share
+counts) inline but its containers (issuances, indexes, etc.) in a separate
+blob, which is only unpickled when the MetaState first needs it. Large arrays
+(e.g. columnar storage) are written as raw bytes.
+
+Snapshots are pickled with the highest protocol available and are meant as a
+cache for fast startup -- the transaction log (see captable.persistence)
+remains the portable record of a table.
+"""
+from __future__ import absolute_import
+
+from array import array
+import datetime
+import io
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .journal import untracked
+from .mixins import Snowflake
+from .securities import Security
+
+MAGIC = b"CAPSNAP\x00"
+
+# Bump whenever the layout changes
+VERSION = 1
+
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+HEADER = struct.Struct("<8sIQ")
+
+# Arrays at least this many bytes long are written raw rather than pickled
+RAW_ARRAY_BYTES = 4096
+
+# MetaState attributes of these types are written inline. Anything else
+# waits for the MetaState's containers to be loaded.
+INLINE = (type(None), bool, int, float, str, bytes, datetime.date,
+          datetime.time, datetime.timedelta)
+try:
+    INLINE += (long, unicode)
+except NameError:
+    pass
+
+# Kinds of persistent ids
+SNOWFLAKE = "s"
+METASTATE = "m"
+ARRAY = "a"
+
+
+def _tobytes(column):
+    try:
+        return column.tobytes()
+    except AttributeError: # Python 2
+        return column.tostring()
+
+
+def _owner(cls):
+    """Returns the Security class defining MetaState class cls. Python 2
+    can't pickle nested classes, so MetaStates are stored by owner."""
+    pending = [Security]
+    while pending:
+        security = pending.pop()
+        if security.__dict__.get("MetaState") is cls:
+            return security
+        pending.extend(security.__subclasses__())
+    raise pickle.PicklingError("No Security class defines %r" % cls)
+
+
+class _Writer(object):
+    """Writes the blobs for a snapshot to an open file"""
+
+    def __init__(self, file_):
+        self.file = file_
+        self.snowflakes = []
+        self._snowflake_ids = {}
+
+    def blob(self, data):
+        """Write data to the file, returns (offset, length)"""
+        offset = self.file.tell()
+        self.file.write(data)
+        return offset, len(data)
+
+    def dumps(self, obj):
+        """Returns obj pickled, with Snowflakes, MetaStates and large arrays
+        replaced with references"""
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(obj)
+        return buffer.getvalue()
+
+    def snowflake_id(self, obj):
+        """Returns the index of a Snowflake in the snowflakes list"""
+        index = self._snowflake_ids.get(id(obj))
+        if index is None:
+            index = self._snowflake_ids[id(obj)] = len(self.snowflakes)
+            self.snowflakes.append(obj)
+        return index
+
+    def _persistent_id(self, obj):
+        # Security instances (issuances) are Snowflakes too, but belong to
+        # exactly one MetaState so are simply pickled along with it
+        if isinstance(obj, Snowflake) and not isinstance(obj, Security):
+            return (SNOWFLAKE, self.snowflake_id(obj))
+
+        if isinstance(obj, Security.MetaState):
+            obj._load()
+            inline = {}
+            containers = {}
+            for name, value in obj.__dict__.items():
+                if name in ('_writable', '_cert_index',
+                            '_issuance_positions', '_owned_rows'):
+                    # Only meaningful while sharing issuances with a fork, or
+                    # rebuilt when next used
+                    continue
+                if isinstance(value, INLINE):
+                    inline[name] = value
+                else:
+                    containers[name] = value
+            return (METASTATE, _owner(obj.__class__), inline,
+                    self.blob(self.dumps(containers)))
+
+        if isinstance(obj, array) and \
+                len(obj) * obj.itemsize >= RAW_ARRAY_BYTES:
+            return (ARRAY, obj.typecode, obj.itemsize,
+                    self.blob(_tobytes(obj)))
+
+        return None
+
+
+def save(path, state, datetime_=None, log=None):
+    """Write state to a snapshot file at path. The file is written under a
+    temporary name and then renamed, so an existing snapshot is replaced
+    atomically.
+
+    Args:
+        path (str) - Path to write to
+        state (dict) - The state to save
+        datetime_ (datetime) - Datetime of the last transaction reflected in
+            state
+        log (TransactionLog) - If the table has a log, its current position
+            and persistent ids are saved so the log can be replayed on top
+            of the snapshot
+
+    Returns the list of Persons (and other Snowflakes) written, in the same
+    order as the snowflakes of the Snapshot when loaded.
+    """
+    temp_path = path + ".tmp"
+    with io.open(temp_path, "wb") as file_:
+        file_.write(HEADER.pack(MAGIC, VERSION, 0))
+        writer = _Writer(file_)
+        index = {"datetime": datetime_, "byteorder": sys.byteorder}
+
+        index["state"] = writer.blob(writer.dumps(state))
+
+        # Persons known to the log must survive even if nothing in state
+        # refers to them, since later log entries may
+        log_pids = {}
+        if log is not None:
+            index["log_offset"] = log.tell()
+            for pid, obj in log.objects():
+                log_pids[writer.snowflake_id(obj)] = pid
+
+        # Each Snowflake's attributes may refer to yet more Snowflakes, which
+        # get appended to the list as we go
+        attrs = []
+        while len(attrs) < len(writer.snowflakes):
+            obj = writer.snowflakes[len(attrs)]
+            attrs.append(writer.dumps(obj.__dict__))
+        index["classes"] = writer.blob(writer.dumps(
+            [obj.__class__ for obj in writer.snowflakes]))
+        index["snowflakes"] = [writer.blob(data) for data in attrs]
+        index["log_pids"] = log_pids
+
+        index_offset = file_.tell()
+        file_.write(pickle.dumps(index, PROTOCOL))
+        file_.seek(0)
+        file_.write(HEADER.pack(MAGIC, VERSION, index_offset))
+
+    getattr(os, "replace", os.rename)(temp_path, path)
+    return writer.snowflakes
+
+
+class _Loader(Snowflake):
+    """Loads the containers of a MetaState from a snapshot. A Snowflake so
+    copies of a MetaState that hasn't loaded yet can share it (each load
+    returns new containers)."""
+
+    def __init__(self, snapshot, blob):
+        self.snapshot = snapshot
+        self.blob = blob
+
+    def __call__(self):
+        return self.snapshot.loads(self.blob)
+
+
+class Snapshot(object):
+    """An open snapshot file
+
+    Args:
+        path (str) - Path to the snapshot
+
+    Properties:
+        path (str) - As above
+        datetime (datetime) - Datetime of the last transaction in the state
+        log_offset (int) - Position in the table's log the snapshot was taken
+            at, or None if the table had no log
+        log_pids (list) - (Snowflake, persistent id) 2-tuples for each
+            Snowflake known to the table's log
+        snowflakes (list) - Persons and other Snowflakes in the snapshot
+    """
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, "rb") as file_:
+            self._mmap = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a cap table snapshot" % path)
+        if version != VERSION:
+            raise ValueError("%s has unsupported snapshot version %s" %
+                             (path, version))
+
+        index = pickle.loads(self._mmap[index_offset:])
+        self.datetime = index["datetime"]
+        self.log_offset = index.get("log_offset")
+        self._byteswap = index["byteorder"] != sys.byteorder
+        self._state = index["state"]
+
+        # Create every Snowflake before loading attributes, which may refer
+        # to each other
+        classes = self.loads(index["classes"])
+        self.snowflakes = [cls.__new__(cls) for cls in classes]
+        for obj, blob in zip(self.snowflakes, index["snowflakes"]):
+            obj.__dict__.update(self.loads(blob))
+        self.log_pids = [(self.snowflakes[i], pid)
+                         for i, pid in index["log_pids"].items()]
+
+    def state(self):
+        """Returns a new copy of the saved state. MetaStates load their
+        containers on first use."""
+        return self.loads(self._state)
+
+    def loads(self, blob):
+        """Unpickle the blob at (offset, length)"""
+        offset, length = blob
+        unpickler = pickle.Unpickler(
+            io.BytesIO(self._mmap[offset:offset + length]))
+        unpickler.persistent_load = self._persistent_load
+        with untracked():
+            return unpickler.load()
+
+    def _persistent_load(self, pid):
+        kind = pid[0]
+        if kind == SNOWFLAKE:
+            return self.snowflakes[pid[1]]
+
+        if kind == METASTATE:
+            _, owner, inline, blob = pid
+            ret = object.__new__(owner.MetaState)
+            ret.__dict__.update(inline)
+            ret.__dict__['_loader'] = _Loader(self, blob)
+            return ret
+
+        if kind == ARRAY:
+            _, typecode, itemsize, (offset, length) = pid
+            ret = array(typecode)
+            if ret.itemsize != itemsize:
+                raise ValueError("Array typecode %r has a different size on "
+                                 "this platform" % typecode)
+            data = self._mmap[offset:offset + length]
+            try:
+                ret.frombytes(data)
+            except AttributeError: # Python 2
+                ret.fromstring(data)
+            if self._byteswap:
+                ret.byteswap()
+            return ret
+
+        raise pickle.UnpicklingError("Unknown persistent id %r" % (pid,))
+
+    def close(self):
+        """Release the memory map. MetaStates that haven't loaded their
+        containers yet can no longer do so."""
+        self._mmap.close()
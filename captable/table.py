@@ -2,37 +2,420 @@
 """
 from __future__ import absolute_import
 
+from .diff import ChangeSet, Tracker, authorizations
+from .journal import Journal, StateDict, forked, untracked, writing
+from .locking import TableLock
 from .logger import logger
-from .validation import DEFAULT_VALIDATORS
-import copy
+from .observers import Timer, txn_name
+from .securities import RELATIONS_KEY, Security
+from . import snapshot
+from .transactions import Transaction
+from .validation import DEFAULT_VALIDATORS, Changes
+import bisect
 import datetime
+import functools
+import itertools
+import sys
+import threading
 
-class CapTable(object):
+
+# Kinds of log entries, see captable.persistence
+RECORD = "record"
+INSERT = "insert"
+
+
+class RecordError(Exception):
+    """Raised when an entry passed to CapTable.record_many fails
+
+    Properties:
+        index (int) - Position of the failed entry in the entries iterable
+        entry (tuple) - The failed entry, as a datetime followed by callables
+        error (Exception) - The exception raised while recording the entry
+    """
+    def __init__(self, index, entry, error):
+        super(RecordError, self).__init__(
+            "Entry %s failed: %r" % (index, error))
+        self.index = index
+        self.entry = entry
+        self.error = error
+
+
+def _writer(method):
+    """Decorator for CapTable methods that change or copy the table, which
+    hold the table's lock exclusively (see captable.locking). Views from
+    CapTable.committed are dropped afterwards, so the next call publishes a
+    new one."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwds):
+        with self._lock:
+            try:
+                return method(self, *args, **kwds)
+            finally:
+                self._committed = None
+    return wrapper
+
+
+class History(object):
+    """A list of a table's transactions (or their datetimes) that can be
+    forked without copying it. Entries present when the list is forked are
+    frozen into segments shared by both lists, and later entries go into a
+    list of their own.
+
+    Supports the list operations CapTable needs: len, indexing, slicing
+    (which returns a plain list), iteration, comparison, append and insert.
+    Segments can be any read-only sequence supporting those (see of).
+    """
+    # Forking flattens the segments into one once there are more than this
+    MAX_SEGMENTS = 16
+
+    def __init__(self, entries=()):
+        # Frozen lists shared with forks, and the index of each one's first
+        # entry
+        self._segments = ()
+        self._starts = ()
+        self._length = 0
+        self._own = list(entries)
+
+    @classmethod
+    def of(cls, segment):
+        """Returns a History starting with the entries of a read-only
+        sequence, e.g. part of a Ledger (see captable.ledger), without
+        copying them"""
+        ret = cls()
+        ret._segments, ret._starts = (segment,), (0,)
+        ret._length = len(segment)
+        return ret
+
+    def fork(self):
+        """Returns a new History with the same entries"""
+        if self._own:
+            self._segments += (self._own,)
+            self._starts += (self._length,)
+            self._length += len(self._own)
+            self._own = []
+            if len(self._segments) > self.MAX_SEGMENTS:
+                self._segments = (list(itertools.chain(*self._segments)),)
+                self._starts = (0,)
+        ret = History()
+        ret._segments, ret._starts = self._segments, self._starts
+        ret._length = self._length
+        return ret
+
+    def __len__(self):
+        return self._length + len(self._own)
+
+    def __iter__(self):
+        return itertools.chain(*(self._segments + (self._own,)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            ret = []
+            for first, segment in zip(self._starts + (self._length,),
+                                      self._segments + (self._own,)):
+                if stop <= first:
+                    break
+                if start < first + len(segment):
+                    ret.extend(segment[max(start - first, 0):stop - first])
+            return ret
+
+        if index < 0:
+            index += len(self)
+        if index >= self._length:
+            return self._own[index - self._length]
+        if index < 0:
+            raise IndexError("History index out of range")
+        i = bisect.bisect_right(self._starts, index) - 1
+        return self._segments[i][index - self._starts[i]]
+
+    def iterate(self, start=0, stop=None):
+        """Yields the entries from index start up to stop, like slicing but
+        without building a list"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first, segment in zip(self._starts + (self._length,),
+                                  self._segments + (self._own,)):
+            end = first + len(segment)
+            if end <= start or first >= stop:
+                continue
+            begin, end = max(start - first, 0), min(stop, end) - first
+            iterate = getattr(segment, "iterate", None)
+            if iterate is not None:
+                entries = iterate(begin, end)
+            else:
+                entries = itertools.islice(segment, begin, end)
+            for entry in entries:
+                yield entry
+
+    def append(self, entry):
+        self._own.append(entry)
+
+    def insert(self, index, entry):
+        if index < self._length:
+            # Segments are shared, so take a copy of everything
+            self._own = list(self)
+            self._segments = self._starts = ()
+            self._length = 0
+        self._own.insert(index - self._length, entry)
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "History(%r)" % list(self)
+
+
+class TableView(object):
+    """Access to a cap table's state at a particular point in time, for
+    queries. Returned by CapTable.as_of, and the base class for CapTable
+    itself.
+
+    Nothing stops changes to the state through a view, but they aren't
+    recorded as transactions, and may show up in other views and checkpoints
+    sharing the same objects. Record transactions on the table instead.
+
+    Args:
+        state (dict) - The state dict to query
+        datetime_ (datetime) - The datetime of the last transaction reflected
+            in state
+    """
+
+    def __init__(self, state, datetime_=None):
+        self.state = state
+        self._datetime = datetime_
+
+    @property
+    def datetime(self):
+        """What 'time' the state reflects"""
+        return self._datetime
+
+    def held_by(self, holder):
+        """Returns a dict mapping the name of each class of security to a
+        list of the live issuances of that class held by holder. Classes in
+        which holder has no issuances are omitted.
+        """
+        ret = {}
+        for name, metastate in self.state.get(Security.STATE_KEY, {}).items():
+            issuances = metastate.held_by(holder)
+            if issuances:
+                ret[name] = issuances
+        return ret
+
+    def shares_held(self, holder):
+        """Returns a dict mapping the name of each class of stock to the
+        number of outstanding shares of that class held by holder. Classes in
+        which holder has no shares are omitted.
+        """
+        ret = {}
+        for name, metastate in self.state.get(Security.STATE_KEY, {}).items():
+            if hasattr(metastate, "shares_held"):
+                amount = metastate.shares_held(holder)
+                if amount:
+                    ret[name] = amount
+        return ret
+
+    def __getitem__(self, key):
+        """Shortcut for accessing the table's current state dict. If the key
+        is an object with a '__table_key__' method, will pass current state to
+        method for returning an object
+
+        The object returned (e.g. a class's MetaState) is only current until
+        the next transaction is recorded, which may leave it to a checkpoint
+        or view and give the table a copy (see journal.forked). Look it up
+        again rather than holding on to it, and don't modify it outside of a
+        transaction.
+        """
+        if hasattr(key, '__table_key__'):
+            return key.__table_key__(self.state)
+        raise KeyError("%s does not have a '__table_key__' method" % repr(key))
+
+
+class CapTable(TableView):
     """Represents a cap table for a company. This is really a wrapper around
-    CapTableState that handles transactional changes to the table."""
+    CapTableState that handles transactional changes to the table.
+
+    Args:
+        validators (list) - Callables run on the state after each
+            transaction, defaults to DEFAULT_VALIDATORS
+        checkpoint_interval (int) - A copy of the state is kept every this
+            many transactions to speed up as_of queries. Pass None to disable
+            checkpoints.
+        max_checkpoints (int) - Maximum number of checkpoints to keep. This
+            is a count, not a size in bytes -- how much memory a checkpoint
+            takes depends on how much of the state changed since the one
+            before. When exceeded, every other checkpoint is dropped and the
+            checkpoint interval doubles. Pass None for no limit.
+        log (TransactionLog) - If provided, each entry is appended to this
+            log as it's recorded. See captable.persistence.
+        observer (callable) - If provided, called with an Event timing each
+            phase of recording. See captable.observers.
+        concurrent (bool) - If True, threads may record transactions on
+            different classes of securities at the same time. See record.
+        ledger (Ledger) - If provided, transactions are kept in this ledger
+            file rather than in memory, and the table starts from the state
+            after any transactions already in it. See captable.ledger.
 
-    def __init__(self, validators=DEFAULT_VALIDATORS):
+    Properties:
+        log (TransactionLog) - As above
+        observer (callable) - As above
+        concurrent (bool) - As above
+    """
+
+    def __init__(self, validators=DEFAULT_VALIDATORS,
+                 checkpoint_interval=1000, max_checkpoints=32, log=None,
+                 observer=None, concurrent=False, ledger=None):
         # List of 2-tuples containing the datetime and transaction of each
         # transaction successfully processed for this table
-        self.transactions = []
+        self.transactions = History()
 
         # A dict containing actual state data. All state information should
         # live here to make reversion easier.
-        self.state = {}
+        self.state = StateDict()
 
         # Validators are called after each transaction recording to verify
         # state. Note that validators are called after all transactions in
         # a multi-transaction have been called.
         self.validators = validators
 
+        # Datetimes of each transaction, kept separately for bisecting
+        self._datetimes = History()
+
+        # Sorted list of (number of transactions, state copy) 2-tuples used
+        # as starting points for as_of. Starts with the empty state.
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self._checkpoints = [(0, StateDict())]
+
+        self.log = log
+        self.observer = observer
+
+        # Set if the table starts from a snapshot rather than an empty state
+        self._snapshot = None
+
+        # Held by the thread recording transactions (see _writer), and the
+        # view of the last committed state handed out by committed
+        self._lock = TableLock()
+        self._committed = None
+
+        # With concurrent set, transactions on separate classes of securities
+        # share _lock, and lock the classes (by name) in _class_locks.
+        # _sequence hands out numbered tickets in order of datetime, and
+        # transactions commit in order of ticket. _admitted is the datetime
+        # of the last ticket, and _issued and _finished count the tickets
+        # handed out and the transactions that have committed or failed.
+        self.concurrent = concurrent
+        self._class_locks = {}
+        self._sequence = threading.Condition(threading.Lock())
+        self._admitted = None
+        self._issued = self._finished = 0
+
+        if ledger is not None:
+            # The ledger keeps the datetimes in step itself
+            self.transactions = ledger
+            self._datetimes = ledger.datetimes
+            # Replaying reads the file, if not read already
+            self._replay(ledger.replay(), stored=True)
+            if len(ledger):
+                self._validate(self.state)
+
+    @_writer
+    def fork(self, **kwds):
+        """Returns a new CapTable with the same history and state as this
+        one, e.g. to model a what-if scenario. The two tables share their
+        state until either changes it, and then only copy the parts changed
+        (see journal.forked), so a fork costs memory in proportion to what's
+        recorded on it rather than the size of the table.
+
+        Args:
+            kwds - Passed to the CapTable constructor. Defaults to this
+                table's validators, checkpoint settings, observer and
+                concurrent setting. The fork has no log unless one is
+                passed.
+        """
+        options = dict(validators=self.validators,
+                       checkpoint_interval=self.checkpoint_interval,
+                       max_checkpoints=self.max_checkpoints,
+                       observer=self.observer, concurrent=self.concurrent)
+        options.update(kwds)
+        ret = self.__class__(**options)
+        ret.state = forked(self.state)
+        ret.transactions = self.transactions.fork()
+        ret._datetimes = self._datetimes.fork()
+
+        # Checkpoints are never modified, so can simply be shared
+        ret._checkpoints = list(self._checkpoints)
+        ret._snapshot = self._snapshot
+        return ret
+
+    def committed(self):
+        """Returns a TableView of the state after the last
+        transaction committed, for querying from other threads while this
+        table goes on recording. Queries on the view need no locking and never
+        see transactions recorded later, in progress or rolled back.
+
+        Every caller gets the same view until the next commit. Creating one
+        forks the state (see fork), so costs little, and it's freed once
+        nothing refers to it. Only waits if a new view is needed while
+        another thread is recording.
+        """
+        view = self._committed
+        if view is None:
+            with self._lock:
+                view = self._committed
+                if view is None:
+                    view = TableView(forked(self.state), self.datetime)
+                    self._committed = view
+        return view
+
     @property
     def datetime(self):
         """What 'time' is the table currently at -- defaults to datetime of 
         last recorded transaction"""
         if self.transactions:
             return self.transactions[-1][0]
+        if self._snapshot is not None:
+            return self._snapshot.datetime
         return None
 
+    @_writer
+    def save_snapshot(self, path):
+        """Save the current state to a snapshot file at path. If the table
+        has a log, the log can later be replayed on top of the snapshot (see
+        captable.persistence.load).
+
+        Returns the list of Persons (and other Snowflakes) saved, see
+        snapshot.save.
+        """
+        return snapshot.save(path, self.state, self.datetime, self.log)
+
+    @classmethod
+    def load_snapshot(cls, path, **kwds):
+        """Returns a new CapTable starting from the state saved in the
+        snapshot file at path. The file is memory-mapped and read lazily.
+
+        The new table's transactions only include those recorded after the
+        snapshot, and as_of and insert are limited to datetimes on or after
+        the snapshot's.
+
+        Args:
+            path (str) - Path to the snapshot
+            kwds - Passed to the CapTable constructor
+        """
+        ret = cls(**kwds)
+        ret._snapshot = snapshot.Snapshot(path)
+        ret.state = ret._snapshot.state()
+        ret._checkpoints = [(0, ret._snapshot.state())]
+        return ret
+
     def record(self, datetime_, *txns):
         """Record a single transaction
 
@@ -44,50 +427,555 @@ class CapTable(object):
                 should return the new, modified state. If more than one
                 callable, will be recorded as a single transaction that all
                 succeed or fail together.
+
+        If the table is concurrent, transactions known to only touch certain
+        classes of securities -- Transactions returned by Security class
+        methods, or callables with a `classes` attribute listing the Security
+        classes they touch -- are recorded at the same time as those on other
+        classes in other threads. Each class is locked in order of name, and
+        the transactions commit in the order their record calls checked
+        their datetimes, which may not be older than any transaction being
+        recorded. If the table has related persons (see captable.relations)
+        they're locked as well, since any class's votes may change them.
+        Other transactions, and all validators that aren't incremental (see
+        captable.validation), wait for the whole table.
         """
+        if self.concurrent:
+            with self._lock.shared():
+                locks = self._locks_for(txns)
+                if locks is not None:
+                    self._record_shared(datetime_, txns, locks)
+            if locks is not None:
+                # Checkpoints copy the whole state, so wait until nothing
+                # else is being recorded
+                if self._checkpoint_due():
+                    with self._lock:
+                        self._checkpoint()
+                return
+        self._record_alone(datetime_, txns)
+
+    def _locks_for(self, txns):
+        """Returns the list of class locks to hold while recording txns at
+        the same time as other transactions, or None if they need the whole
+        table. Call while sharing the table lock."""
+        state = self.state
+        if not isinstance(dict.get(state, Security.STATE_KEY), StateDict):
+            return None
+        if not all(getattr(validate, "incremental", False)
+                   for validate in self.validators):
+            return None
+
+        names = set()
+        for txn in txns:
+            classes = getattr(txn, "classes", None)
+            if classes is None and isinstance(txn, Transaction):
+                classes = [txn.security]
+            if classes is None or not all(
+                    isinstance(cls, type) and issubclass(cls, Security)
+                    for cls in classes):
+                return None
+            names.update(cls.name for cls in classes)
+        names = sorted(names)
+        if RELATIONS_KEY in state:
+            names.append(None)
+
+        with self._sequence:
+            return [self._class_locks.setdefault(name, threading.Lock())
+                    for name in names]
+
+    def _record_shared(self, datetime_, txns, locks):
+        """Record txns while holding locks, allowing transactions on other
+        classes at the same time"""
+        for lock in locks:
+            lock.acquire()
+        try:
+            with self._sequence:
+                if self._issued > self._finished:
+                    current = self._admitted
+                else:
+                    current = self.datetime
+                datetime_ = self._check_entry(datetime_, txns, current)
+                ticket = self._issued
+                self._issued += 1
+                self._admitted = datetime_
+
+                # Other threads may access the securities dict at the same
+                # time, so stop sharing it with forks up front
+                with writing(), untracked():
+                    self.state.get(Security.STATE_KEY)
+
+            try:
+                self._record(datetime_, txns, lambda: self._turn(ticket))
+            finally:
+                self._turn(ticket)
+                with self._sequence:
+                    self._finished += 1
+                    self._committed = None
+                    self._sequence.notify_all()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _turn(self, ticket):
+        """Wait until every transaction with an earlier ticket has committed
+        or failed"""
+        with self._sequence:
+            while self._finished != ticket:
+                self._sequence.wait()
+
+    @_writer
+    def _record_alone(self, datetime_, txns):
+        self._record(datetime_, txns)
+
+    def _record(self, datetime_, txns, turn=None):
+        """Record a transaction. If turn is provided, the table lock is
+        shared, the datetime is already checked, and turn is called to wait
+        before committing. Otherwise the table lock is held exclusively."""
+        observer = self.observer
+        if observer is not None:
+            start = Timer()
+        shared = turn is not None
+        if not shared:
+            datetime_ = self._check_entry(datetime_, txns, self.datetime)
+
+        # Transactions modify state in place. The journal records how to undo
+        # each change so we can roll back if anything fails.
+        journal = Journal()
+        with journal:
+            try:
+                new_state = self._apply(datetime_, txns)
+                self._validate(new_state, self._changes(journal, new_state))
+                if turn is not None:
+                    # Earlier transactions on other classes commit (and
+                    # write their log entries) first
+                    turn()
+                    turn = None
+                data, stored = self._encode(RECORD, datetime_, txns)
+
+                # Write the log before committing, so the changes can still
+                # be undone if writing fails
+                if data:
+                    self.log.write(data)
+            except:
+                if observer is not None:
+                    counters = self._counters(journal, self.state)
+                    undo = Timer()
+                journal.rollback()
+                if turn is None:
+                    self._discard()
+                if observer is not None:
+                    observer(undo.event("rollback", **counters))
+                    observer(start.event("record", failed=True, **counters))
+                raise
+
+        # If txn succeeds, "commit" the return value as the new state
+        if observer is not None:
+            counters = self._counters(journal, new_state)
+            commit = Timer()
+        journal.commit()
+        self.state = new_state
+
+        # Record actual transactions and datetime as 2-tuple (or more if
+        # multiple transactions)
+        self._append((datetime_,) + txns, stored)
+        if not shared:
+            self._checkpoint()
+        if observer is not None:
+            observer(commit.event("commit"))
+            observer(start.event("record", failed=False, **counters))
+
+    @_writer
+    def record_many(self, entries, deferred=False, batch_size=1000):
+        """Record a series of transactions, e.g. when loading a ledger
+
+        Args:
+            entries (iterable) - Iterable (e.g. a generator) of entries in
+                chronological order. Each entry is either a (datetime, txns)
+                2-tuple where txns is a list of callables, or a tuple in the
+                same format as the transactions attribute, i.e. a datetime
+                followed by one or more callables. Each entry is treated as
+                a single transaction as with record.
+            deferred (bool) - If False, validators are run after every entry.
+                If True, validators are run once per batch. If the batch
+                fails, it is rolled back and re-processed one entry at a time
+                to find the entry at fault, so transactions must be safe to
+                call more than once.
+            batch_size (int) - Number of entries per batch in deferred mode
+
+        Returns the number of entries recorded. If an entry fails, entries
+        before it remain recorded and a RecordError is raised.
+        """
+        count = 0
+        batch = []
+        for entry in entries:
+            if len(entry) == 2 and not callable(entry[1]):
+                entry = (entry[0],) + tuple(entry[1])
+            batch.append(entry)
+            if not deferred or len(batch) >= batch_size:
+                self._record_batch(count, batch, deferred)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._record_batch(count, batch, deferred)
+            count += len(batch)
+        return count
+
+    def _record_batch(self, start, batch, deferred):
+        """Record a list of entries for record_many. start is the index of
+        the first entry in the batch."""
+        if deferred:
+            observer = self.observer
+            if observer is not None:
+                timer = Timer()
+            journal = Journal()
+            with journal:
+                try:
+                    last = self.datetime
+                    new_state = self.state
+                    recorded = []
+                    encoded = []
+                    for entry in batch:
+                        datetime_ = self._check_entry(entry[0], entry[1:], last)
+                        self.state = self._apply(datetime_, entry[1:])
+                        recorded.append((datetime_,) + entry[1:])
+                        encoded.append(self._encode(RECORD, datetime_,
+                                                    entry[1:]))
+                        last = datetime_
+                    self._validate(self.state,
+                                   self._changes(journal, self.state))
+                    if self.log is not None:
+                        self.log.write([data for data, _ in encoded])
+                    new_state = self.state
+                except:
+                    if observer is not None:
+                        counters = self._counters(journal, self.state)
+                        undo = Timer()
+                    journal.rollback()
+                    self._discard()
+                    recorded = None
+                    if observer is not None:
+                        observer(undo.event("rollback", **counters))
+                        observer(timer.event("record", failed=True,
+                                             entries=len(batch), **counters))
+                    # Retry one at a time below, unless interrupted
+                    if not isinstance(sys.exc_info()[1], Exception):
+                        raise
+                finally:
+                    self.state = new_state
+
+            if recorded is not None:
+                if observer is not None:
+                    counters = self._counters(journal, new_state)
+                    commit = Timer()
+                journal.commit()
+                for entry, (_, stored) in zip(recorded, encoded):
+                    self._append(entry, stored)
+                self._checkpoint()
+                if observer is not None:
+                    observer(commit.event("commit"))
+                    observer(timer.event("record", failed=False,
+                                         entries=len(batch), **counters))
+                return
+
+        # Record one at a time to isolate failures
+        for index, entry in enumerate(batch):
+            try:
+                self.record(*entry)
+            except Exception as e:
+                raise RecordError(start + index, entry, e)
+
+    @_writer
+    def _replay(self, entries, stored=False):
+        """Record entries that were already validated when first recorded,
+        e.g. entries read back from a log. Skips the journal and validators,
+        so if an entry fails the table is left part way through it.
+
+        If stored is True, entries are the table's transactions (e.g. a
+        ledger read back from disk) and are only applied to the state."""
+        with untracked():
+            if stored:
+                for count, entry in enumerate(entries, 1):
+                    self.state = self._apply(entry[0], entry[1:])
+                    self._checkpoint(count)
+                return
+            for entry in entries:
+                txns = entry[1:]
+                datetime_ = self._check_entry(entry[0], txns, self.datetime)
+                self.state = self._apply(datetime_, txns)
+                self._append((datetime_,) + txns)
+                self._checkpoint()
+
+    def _check_entry(self, datetime_, txns, current):
+        """Validates the arguments for recording txns at datetime_ after a
+        transaction at current. Returns the datetime to record at."""
         if len(txns) == 0:
             raise ValueError("Must provide at least one transaction")
 
         if not datetime_:
             datetime_ = datetime.datetime.now()
 
-        current = self.datetime
         if current and current > datetime_:
             raise ValueError("Cannot record transaction older that current "
                 "captable state. Current datetime is %s, record call was for "
                 "%s" % (repr(current), repr(datetime_)))
+        return datetime_
 
-        # When processing transactions, pass a copy of state to simplify the 
-        # commit/rollback process.
-        new_state = copy.deepcopy(self.state)
+    def _checkpoint_due(self, count=None):
+        interval = self.checkpoint_interval
+        if count is None:
+            count = len(self.transactions)
+        return bool(interval) and count - self._checkpoints[-1][0] >= interval
 
-        # Process all transactions. 
-        for txn in txns:
-            if not callable(txn):
-                raise ValueError("Transaction must be callable")
+    def _checkpoint(self, count=None):
+        """Copy the current state into the list of checkpoints if due. count
+        is the number of transactions the state reflects, by default all of
+        them."""
+        if count is None:
+            count = len(self.transactions)
+        if not self._checkpoint_due(count):
+            return
+        self._checkpoints.append((count, forked(self.state)))
+        self._thin_checkpoints()
 
-            new_state = txn(datetime_, new_state)
+    def _thin_checkpoints(self):
+        """While there are too many checkpoints, thin out every other one
+        (keeping the empty one) and double the interval"""
+        limit = self.max_checkpoints
+        while limit and len(self._checkpoints) > limit:
+            self.checkpoint_interval *= 2
+            self._checkpoints = self._checkpoints[::2]
 
-            # Make sure transaction remembered to return new state state
-            if new_state == None:
-                raise RuntimeError("Transaction did not return new state data")
+    def as_of(self, datetime_):
+        """Returns a TableView of the state of this table after all
+        transactions at or before datetime_. The state is rebuilt by replaying
+        transactions from the nearest earlier checkpoint.
+        """
+        count = self._count_at(datetime_)
+        start = self._snapshot and self._snapshot.datetime
+        if not count and start:
+            if datetime_ < start:
+                raise ValueError("Table starts from a snapshot at %r" % start)
+            return TableView(self._state_at(0), start)
+        state = self._state_at(count)
+        return TableView(state, self._datetimes[count - 1] if count else None)
 
-        # Validate the new state
-        for validate in self.validators:
-            validate(new_state)
+    def diff(self, start, end):
+        """Returns a ChangeSet describing what changed between the state as of
+        start and the state as of end (see as_of): the certificates issued,
+        transferred and cancelled by transactions after start up to and
+        including end, and the changes in each class's authorized amount.
 
-        # If txn succeeds, "commit" the return value as the new state
-        self.state = new_state
+        Only the transactions in between are replayed (from the nearest
+        checkpoint at or before start), so the cost depends on how much
+        changed rather than on the size of the table. See captable.diff.
+        """
+        if end < start:
+            raise ValueError("End %r is before start %r" % (end, start))
+        first, last = self._count_at(start), self._count_at(end)
+        begin = self._snapshot and self._snapshot.datetime
+        if not first and begin and start < begin:
+            raise ValueError("Table starts from a snapshot at %r" % begin)
 
-        # Record actual transactions and datetime as 2-tuple (or more if
-        # multiple transactions)
-        self.transactions.append((datetime_,) + txns)
+        replay = CapTable(validators=[], checkpoint_interval=None)
+        replay.state = self._state_at(first)
+        before = authorizations(replay.state.get(Security.STATE_KEY, {}))
+        with Tracker() as track:
+            for entry in self.transactions.iterate(first, last):
+                replay.state = replay._apply(entry[0], entry[1:])
+        securities = replay.state.get(Security.STATE_KEY, {})
+        after = authorizations(securities)
+        authorized = dict((name, (before.get(name), amount))
+                          for name, amount in after.items()
+                          if name not in before or before[name] != amount)
+        return ChangeSet(start, end, track.changes(securities), authorized)
 
-    def __getitem__(self, key):
-        """Shortcut for accessing the table's current state dict. If the key
-        is an object with a '__table_key__' method, will pass current state to
-        method for returning an object
+    @_writer
+    def insert(self, datetime_, *txns):
+        """Record a transaction that may be older than the current datetime,
+        e.g. a late-discovered board consent. The transaction is placed after
+        any existing transactions with the same datetime, and every later
+        transaction is replayed (and validated) on top of it. The table is
+        only updated if all of them succeed.
+
+        Args are the same as for record. Raises whatever exception the new
+        transaction raises, or a RecordError (with index set to the position
+        in the transactions attribute the failing transaction would have
+        had) if a later transaction now fails.
         """
-        if hasattr(key, '__table_key__'):
-            return key.__table_key__(self.state)
-        raise KeyError("%s does not have a '__table_key__' method" % repr(key))
+        if not datetime_:
+            return self.record(datetime_, *txns)
+
+        position = self._count_at(datetime_)
+        if position == len(self.transactions):
+            return self.record(datetime_, *txns)
+        if position:
+            previous = self._datetimes[position - 1]
+        else:
+            previous = self._snapshot and self._snapshot.datetime
+        datetime_ = self._check_entry(datetime_, txns, previous)
+
+        # Replay on a copy of the state just before the insert, rebuilt from
+        # the nearest earlier checkpoint. The replay takes checkpoints where
+        # this table would have, counting from the last one kept.
+        kept = [c for c in self._checkpoints if c[0] <= position]
+        replay = CapTable(validators=self.validators,
+                          checkpoint_interval=self.checkpoint_interval,
+                          max_checkpoints=None)
+        replay._checkpoints = [(kept[-1][0] - position, None)]
+        replay.state = self._state_at(position)
+        replay.record(datetime_, *txns)
+        for index, entry in enumerate(self.transactions.iterate(position)):
+            try:
+                replay.record(*entry)
+            except Exception as e:
+                raise RecordError(position + index + 1, entry, e)
+        data = self._encode(INSERT, datetime_, txns)[0]
+
+        # Everything succeeded, so log the entry and swap in the new history
+        # and state. Later checkpoints no longer reflect the history, so are
+        # replaced by the replay's. A ledger rewrites its file to insert, so
+        # does so before the state changes in case that fails.
+        if data:
+            try:
+                self.log.write(data)
+            except:
+                self._discard()
+                raise
+        self.transactions.insert(position, (datetime_,) + txns)
+        self._datetimes.insert(position, datetime_)
+        self.state = replay.state
+        self._checkpoints = kept + [(position + count, state) for count, state
+                                    in replay._checkpoints[1:]]
+        self._thin_checkpoints()
+        self._checkpoint()
+
+    def _count_at(self, datetime_):
+        """Number of transactions at or before datetime_"""
+        datetimes = self._datetimes
+        bisect_right = getattr(datetimes, "bisect_right", None)
+        if bisect_right is not None:
+            return bisect_right(datetime_)
+        return bisect.bisect_right(datetimes, datetime_)
+
+    def _state_at(self, count):
+        """Returns a new copy of the state after the first count transactions,
+        replayed from the nearest earlier checkpoint"""
+        index = bisect.bisect_left(self._checkpoints, (count + 1,)) - 1
+        start, state = self._checkpoints[index]
+        state = forked(state)
+
+        # Transactions were validated when first recorded, so skip validators
+        replay = CapTable(validators=[], checkpoint_interval=None)
+        replay.state = state
+        for entry in self.transactions.iterate(start, count):
+            replay.state = replay._apply(entry[0], entry[1:])
+        return replay.state
+
+    def _apply(self, datetime_, txns):
+        """Process and validate transactions against the current state.
+        Changes are made in place, so callers should activate a Journal if
+        they need to be able to roll back. Returns the new state but does not
+        run validators."""
+        new_state = self.state
+        observer = self.observer
+
+        # Process all transactions. 
+        with writing():
+            for txn in txns:
+                if not callable(txn):
+                    raise ValueError("Transaction must be callable")
+
+                if observer is None:
+                    new_state = txn(datetime_, new_state)
+                else:
+                    start = Timer()
+                    try:
+                        new_state = txn(datetime_, new_state)
+                    finally:
+                        observer(start.event("txn", txn_name(txn)))
+
+                # Make sure transaction remembered to return new state state
+                if new_state == None:
+                    raise RuntimeError(
+                        "Transaction did not return new state data")
+
+                # Transactions that build a brand new state dict get wrapped so
+                # later transactions are still tracked
+                if not isinstance(new_state, StateDict):
+                    new_state = StateDict(new_state)
+
+        return new_state
+
+    def _encode(self, kind, datetime_, txns):
+        """Returns a (log data, ledger data) 2-tuple for an entry. Either is
+        None if there's no log, or the transactions aren't kept in a ledger
+        (which only stores RECORD entries this way). Encoding before
+        committing means an entry that can't be pickled rolls back."""
+        data = stored = None
+        if self.log is not None:
+            data = self.log.encode(kind, datetime_, txns)
+        encode = getattr(self.transactions, "encode", None)
+        if encode is not None and kind == RECORD:
+            stored = encode((datetime_,) + tuple(txns))
+        return data, stored
+
+    def _discard(self):
+        """Abandon log and ledger data encoded for entries that failed"""
+        if self.log is not None:
+            self.log.discard()
+        discard = getattr(self.transactions, "discard", None)
+        if discard is not None:
+            discard()
+
+    def _append(self, entry, stored=None):
+        """Add a recorded entry to the history. stored is the ledger data
+        _encode returned for it, if any."""
+        if stored is None:
+            self.transactions.append(entry)
+        else:
+            self.transactions.append(entry, stored)
+        self._datetimes.append(entry[0])
+
+    def _counters(self, journal, state):
+        """Returns a dict of counters describing a transaction's changes for
+        observers"""
+        return {
+            "journal_entries": len(journal.entries),
+            "copied": sum(len(keys) for keys in journal.copied.values()),
+            "touched": len(journal.touched.get(id(state), ())),
+            "state_keys": len(state)
+        }
+
+    def _changes(self, journal, state):
+        """Returns a Changes instance describing what was touched in state
+        while journal was active"""
+        keys = journal.touched.get(id(state), set())
+        securities = dict.get(state, Security.STATE_KEY)
+        if isinstance(securities, StateDict):
+            securities = set(journal.touched.get(id(securities), ()))
+        else:
+            securities = None
+        return Changes(set(keys), securities)
+
+    def _validate(self, state, changes=None):
+        """Run validators against state. If changes is provided, validators
+        that declare their dependencies only check what changed."""
+        observer = self.observer
+        for validate in self.validators:
+            if changes is not None:
+                depends_on = getattr(validate, "depends_on", None)
+                if depends_on is not None and \
+                        changes.keys.isdisjoint(depends_on):
+                    continue
+
+            if observer is not None:
+                start = Timer()
+            try:
+                if changes is not None and \
+                        getattr(validate, "incremental", False):
+                    validate(state, changes)
+                else:
+                    validate(state)
+            finally:
+                if observer is not None:
+                    observer(start.event("validator", txn_name(validate)))
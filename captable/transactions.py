@@ -0,0 +1,56 @@
+"""Serializable transactions.
+
+A transaction is any callable accepting a datetime and a state dict and
+returning the modified state. The transactions returned by Security class
+methods (e.g. `CommonStock.issue(...)`) are Transaction instances -- named
+records of an operation on a class of securities and its arguments -- rather
+than closures, so they can be compared, inspected and pickled (e.g. to persist
+a table's history, see captable.persistence).
+
+Other classes keeping state in a table (e.g. captable.relations.Relations)
+return Transactions the same way.
+
+Pickling a Transaction pickles its Security class by reference, so the class
+must be importable (i.e. defined at module level).
+"""
+from __future__ import absolute_import
+
+
+class Transaction(object):
+    """A named operation on a class of securities. Calling it with a datetime
+    and state calls the `_<name>` classmethod of the security class with the
+    datetime, state and any stored arguments.
+
+    Args:
+        security (class) - The Security class
+        name (str) - Name of the operation, e.g. "issue"
+        args, kwds - Arguments for the operation
+
+    Properties:
+        security, name, args (tuple), kwds (dict) - As above
+    """
+    def __init__(self, security, name, *args, **kwds):
+        self.security = security
+        self.name = name
+        self.args = args
+        self.kwds = kwds
+
+    def __call__(self, datetime_, state):
+        return getattr(self.security, "_" + self.name)(
+            datetime_, state, *self.args, **self.kwds)
+
+    def __eq__(self, other):
+        return (isinstance(other, Transaction) and
+                (self.security, self.name, self.args, self.kwds) ==
+                (other.security, other.name, other.args, other.kwds))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        params = [repr(a) for a in self.args]
+        params += ["%s=%r" % (k, v) for k, v in sorted(self.kwds.items())]
+        return "%s.%s(%s)" % (self.security.__name__, self.name,
+                              ", ".join(params))
@@ -5,17 +5,64 @@ each transaction during CapTable processing.
 Validators are not intended to be the *sole* source of ensuring cap table
 correctness. Transactions may do some validation themselves and may refuse to 
 process or process differently if things don't check out.
+
+A validator is simply called with the state after each transaction. To avoid
+re-checking parts of the state that a transaction did not touch, a validator
+may also be declared with the `validator` decorator:
+
+* `depends_on` lists the top-level state keys the validator looks at. The
+  validator is skipped if none of them were touched.
+* If `incremental` is True, the validator is called with a Changes instance
+  as a second argument describing what was touched.
 """
 from __future__ import absolute_import
 from .securities import Security
 
-def check_auth(state):
+
+class Changes(object):
+    """Describes which parts of a table's state a transaction may have changed.
+    Anything a transaction accessed is treated as changed.
+
+    Properties:
+        keys (set) - Top-level state keys touched
+        securities (set) - Names of the classes of securities touched, or None
+            if unknown (in which case all classes should be checked)
+    """
+    def __init__(self, keys, securities=None):
+        self.keys = keys
+        self.securities = securities
+
+
+def validator(depends_on=None, incremental=False):
+    """Decorator declaring the state keys a validator depends on and whether
+    it accepts a Changes instance"""
+    def decorator(func):
+        func.depends_on = depends_on
+        func.incremental = incremental
+        return func
+    return decorator
+
+
+@validator(depends_on=[Security.STATE_KEY], incremental=True)
+def check_auth(state, changes=None):
     """Check the SecuritiesState and makes sure amounts add up"""
-    for name, metastate in state.get(Security.STATE_KEY, {}).iteritems():
+    securities = state.get(Security.STATE_KEY, {})
+    if changes is None or changes.securities is None:
+        names = list(securities.keys())
+    else:
+        names = changes.securities
+    for name in names:
+        metastate = securities.get(name)
         if hasattr(metastate, "authorized") and hasattr(metastate, "issued"):
             assert metastate.authorized >= metastate.issued, (
                 name + " Warning: " + str(metastate.issued) + 
                 " issued but only " + str(metastate.authorized) + " authorized"
             )
+            reserved = getattr(metastate, "reserved", 0)
+            assert metastate.authorized >= metastate.issued + reserved, (
+                name + " Warning: " + str(metastate.issued) + " issued and " +
+                str(reserved) + " reserved but only " +
+                str(metastate.authorized) + " authorized"
+            )
 
-DEFAULT_VALIDATORS = [check_auth]
\ No newline at end of file
+DEFAULT_VALIDATORS = [check_auth]
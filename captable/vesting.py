@@ -0,0 +1,288 @@
+"""Vesting schedules for Stock issuances, and tables answering how many shares
+have vested on any date.
+
+A Schedule is attached to an issuance when it's issued:
+
+    CommonStock.issue(holder=person, amount=48000,
+                      vesting=Schedule(start, months=48, cliff=12))
+
+Each installment vests the shares accrued (pro rata by month) since the last
+one, and nothing vests before the cliff. An acceleration trigger (see
+Stock.accelerate) immediately vests a fraction of the then unvested shares,
+with later installments shrinking to match.
+
+A VestingTable compiles every schedule in a table into a cumulative step
+function per holder, stored as parallel arrays of date ordinals and vested
+share counts. Queries are then a bisect per holder rather than a walk through
+each issuance's schedule.
+"""
+from __future__ import absolute_import
+
+from array import array
+import bisect
+import calendar
+import datetime
+
+from .columnar import INT64
+from .securities import Security
+
+
+def _ordinal(value):
+    """Day number of a date or datetime"""
+    return value.toordinal()
+
+
+def _add_months(date, months):
+    """Returns date plus a number of months, clamping the day to the end of
+    shorter months"""
+    year, month = divmod(date.month - 1 + months, 12)
+    year += date.year
+    day = min(date.day, calendar.monthrange(year, month + 1)[1])
+    return datetime.date(year, month + 1, day)
+
+
+class Schedule(object):
+    """Terms on which an issuance vests. Schedules are immutable and compared
+    by value, so one instance can be shared by many issuances.
+
+    Args:
+        start (date) - Vesting commencement date. If None, vesting starts on
+            the date of issuance.
+        months (int) - Months until fully vested
+        cliff (int) - Months before anything vests. The first installment on
+            or after the cliff vests everything accrued so far.
+        every (int) - Months between installments, e.g. 1 for monthly or 3
+            for quarterly vesting. If months isn't a multiple, the last
+            installment is shorter.
+        triggers (dict) - Maps the name of each acceleration trigger (e.g.
+            "change_of_control") to the fraction of unvested shares it vests
+
+    Properties:
+        start, months, cliff, every - As above
+        triggers (dict) - As above, or an empty dict
+        offsets (tuple) - Months after start of each installment
+    """
+    def __init__(self, start=None, months=48, cliff=0, every=1,
+                 triggers=None):
+        if months < 0 or cliff < 0 or cliff > months:
+            raise ValueError("Need 0 <= cliff <= months")
+        if every < 1:
+            raise ValueError("Need at least one month between installments")
+        triggers = dict(triggers or {})
+        for name, fraction in triggers.items():
+            if not 0 < fraction <= 1:
+                raise ValueError("Trigger %r must vest a fraction between 0 "
+                                 "and 1" % name)
+
+        self.start = start
+        self.months = months
+        self.cliff = cliff
+        self.every = every
+        self.triggers = triggers
+
+        offsets = list(range(every, months + 1, every))
+        if not offsets or offsets[-1] != months:
+            offsets.append(months)
+        self.offsets = tuple(m for m in offsets if m >= cliff)
+
+        # Maps start ordinals to installment ordinals. Not part of the value.
+        self._ordinals = {}
+
+    def _key(self):
+        return (self.start, self.months, self.cliff, self.every,
+                tuple(sorted(self.triggers.items())))
+
+    def __eq__(self, other):
+        return isinstance(other, Schedule) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "Schedule(%r, months=%r, cliff=%r, every=%r, triggers=%r)" % (
+            self.start, self.months, self.cliff, self.every, self.triggers)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        ret = self.__dict__.copy()
+        del ret['_ordinals']
+        return ret
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ordinals = {}
+
+    def ordinals(self, start):
+        """Returns the date ordinal of each installment for a schedule
+        starting on start"""
+        start_ordinal = _ordinal(start)
+        ret = self._ordinals.get(start_ordinal)
+        if ret is None:
+            start = datetime.date.fromordinal(start_ordinal)
+            ret = self._ordinals[start_ordinal] = [
+                _add_months(start, m).toordinal() for m in self.offsets]
+        return ret
+
+    def steps(self, amount, issued_on=None, accelerations=()):
+        """Returns a list of (date ordinal, cumulative vested shares)
+        2-tuples, one for each day on which shares of an issuance vest
+
+        Args:
+            amount (int) - Shares in the issuance
+            issued_on (date) - Date of issuance, used if the schedule has no
+                start
+            accelerations (tuple) - (datetime, trigger name) 2-tuples, as
+                recorded by Stock.accelerate
+        """
+        ordinals = self.ordinals(self.start or issued_on)
+        months = self.months
+        if not months:
+            base = [amount] * len(ordinals)
+        else:
+            base = [amount * m // months for m in self.offsets]
+        if not accelerations:
+            return list(zip(ordinals, base))
+
+        # After an acceleration, the shares still unvested vest in
+        # proportion to what the schedule alone would have vested since
+        events = sorted((_ordinal(datetime_), self.triggers[trigger])
+                        for datetime_, trigger in accelerations)
+        ret = []
+        base_from = vested_from = 0
+        vested = current = 0
+        i = j = 0
+        while i < len(ordinals) or j < len(events):
+            # Installments on the same day as an acceleration come first
+            if j == len(events) or (i < len(ordinals) and
+                                    ordinals[i] <= events[j][0]):
+                ordinal, current = ordinals[i], base[i]
+                vested = vested_from + (
+                    (amount - vested_from) * (current - base_from) //
+                    (amount - base_from) if amount > base_from else 0)
+                i += 1
+            else:
+                ordinal, fraction = events[j]
+                vested += int(fraction * (amount - vested))
+                base_from, vested_from = current, vested
+                j += 1
+            if ret and ret[-1][0] == ordinal:
+                ret[-1] = (ordinal, vested)
+            else:
+                ret.append((ordinal, vested))
+        return ret
+
+
+def steps(issuance):
+    """Returns the (date ordinal, cumulative vested shares) steps for an
+    issuance. Issuances without a schedule vest in full when issued."""
+    schedule = issuance.vesting
+    if schedule is None:
+        issued_on = issuance.issued_on
+        return [(_ordinal(issued_on) if issued_on else 1, issuance.amount)]
+    return schedule.steps(issuance.amount, issuance.issued_on,
+                          issuance.accelerations)
+
+
+def _compile(deltas):
+    """Returns arrays of sorted date ordinals and cumulative totals for a
+    dict mapping ordinals to changes"""
+    ordinals = sorted(deltas)
+    cumulative = []
+    total = 0
+    for ordinal in ordinals:
+        total += deltas[ordinal]
+        cumulative.append(total)
+    return array('i', ordinals), array(INT64, cumulative)
+
+
+class VestingTable(object):
+    """Vested shares of each holder on any date, for the live (uncancelled,
+    non-treasury) issuances in a table
+
+    Args:
+        view (TableView) - The table (or a view from as_of) to compile.
+            Issuances are attributed to their current holders.
+        classes (list) - Stock classes to include. Defaults to all of them.
+
+    Properties:
+        amounts (dict) - Maps each holder to the total shares covered
+    """
+    def __init__(self, view, classes=None):
+        names = None if classes is None else set(c.name for c in classes)
+        deltas = {}
+        self.amounts = {}
+        for name, metastate in view.state.get(Security.STATE_KEY, {}).items():
+            if getattr(metastate, "holder_amounts", None) is None:
+                continue
+            if names is not None and name not in names:
+                continue
+            for holder in metastate.holders:
+                held = deltas.get(holder)
+                if held is None:
+                    held = deltas[holder] = {}
+                    self.amounts[holder] = 0
+                for issuance in metastate.held_by(holder):
+                    self.amounts[holder] += issuance.amount
+                    previous = 0
+                    for ordinal, vested in steps(issuance):
+                        held[ordinal] = held.get(ordinal, 0) + \
+                            vested - previous
+                        previous = vested
+
+        # Every holder's steps are concatenated into one pair of arrays, with
+        # _ranges giving each holder's slice
+        self._ordinals = array('i')
+        self._vested = array(INT64)
+        self._ranges = {}
+        totals = {}
+        for holder, held in deltas.items():
+            ordinals, vested = _compile(held)
+            start = len(self._ordinals)
+            self._ordinals.extend(ordinals)
+            self._vested.extend(vested)
+            self._ranges[holder] = (start, len(self._ordinals))
+            for ordinal, delta in held.items():
+                totals[ordinal] = totals.get(ordinal, 0) + delta
+        self._total_ordinals, self._total_vested = _compile(totals)
+
+    def _vested_on(self, ordinal, holder):
+        lo, hi = self._ranges.get(holder, (0, 0))
+        i = bisect.bisect_right(self._ordinals, ordinal, lo, hi)
+        return self._vested[i - 1] if i > lo else 0
+
+    def vested(self, on, holder=None):
+        """Shares vested on (and including) a date. Returns an int for a
+        single holder, or a dict mapping every holder to shares vested."""
+        ordinal = _ordinal(on)
+        if holder is not None:
+            return self._vested_on(ordinal, holder)
+        return dict((h, self._vested_on(ordinal, h)) for h in self._ranges)
+
+    def unvested(self, on, holder=None):
+        """Shares not yet vested on a date, as for vested"""
+        if holder is not None:
+            return self.amounts.get(holder, 0) - self.vested(on, holder)
+        return dict((h, self.amounts[h] - vested)
+                    for h, vested in self.vested(on).items())
+
+    def vesting_between(self, start, end, holder=None):
+        """Shares vesting after start, up to and including end. Returns an
+        int for a single holder, or a dict mapping every holder to shares."""
+        if holder is not None:
+            return self.vested(end, holder) - self.vested(start, holder)
+        start, end = _ordinal(start), _ordinal(end)
+        return dict((h, self._vested_on(end, h) - self._vested_on(start, h))
+                    for h in self._ranges)
+
+    def total(self, on):
+        """Shares vested across all holders on a date"""
+        i = bisect.bisect_right(self._total_ordinals, _ordinal(on))
+        return self._total_vested[i - 1] if i else 0
@@ -0,0 +1,197 @@
+"""Liquidation waterfall analysis -- how the proceeds of a sale or
+liquidation are distributed among the classes of stock and their holders.
+
+Each Stock class's liquidation terms are attributes of its MetaState:
+LIQUIDATION_PREFERENCE, SENIORITY, PARTICIPATING, PARTICIPATION_CAP and
+CONVERSION_RATIO (see Stock.MetaState). Proceeds are distributed as follows:
+
+1. Preferences are paid in order of seniority, pro rata among classes of the
+   same seniority.
+2. Anything left is shared among common stock, participating classes and
+   classes that convert, in proportion to their as-converted shares.
+   Participating classes stop participating once they reach their cap.
+3. Each non-participating (or capped) class converts to common if that pays
+   more than its preference (or cap).
+
+Every class's payout is a piecewise linear function of the exit value. A
+Waterfall works out the pieces once, so each exit value is then evaluated
+with a bisect and a multiply-add per class. This makes it cheap to compute
+payout curves over thousands of exit values.
+"""
+from __future__ import absolute_import, division
+
+import bisect
+
+from .securities import Security
+
+
+def _per_share(metastate, price):
+    """Returns (fixed, ratio) such that a share of metastate's class is paid
+    fixed + ratio * price when each as-converted common share gets price
+    from the remaining proceeds"""
+    preference = metastate.LIQUIDATION_PREFERENCE
+    ratio = metastate.CONVERSION_RATIO
+    cap = metastate.PARTICIPATION_CAP
+    converted = ratio * price
+    if metastate.PARTICIPATING:
+        if cap is None or preference + converted < cap:
+            return preference, ratio
+        if converted > cap:
+            return 0, ratio
+        return cap, 0
+    if converted > preference:
+        return 0, ratio
+    return preference, 0
+
+
+def _price_breakpoints(metastate):
+    """Prices per common share at which metastate's class changes how it's
+    paid"""
+    preference = metastate.LIQUIDATION_PREFERENCE
+    ratio = metastate.CONVERSION_RATIO
+    cap = metastate.PARTICIPATION_CAP
+    if not ratio:
+        return []
+    if metastate.PARTICIPATING:
+        if cap is None:
+            return []
+        return [(cap - preference) / ratio, cap / ratio]
+    return [preference / ratio] if preference else []
+
+
+class Waterfall(object):
+    """Distribution of proceeds among the classes of stock in a table
+
+    Args:
+        view (TableView) - The table (or a view from as_of) to analyze
+
+    Properties:
+        names (list) - Names of the classes of stock
+        shares (list) - Outstanding shares of each class
+        starts (list) - Exit values at which each piece of the payout
+            functions starts
+        pieces (list) - For each piece, a list of (fixed, rate) 2-tuples such
+            that the corresponding class is paid fixed + rate * exit value
+    """
+    def __init__(self, view):
+        self.names = []
+        self.shares = []
+        self._metastates = []
+        self._holder_amounts = []
+        for name, metastate in sorted(
+                view.state.get(Security.STATE_KEY, {}).items()):
+            if not hasattr(metastate, "LIQUIDATION_PREFERENCE"):
+                continue
+            self.names.append(name)
+            self.shares.append(metastate.outstanding)
+            self._metastates.append(metastate)
+            self._holder_amounts.append(metastate.holder_amounts)
+
+        self.starts = []
+        self.pieces = []
+        self._preference_pieces()
+        self._participation_pieces()
+
+    def _add(self, start, piece):
+        self.starts.append(start)
+        self.pieces.append(piece)
+
+    def _preference_pieces(self):
+        """Pieces for exit values below the total of all preferences"""
+        tiers = {}
+        for index, metastate in enumerate(self._metastates):
+            amount = self.shares[index] * metastate.LIQUIDATION_PREFERENCE
+            if amount:
+                tiers.setdefault(metastate.SENIORITY, []).append(
+                    (index, amount))
+
+        paid = [0] * len(self.names)
+        total = 0
+        for seniority in sorted(tiers, reverse=True):
+            tier = tiers[seniority]
+            tier_total = sum(amount for index, amount in tier)
+
+            # Within the tier, each class gets its share of the proceeds
+            # beyond what's paid to more senior classes
+            piece = [(fixed, 0) for fixed in paid]
+            for index, amount in tier:
+                weight = amount / tier_total
+                piece[index] = (-total * weight, weight)
+                paid[index] = amount
+            self._add(total, piece)
+            total += tier_total
+
+    def _participation_pieces(self):
+        """Pieces for exit values at or above the total of all preferences,
+        found by working in terms of the price per as-converted common share
+        paid from the remaining proceeds"""
+        prices = set([0])
+        for metastate in self._metastates:
+            prices.update(p for p in _price_breakpoints(metastate) if p > 0)
+        prices = sorted(prices)
+
+        for i, price in enumerate(prices):
+            # Payments are linear in price until the next breakpoint, so
+            # sample the middle of the interval to pick each class's terms
+            if i + 1 < len(prices):
+                sample = (price + prices[i + 1]) / 2
+            else:
+                sample = price + 1
+            terms = [_per_share(m, sample) for m in self._metastates]
+
+            # Exit value = fixed + rate * price
+            fixed = sum(n * f for n, (f, r) in zip(self.shares, terms))
+            rate = sum(n * r for n, (f, r) in zip(self.shares, terms))
+            if not rate:
+                # Nobody shares in additional proceeds at these prices
+                continue
+
+            # Convert to functions of exit value
+            piece = [(n * (f - r * fixed / rate), n * r / rate)
+                     for n, (f, r) in zip(self.shares, terms)]
+            self._add(fixed + rate * price, piece)
+
+    def _piece(self, exit_value):
+        if exit_value < 0:
+            raise ValueError("Exit value must not be negative")
+        index = bisect.bisect_right(self.starts, exit_value) - 1
+        if index < 0:
+            return [(0, 0)] * len(self.names)
+        return self.pieces[index]
+
+    def payouts(self, exit_value):
+        """Returns a dict mapping the name of each class of stock to the
+        total paid to its outstanding shares for the given exit value"""
+        return dict((name, fixed + rate * exit_value) for name, (fixed, rate)
+                    in zip(self.names, self._piece(exit_value)))
+
+    def curves(self, exit_values):
+        """Returns a dict mapping the name of each class of stock to a list
+        of the total paid to it for each of exit_values"""
+        columns = [[] for _ in self.names]
+        for exit_value in exit_values:
+            piece = self._piece(exit_value)
+            for column, (fixed, rate) in zip(columns, piece):
+                column.append(fixed + rate * exit_value)
+        return dict(zip(self.names, columns))
+
+    def holder_payouts(self, exit_value, by=None):
+        """Returns a dict mapping each holder to their total payout for the
+        given exit value
+
+        Args:
+            exit_value (number) - Proceeds to distribute
+            by (callable) - If provided, holders are grouped by the value this
+                returns for each (see captable.ownership.report)
+        """
+        ret = {}
+        piece = self._piece(exit_value)
+        for (fixed, rate), shares, amounts in zip(piece, self.shares,
+                                                  self._holder_amounts):
+            if not shares:
+                continue
+            per_share = (fixed + rate * exit_value) / shares
+            for holder, amount in amounts.items():
+                key = holder if by is None else by(holder)
+                ret[key] = ret.get(key, 0) + amount * per_share
+        return ret
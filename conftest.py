@@ -1 +1 @@
-collect_ignore = ["setup.py"]
\ No newline at end of file
+collect_ignore = ["setup.py", "benchmarks"]
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import datetime
+
 import captable
 from captable.mixins import Snowflake
 
@@ -27,4 +29,9 @@ class ErrorTransaction(StubTransaction):
     """Simulates an exception raised after state changes"""
     def __call__(self, *args, **kwds):
         state = super(ErrorTransaction, self).__call__(*args, **kwds)
-        raise RuntimeError("Boom")
\ No newline at end of file
+        raise RuntimeError("Boom")
+
+
+def day(n):
+    """Returns the datetime n days after the start date used by the tests"""
+    return datetime.datetime(2015, 5, 1) + datetime.timedelta(days=n)
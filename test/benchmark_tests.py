@@ -0,0 +1,25 @@
+from __future__ import absolute_import
+
+from captable import CapTable
+from benchmarks import ledger, run
+
+
+def test_ledger():
+    """Generated ledgers should be deterministic and valid"""
+    entries = list(ledger.Ledger(200, seed=1))
+    again = list(ledger.Ledger(200, seed=1))
+    assert [len(e[1]) for e in entries] == [len(e[1]) for e in again]
+    assert [e[0] for e in entries] == [e[0] for e in again]
+
+    table = CapTable()
+    table.record_many(entries)
+    assert sum(len(table[cls].issuances) for cls in ledger.CLASSES) == 200
+
+def test_regressions():
+    """Results slower than the baseline should be reported"""
+    baseline = run.run([50], names=["queries"])
+    results = {"results": [dict(r, us_per_op=r["us_per_op"] * 2)
+                           for r in baseline["results"]]}
+    assert len(run.regressions(results, baseline, 0.5)) == \
+        len(baseline["results"])
+    assert run.regressions(baseline, baseline, 0) == []
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.certs import CertIndex, SortedKeys, natural_key
+from ._helpers import day
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Small chunks, so queries and changes span many of them
+    monkeypatch.setattr(SortedKeys, "CHUNK_SIZE", 4)
+
+@pytest.fixture
+def table(small_chunks):
+    table = CapTable()
+    table.pg = Person("Peter Gregory")
+    table.record(day(0), CommonStock.auth(100000))
+    table.record_many((day(1), [
+        CommonStock.issue(holder=table.pg, amount=10, cert_no=cert_no)
+    ]) for cert_no in ["CS-%s" % n for n in range(100, 0, -1)] +
+        ["PA-%s" % n for n in range(1, 21)] + ["CS-0042", "CS-7-B"])
+    table.record(day(2), *[CommonStock.cancel("CS-%s" % n)
+                           for n in range(1, 101, 3)])
+    return table
+
+
+def test_natural_key():
+    """Runs of digits should sort by value"""
+    cert_nos = ["CS-10", "CS-9", "CS-9-A", "2", "CS-09", "A10B2", "A10B10",
+                "CS-"]
+    assert sorted(cert_nos, key=natural_key) == \
+        ["2", "A10B2", "A10B10", "CS-", "CS-09", "CS-9", "CS-9-A", "CS-10"]
+
+def test_queries(table):
+    """Range and prefix queries should return cert_nos in natural order,
+    optionally skipping cancelled ones"""
+    index = table[CommonStock].cert_index
+    assert len(index) == 122
+    assert list(index.between("CS-40", "CS-44")) == \
+        ["CS-40", "CS-41", "CS-0042", "CS-42", "CS-43", "CS-44"]
+    assert list(index.between("CS-40", "CS-44", live=True)) == \
+        ["CS-41", "CS-0042", "CS-42", "CS-44"]
+    assert list(index.between(last="CS-3")) == ["CS-1", "CS-2", "CS-3"]
+    assert list(index.between("PA-19")) == ["PA-19", "PA-20"]
+    assert list(index.prefixed("CS-1")) == \
+        ["CS-1"] + ["CS-%s" % n for n in range(10, 20)] + ["CS-100"]
+    assert list(index.prefixed("CS-1", live=True)) == \
+        ["CS-11", "CS-12", "CS-14", "CS-15", "CS-17", "CS-18"]
+    assert list(index.prefixed("CS-0")) == ["CS-0042"]
+    assert list(index.prefixed("CS-7")) == \
+        ["CS-7", "CS-7-B"] + ["CS-%s" % n for n in range(70, 80)]
+    assert list(index.prefixed("PA-")) == ["PA-%s" % n for n in range(1, 21)]
+    assert list(index.prefixed("X")) == []
+    assert list(index.live())[:3] == ["CS-2", "CS-3", "CS-5"]
+
+def test_next_cert_no(table):
+    index = table[CommonStock].cert_index
+    assert index.next_cert_no("CS-") == "CS-101"
+    assert index.next_cert_no("PA-") == "PA-21"
+    assert index.next_cert_no("PB-") == "PB-1"
+    assert index.next_cert_no("PB-", start=1000) == "PB-1000"
+    assert CertIndex([("X-0099", False)]).next_cert_no("X-") == "X-0100"
+    with pytest.raises(ValueError):
+        index.next_cert_no("CS-1")
+
+def test_maintained(table):
+    """The index should follow issues and cancels, including rollbacks"""
+    index = table[CommonStock].cert_index
+    table.record(day(3), CommonStock.issue(holder=table.pg, amount=10,
+                                           cert_no="CS-101"),
+                 CommonStock.cancel("CS-2"))
+    assert index.next_cert_no("CS-") == "CS-102"
+    assert list(index.between("CS-1", "CS-3", live=True)) == ["CS-3"]
+
+    with pytest.raises(AssertionError):
+        table.record(day(3), CommonStock.issue(holder=table.pg, amount=10,
+                                               cert_no="CS-102"),
+                     CommonStock.cancel("CS-3"),
+                     CommonStock.issue(holder=table.pg, amount=10 ** 6))
+    assert index.next_cert_no("CS-") == "CS-102"
+    assert list(index.between("CS-1", "CS-3", live=True)) == ["CS-3"]
+    assert list(index) == \
+        list(CertIndex((cert_no, issuance.cancelled) for cert_no, issuance
+                       in table[CommonStock].cert_no_lookups.items()))
+
+def test_forked(table):
+    """Forks and committed views should keep their own indexes"""
+    table[CommonStock].cert_index
+    view = table.committed()
+    fork = table.fork()
+    fork.record(day(3), CommonStock.issue(holder=table.pg, amount=10,
+                                          cert_no="CS-500"),
+                CommonStock.cancel("CS-5"))
+    table.record(day(3), CommonStock.cancel("CS-6"))
+    assert fork[CommonStock].cert_index.next_cert_no("CS-") == "CS-501"
+    assert table[CommonStock].cert_index.next_cert_no("CS-") == "CS-101"
+    assert list(fork[CommonStock].cert_index.between(
+        "CS-5", "CS-6", live=True)) == ["CS-6"]
+    assert list(table[CommonStock].cert_index.between(
+        "CS-5", "CS-6", live=True)) == ["CS-5"]
+    assert list(view[CommonStock].cert_index.between(
+        "CS-5", "CS-6", live=True)) == ["CS-5", "CS-6"]
+
+def test_snapshot(table, tmpdir):
+    """Snapshots should leave the index out and rebuild it when used"""
+    table[CommonStock].cert_index
+    path = str(tmpdir.join("table.snapshot"))
+    table.save_snapshot(path)
+    loaded = CapTable.load_snapshot(path)
+    metastate = loaded[CommonStock]
+    metastate._load()
+    assert "_cert_index" not in metastate.__dict__
+    assert list(loaded[CommonStock].cert_index) == \
+        list(table[CommonStock].cert_index)
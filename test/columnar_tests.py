@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+
+import datetime
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar, IssuanceProxy
+
+
+class ColumnarStock(CommonStock):
+    class MetaState(Columnar, CommonStock.MetaState):
+        CHECK_COUNTS = True
+
+
+@pytest.fixture
+def table():
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+    table = CapTable()
+    table.record(datetime.datetime(2015, 5, 1), ColumnarStock.auth(10000))
+    table.record(datetime.datetime(2015, 5, 2),
+                 ColumnarStock.issue(holder=pg, amount=1000, cert_no="CS-1"),
+                 ColumnarStock.issue(holder=gb, amount=2000, cert_no="CS-2"),
+                 ColumnarStock.issue(holder=gb, amount=3000))
+    return table
+
+
+def test_issuance(table):
+    """Issuances should be stored as rows and read back through proxies"""
+    metastate = table[ColumnarStock]
+    assert len(metastate.columns) == 3
+    assert len(metastate.issuances) == 3
+
+    cs1 = metastate["CS-1"]
+    assert isinstance(cs1, IssuanceProxy)
+    assert cs1 == metastate.issuances[0]
+    assert cs1.holder.name == "Peter Gregory"
+    assert cs1.amount == 1000
+    assert cs1.cert_name == "Peter Gregory"
+    assert cs1.issued_on == datetime.datetime(2015, 5, 2)
+    assert cs1.security_class is ColumnarStock
+    assert not cs1.cancelled
+    assert metastate.issuances[2].cert_no is None
+
+    assert metastate.issued == 6000
+    assert metastate.outstanding == 6000
+    assert metastate.shares_held(cs1.holder) == 1000
+
+def test_transfer_cancel(table):
+    """Transfers and cancellations should update rows and counts"""
+    metastate = table[ColumnarStock]
+    gb = metastate["CS-2"].holder
+    table.record(None, ColumnarStock.transfer(cert_no="CS-1", to=gb))
+    table.record(None, ColumnarStock.retire(cert_no="CS-2"))
+    table.record(None, ColumnarStock.transfer(cert_no="CS-1", to=None))
+
+    assert metastate["CS-1"].holder is None
+    assert metastate["CS-2"].cancelled
+    assert metastate.issued == 4000
+    assert metastate.outstanding == 3000
+    assert metastate.cancelled == 2000
+    assert metastate.held_by(gb) == [metastate.issuances[2]]
+
+def test_rollback(table):
+    """Failed transactions should roll back row changes and appends"""
+    metastate = table[ColumnarStock]
+    gb = metastate["CS-2"].holder
+    with pytest.raises(AssertionError):
+        table.record(None,
+                     ColumnarStock.transfer(cert_no="CS-1", to=gb),
+                     ColumnarStock.cancel(cert_no="CS-2"),
+                     ColumnarStock.issue(holder=gb, amount=100,
+                                         cert_no="CS-3"),
+                     ColumnarStock.issue(holder=gb, amount=10**6))
+
+    assert len(metastate.columns) == 3
+    assert "CS-3" not in metastate
+    assert metastate["CS-1"].holder.name == "Peter Gregory"
+    assert not metastate["CS-2"].cancelled
+    assert metastate.outstanding == 6000
+    assert metastate.shares_held(gb) == 5000
+
+def test_extra_attributes(table):
+    """Attributes without a dedicated column should still be stored"""
+    metastate = table[ColumnarStock]
+    issuance = metastate["CS-1"]
+    with pytest.raises(AttributeError):
+        issuance.legend
+    issuance.legend = "Restricted"
+    assert metastate["CS-1"].legend == "Restricted"
+
+def test_as_of(table):
+    """Copies made for as_of should not share rows with the table"""
+    table.record(datetime.datetime(2015, 5, 3),
+                 ColumnarStock.cancel(cert_no="CS-1"))
+    view = table.as_of(datetime.datetime(2015, 5, 2))
+    assert not view[ColumnarStock]["CS-1"].cancelled
+    assert table[ColumnarStock]["CS-1"].cancelled
+    assert view[ColumnarStock].issued == 6000
+
+def test_migrate(table):
+    """Should be able to migrate between object and columnar storage"""
+    class ObjectStock(CommonStock):
+        name = ColumnarStock.name
+
+        class MetaState(CommonStock.MetaState):
+            pass
+
+    class ColumnarStock2(ColumnarStock):
+        pass
+
+    pg = table[ColumnarStock]["CS-1"].holder
+    table.record(None, ObjectStock.auth())
+    metastate = table[ObjectStock]
+    assert not hasattr(metastate, "columns")
+    assert isinstance(metastate["CS-1"], ColumnarStock)
+    assert metastate["CS-1"].holder is pg
+    assert metastate.held_by(pg) == [metastate["CS-1"]]
+    assert metastate.outstanding == 6000
+
+    table.record(None, ColumnarStock2.auth())
+    metastate = table[ColumnarStock2]
+    assert isinstance(metastate["CS-1"], IssuanceProxy)
+    assert metastate.shares_held(pg) == 1000
+    assert metastate.outstanding == 6000
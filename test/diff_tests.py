@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar
+from ._helpers import day
+
+
+class ColumnarStock(CommonStock):
+    name = "Columnar Stock"
+
+    class MetaState(Columnar, CommonStock.MetaState):
+        pass
+
+
+def summary(changes):
+    return dict((kind, [change.cert_no for change in getattr(changes, kind)])
+                for kind in ("issued", "transferred", "cancelled"))
+
+@pytest.fixture
+def table():
+    table = CapTable(checkpoint_interval=10)
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(100000))
+    table.record_many((day(1), [
+        CommonStock.issue(holder=table.pg, amount=10, cert_no="CS-%s" % n)
+    ]) for n in range(50))
+    table.record(day(2), CommonStock.transfer("CS-1", table.gb),
+                 CommonStock.cancel("CS-2"), CommonStock.auth(200000))
+    table.record(day(3), CommonStock.issue(holder=table.gb, amount=5,
+                                           cert_no="N-1"),
+                 CommonStock.transfer("CS-3", table.gb))
+    table.record(day(4), CommonStock.transfer("CS-3", table.pg),
+                 CommonStock.cancel("N-1"),
+                 CommonStock.issue(holder=table.gb, amount=5))
+    return table
+
+
+def test_diff(table):
+    """A diff should list the net changes to certificates and
+    authorizations"""
+    changes = table.diff(day(1), day(4))
+    assert changes.start == day(1) and changes.end == day(4)
+    assert summary(changes) == {"issued": ["N-1", None],
+                                "transferred": ["CS-1"],
+                                "cancelled": ["CS-2", "N-1"]}
+    assert changes.authorized == {CommonStock.name: (100000, 200000)}
+
+    transfer = changes.transferred[0]
+    assert transfer.security == CommonStock.name
+    assert (transfer.old_holder, transfer.holder) == (table.pg, table.gb)
+    assert transfer.issuance.cert_no == "CS-1"
+    assert transfer.issuance.holder is table.gb
+    issued = changes.issued[1]
+    assert (issued.old_holder, issued.holder) == (None, table.gb)
+    assert issued.issuance.amount == 5
+
+def test_bounds(table):
+    """Only transactions after start up to and including end count"""
+    assert summary(table.diff(day(2), day(3))) == \
+        {"issued": ["N-1"], "transferred": ["CS-3"], "cancelled": []}
+    assert table.diff(day(2), day(3)).authorized == {}
+    assert summary(table.diff(day(-1), day(1)))["issued"] == \
+        ["CS-%s" % n for n in range(50)]
+    assert table.diff(day(-1), day(0)).authorized == \
+        {CommonStock.name: (None, 100000)}
+    assert not table.diff(day(4), day(10))
+    assert not table.diff(day(2), day(2))
+    with pytest.raises(ValueError):
+        table.diff(day(3), day(2))
+
+def test_cost(table, monkeypatch):
+    """A diff should only replay the transactions since the nearest
+    checkpoint"""
+    for n in range(50, 1000):
+        table.record(day(5), CommonStock.issue(holder=table.pg, amount=10,
+                                               cert_no="CS-%s" % n))
+    table.record(day(6), CommonStock.transfer("CS-5", table.gb))
+    applied = []
+    apply = CapTable._apply
+    monkeypatch.setattr(CapTable, "_apply", lambda self, datetime_, txns:
+                        applied.append(datetime_) or
+                        apply(self, datetime_, txns))
+    changes = table.diff(day(5), day(6))
+    assert summary(changes)["transferred"] == ["CS-5"]
+    assert applied[-1] == day(6)
+    assert len(applied) <= table.checkpoint_interval + 1
+
+def test_snapshot(table, tmpdir):
+    """Diffs of a table loaded from a snapshot can't start before it"""
+    path = str(tmpdir.join("table.snapshot"))
+    table.save_snapshot(path)
+    loaded = CapTable.load_snapshot(path)
+    loaded.record(day(5), CommonStock.cancel("CS-4"))
+    assert summary(loaded.diff(day(4), day(5)))["cancelled"] == ["CS-4"]
+    with pytest.raises(ValueError):
+        loaded.diff(day(3), day(5))
+
+def test_columnar():
+    """Columnar issuances should be tracked like any other"""
+    table = CapTable()
+    pg, gb = Person("Peter Gregory"), Person("Gavin Belson")
+    table.record(day(0), ColumnarStock.auth(10000),
+                 ColumnarStock.issue(holder=pg, amount=10, cert_no="C-1"),
+                 ColumnarStock.issue(holder=pg, amount=10, cert_no="C-2"))
+    table.record(day(1), ColumnarStock.transfer("C-1", gb),
+                 ColumnarStock.cancel("C-2"),
+                 ColumnarStock.issue(holder=gb, amount=10, cert_no="C-3"))
+    changes = table.diff(day(0), day(1))
+    assert summary(changes) == {"issued": ["C-3"], "transferred": ["C-1"],
+                                "cancelled": ["C-2"]}
+    assert changes.certificates[0].security == ColumnarStock.name
+    assert changes.transferred[0].holder is gb
@@ -0,0 +1,282 @@
+from __future__ import absolute_import
+
+import copy
+import pickle
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar
+from captable.journal import (ForkedDict, ForkedList, Journal,
+                              JournaledDict, JournaledList)
+from captable.relations import Relations, voting_power
+from captable.table import History
+from ._helpers import day
+
+
+class PreferredStock(CommonStock):
+    name = "Preferred Stock"
+
+    class MetaState(Columnar, CommonStock.MetaState):
+        pass
+
+
+@pytest.fixture
+def table():
+    table = CapTable(checkpoint_interval=50)
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(100000), PreferredStock.auth(100000))
+    table.record_many((day(1), [
+        cls.issue(holder=(table.pg if n % 2 else table.gb), amount=10,
+                  cert_no="%s-%s" % (cls.name, n))
+        for cls in (CommonStock, PreferredStock)
+    ]) for n in range(200))
+    return table
+
+
+def test_fork(table):
+    """A fork should start with the same history and state, after which
+    changes to either one shouldn't affect the other"""
+    fork = table.fork()
+    assert fork.transactions == table.transactions
+    assert fork.state == table.state
+
+    fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg),
+                PreferredStock.cancel("Preferred Stock-1"))
+    table.record(day(3), CommonStock.cancel("Common Stock-0"))
+    assert fork[CommonStock]["Common Stock-0"].holder is table.pg
+    assert not fork[CommonStock]["Common Stock-0"].cancelled
+    assert table[CommonStock]["Common Stock-0"].holder is table.gb
+    assert table[CommonStock]["Common Stock-0"].cancelled
+    assert fork[PreferredStock].shares_held(table.pg) == 990
+    assert table[PreferredStock].shares_held(table.pg) == 1000
+    assert fork[CommonStock].shares_held(table.gb) == 990
+    assert len(table.transactions) == len(fork.transactions) == 202
+
+def test_shared_issuances(table):
+    """Issuances should be shared until a fork modifies them"""
+    fork = table.fork()
+    fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg))
+    issuances = table[CommonStock].issuances
+    fork_issuances = fork[CommonStock].issuances
+    assert isinstance(fork_issuances, ForkedList)
+    assert fork_issuances[0] is not issuances[0]
+    assert fork_issuances[1] is issuances[1]
+    assert any(issuance is issuances[1]
+               for issuance in fork[CommonStock].held_by(table.pg))
+
+def test_shared_issuances_reforked(table):
+    """Issuances shared again by a later fork should be swapped for copies
+    in place, wherever they are in the list"""
+    fork = table.fork()
+    fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg),
+                CommonStock.issue(holder=table.gb, amount=10, cert_no="N-1"))
+    second = fork.fork()
+    second.record(day(3), CommonStock.transfer("Common Stock-0", table.gb),
+                  CommonStock.transfer("N-1", table.pg),
+                  CommonStock.transfer("Common Stock-5", table.gb))
+    metastate = second[CommonStock]
+    issuances = list(metastate.issuances)
+    for cert_no in ("Common Stock-0", "N-1", "Common Stock-5"):
+        issuance = metastate[cert_no]
+        assert [i for i in issuances if i.cert_no == cert_no] == [issuance]
+        assert issuances.index(issuance) == \
+            [i.cert_no for i in issuances].index(cert_no)
+    assert fork[CommonStock]["N-1"].holder is table.gb
+    assert fork[CommonStock]["Common Stock-0"].holder is table.pg
+    assert second[CommonStock].shares_held(table.pg) == 1000
+
+def test_shared_columns(table):
+    """A fork of a columnar class should share each column until it
+    modifies it"""
+    fork = table.fork()
+    fork.record(day(2), PreferredStock.transfer("Preferred Stock-0", table.pg))
+    columns = table[PreferredStock].columns
+    fork_columns = fork[PreferredStock].columns
+    assert fork_columns.amounts is columns.amounts
+    assert fork_columns.holder_ids is not columns.holder_ids
+
+    second = fork.fork()
+    with pytest.raises(AssertionError):
+        second.record(day(3),
+                      PreferredStock.transfer("Preferred Stock-0", table.gb),
+                      PreferredStock.issue(holder=table.gb, amount=10 ** 6))
+    second.record(day(3), PreferredStock.cancel("Preferred Stock-1"),
+                  PreferredStock.issue(holder=table.gb, amount=10,
+                                       cert_no="N-1"))
+    assert fork[PreferredStock]["Preferred Stock-0"].holder is table.pg
+    assert not fork[PreferredStock]["Preferred Stock-1"].cancelled
+    assert "N-1" not in fork[PreferredStock]
+    assert second[PreferredStock]["N-1"].holder is table.gb
+    assert second[PreferredStock].shares_held(table.pg) == 1000
+    assert fork[PreferredStock].shares_held(table.pg) == 1010
+    assert len(table[PreferredStock].held_by(table.gb)) == 100
+    assert len(fork[PreferredStock].held_by(table.gb)) == 99
+    assert len(second[PreferredStock].held_by(table.gb)) == 100
+    lookups = second[PreferredStock].cert_no_lookups
+    assert pickle.loads(pickle.dumps(lookups, 2)) == lookups
+
+def test_fork_allocation():
+    """Forking a table and modifying an issuance shouldn't copy anything
+    proportional to the number of issuances"""
+    tracemalloc = pytest.importorskip("tracemalloc")
+
+    def allocated(count):
+        table = CapTable(checkpoint_interval=count // 4)
+        pg, gb = Person("Peter Gregory"), Person("Gavin Belson")
+        table.record(day(0), CommonStock.auth(10 ** 6))
+        table.record_many((day(1), [
+            CommonStock.issue(holder=pg, amount=1, cert_no=str(n))
+        ]) for n in range(count))
+        table.fork().record(day(2), CommonStock.transfer("0", gb))
+        tracemalloc.start()
+        try:
+            fork = table.fork()
+            fork.record(day(2), CommonStock.transfer("1", gb),
+                        CommonStock.issue(holder=gb, amount=1))
+            return tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+    assert allocated(8000) < allocated(1000) * 2
+
+def test_metastate_lookup():
+    """A MetaState looked up before later transactions may be left to a
+    checkpoint, so should be looked up again"""
+    table = CapTable(checkpoint_interval=3)
+    pg = Person("Peter Gregory")
+    table.record(day(0), CommonStock.auth(1000))
+    held = table[CommonStock]
+    for n in range(5):
+        table.record(day(1), CommonStock.issue(holder=pg, amount=10))
+    assert table[CommonStock].issued == 50
+    assert held is not table[CommonStock]
+    assert held.issued < 50
+    assert table.as_of(day(0))[CommonStock].issued == 0
+
+def test_rollback(table):
+    """A failed transaction in a fork should leave it and its parent
+    unchanged"""
+    fork = table.fork()
+    with pytest.raises(AssertionError):
+        fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg),
+                    CommonStock.cancel("Common Stock-2"),
+                    CommonStock.issue(holder=table.pg, amount=10 ** 6))
+    assert fork.state == table.state
+    assert fork[CommonStock].shares_held(table.pg) == 1000
+    assert "Common Stock-0" in [issuance.cert_no for issuance in
+                                fork[CommonStock].held_by(table.gb)]
+
+def test_as_of(table):
+    """Historical states of a fork should include the fork's own
+    transactions"""
+    fork = table.fork()
+    fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg))
+    fork.record(day(3), CommonStock.cancel("Common Stock-2"))
+    view = fork.as_of(day(2))
+    assert view[CommonStock]["Common Stock-0"].holder is table.pg
+    assert not view[CommonStock]["Common Stock-2"].cancelled
+    assert table.as_of(day(2))[CommonStock]["Common Stock-0"].holder is \
+        table.gb
+    assert fork.as_of(day(1))[CommonStock].shares_held(table.pg) == 1000
+
+def test_fork_of_fork(table):
+    fork = table.fork()
+    fork.record(day(2), CommonStock.transfer("Common Stock-0", table.pg))
+    second = fork.fork()
+    second.record(day(3), CommonStock.transfer("Common Stock-0", table.gb))
+    fork.record(day(3), Relations.relate(table.pg, table.gb))
+    assert second[CommonStock].shares_held(table.pg) == 1000
+    assert fork[CommonStock].shares_held(table.pg) == 1010
+    assert voting_power(fork, table.gb) == 4000
+    assert Relations.STATE_KEY not in second.state
+
+def test_forked_dict():
+    """A ForkedDict should behave like a copy of its base, and undo changes
+    on rollback"""
+    inner = JournaledDict(x=1)
+    base = JournaledDict((n, n) for n in range(10))
+    base["inner"] = inner
+    forked = ForkedDict(base)
+    assert forked == base
+    assert len(forked) == 11
+
+    with Journal() as journal:
+        forked[0] = "zero"
+        del forked[1]
+        forked[20] = 20
+        forked["inner"]["y"] = 2
+        assert forked.pop(2) == 2
+        assert len(forked) == 10
+        assert 1 not in forked and 2 not in forked and 20 in forked
+        assert forked.get(1, "missing") == "missing"
+        with pytest.raises(KeyError):
+            del forked[1]
+        assert dict(forked.items())["inner"] == {"x": 1, "y": 2}
+        journal.rollback()
+    assert forked == base
+    assert inner == {"x": 1}
+
+    del forked[3]
+    forked[3] = "three"
+    assert sorted(forked, key=str) == sorted(base, key=str)
+    assert forked[3] == "three"
+    assert ForkedDict(JournaledDict()) == {}
+    assert copy.deepcopy(forked) == forked
+    assert type(pickle.loads(pickle.dumps(forked, 2))) is JournaledDict
+
+    # Forking a ForkedDict should keep a single layer over the same base
+    second = forked.__fork__()
+    assert second._base is base and second == forked
+
+    # Once changes outgrow the base, forks share a single flattened copy
+    for n in range(10):
+        forked[n] = -n
+    third, fourth = forked.__fork__(), forked.__fork__()
+    assert third._base is fourth._base is not base
+    assert third == fourth == forked and forked._base is base
+
+def test_forked_list():
+    """A ForkedList should behave like a copy of its base, and undo changes
+    on rollback"""
+    base = JournaledList(range(10))
+    forked = ForkedList(base)
+    assert forked == base
+    with Journal() as journal:
+        forked[1] = "one"
+        forked.append(10)
+        forked[-1] = "ten"
+        assert forked[1:3] == ["one", 2]
+        assert len(forked) == 11
+        assert forked.index("ten") == 10
+        forked.insert(0, -1)
+        assert forked[:3] == [-1, 0, "one"]
+        journal.rollback()
+    assert forked == list(range(10))
+    assert list(reversed(forked)) == list(range(9, -1, -1))
+    with pytest.raises(IndexError):
+        forked[10]
+    assert pickle.loads(pickle.dumps(forked, 2)) == forked
+    assert base == list(range(10))
+
+    forked.extend(range(10, 20))
+    second, third = forked.__fork__(), forked.__fork__()
+    assert second._base is third._base is not base
+    assert second == third == forked == list(range(20))
+
+def test_history():
+    """History should act as a list that can be forked without copying
+    it"""
+    history = History(range(5))
+    fork = history.fork()
+    history.append(5)
+    fork.append("a")
+    assert history == list(range(6))
+    assert fork == [0, 1, 2, 3, 4, "a"]
+    assert fork[2:] == [2, 3, 4, "a"]
+    assert fork[-1] == "a" and fork[4] == 4
+
+    fork.insert(1, "b")
+    assert fork == [0, "b", 1, 2, 3, 4, "a"]
+    assert history == list(range(6))
+    assert history != fork
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import pytest
+
+import captable
+from captable import CapTable, CommonStock, Person
+from captable.table import TableView
+from ._helpers import day
+
+
+def build_table(**kwds):
+    """Returns a table where CS-n is issued on day n and then transferred
+    from pg to gb on day n + 10"""
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+    table = CapTable(**kwds)
+    table.record(day(0), CommonStock.auth(100000))
+    for n in range(1, 11):
+        table.record(day(n), CommonStock.issue(holder=pg, amount=n * 100,
+                                               cert_no="CS-%s" % n))
+    for n in range(1, 11):
+        table.record(day(n + 10), 
+                     CommonStock.transfer(cert_no="CS-%s" % n, to=gb))
+    return table, pg, gb
+
+
+@pytest.mark.parametrize("kwds", [
+    {},
+    {"checkpoint_interval": 3},
+    {"checkpoint_interval": 1, "max_checkpoints": 4},
+    {"checkpoint_interval": None}
+])
+def test_as_of(kwds):
+    """as_of should reflect only transactions on or before the datetime"""
+    table, pg, gb = build_table(**kwds)
+
+    view = table.as_of(day(-1))
+    assert view.datetime is None
+    with pytest.raises(KeyError):
+        view[CommonStock]
+
+    for n in range(1, 11):
+        view = table.as_of(day(n))
+        assert view.datetime == day(n)
+        assert view[CommonStock].issued == sum(range(1, n + 1)) * 100
+        assert view.shares_held(pg) == {
+            CommonStock.name: view[CommonStock].issued}
+
+    view = table.as_of(day(15))
+    assert view[CommonStock]["CS-5"].holder == gb
+    assert view[CommonStock]["CS-6"].holder == pg
+    assert view.shares_held(gb) == {CommonStock.name: 1500}
+
+    # Latest state unaffected by queries, and vice versa
+    view = table.as_of(day(30))
+    assert view[CommonStock].outstanding == table[CommonStock].outstanding
+    assert table.shares_held(gb) == {CommonStock.name: 5500}
+    table.record(day(31), CommonStock.cancel("CS-5"))
+    assert not view[CommonStock]["CS-5"].cancelled
+    assert view.shares_held(gb) == {CommonStock.name: 5500}
+
+def test_checkpoint_budget():
+    """Checkpoints should be thinned out to stay within max_checkpoints"""
+    table, pg, gb = build_table(checkpoint_interval=1, max_checkpoints=4)
+    assert len(table._checkpoints) <= 4
+    assert table.checkpoint_interval == 8
+
+@pytest.mark.parametrize("kwds", [{}, {"checkpoint_interval": 4}])
+def test_insert(kwds):
+    """Should be able to insert a transaction in the past and have it
+    reflected in the current state and in later as_of queries"""
+    table, pg, gb = build_table(**kwds)
+    pc = Person("Peter Cunningham")
+    table.insert(day(3), CommonStock.issue(holder=pc, amount=50, 
+                                           cert_no="CS-X"))
+    
+    assert len(table.transactions) == 22
+    assert table.transactions[4][0] == day(3)
+    assert table[CommonStock]["CS-X"].holder == pc
+    assert table[CommonStock].issued == 5550
+    assert table.as_of(day(2))[CommonStock].issued == 300
+    assert table.as_of(day(3))[CommonStock].issued == 650
+
+    # Recording at the end still works
+    table.record(day(30), CommonStock.transfer(cert_no="CS-X", to=gb))
+    assert table.shares_held(gb) == {CommonStock.name: 5550}
+
+def test_insert_checkpoints():
+    """Inserting should replace the checkpoints after the insert point, so
+    later as_of queries still replay at most an interval's transactions"""
+    table, pg, gb = build_table(checkpoint_interval=4)
+    before = [count for count, _ in table._checkpoints]
+    pc = Person("Peter Cunningham")
+    table.insert(day(3), CommonStock.issue(holder=pc, amount=50,
+                                           cert_no="CS-X"))
+    counts = [count for count, _ in table._checkpoints]
+    assert counts[:2] == before[:2]
+    assert len(counts) == len(before) + (len(table.transactions) % 4 == 0)
+    assert all(b - a <= 4 for a, b in zip(counts, counts[1:]))
+
+    # Checkpoints should match the state replayed from scratch
+    def summary(view):
+        metastate = view[CommonStock]
+        return (metastate.issued, [(issuance.cert_no, issuance.holder)
+                                   for issuance in metastate.issuances])
+    for count, state in table._checkpoints[1:]:
+        replayed = CapTable()
+        replayed.record_many(table.transactions[:count])
+        assert summary(TableView(state)) == summary(replayed)
+
+@pytest.mark.parametrize("kwds", [{}, {"checkpoint_interval": 4}])
+def test_insert_rejected(kwds):
+    """Inserting a transaction that causes a later transaction to fail should
+    leave the table unchanged"""
+    table, pg, gb = build_table(**kwds)
+
+    # Fails directly
+    with pytest.raises(AssertionError):
+        table.insert(day(3), CommonStock.issue(holder=pg, amount=10**6))
+
+    # Makes a later transaction fail
+    with pytest.raises(captable.RecordError) as excinfo:
+        table.insert(day(3), CommonStock.cancel(cert_no="CS-2"),
+                             CommonStock.issue(holder=pg, amount=10, 
+                                               cert_no="CS-4"))
+    assert excinfo.value.index == 5
+    assert isinstance(excinfo.value.error, ValueError)
+
+    assert len(table.transactions) == 21
+    assert table[CommonStock].issued == 5500
+    assert table.as_of(day(3))[CommonStock].issued == 600
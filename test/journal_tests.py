@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+
+from captable.journal import (Journal, Journaled, JournaledDict,
+                              JournaledList, StateDict)
+
+
+class Thing(Journaled):
+    pass
+
+
+def test_attr_rollback():
+    """Attribute assignments and deletions should be undone on rollback"""
+    thing = Thing()
+    thing.a = 1
+    thing.b = 2
+
+    journal = Journal()
+    with journal:
+        thing.a = 10
+        del thing.b
+        thing.c = 3
+    journal.rollback()
+
+    assert vars(thing) == {"a": 1, "b": 2}
+
+def test_container_rollback():
+    """Dict and list mutations should be undone on rollback"""
+    d = JournaledDict(a=1, b=2)
+    l = JournaledList([1, 2, 3])
+
+    journal = Journal()
+    with journal:
+        d["a"] = 10
+        d["c"] = 3
+        del d["b"]
+        d.setdefault("d", 4)
+        l.append(4)
+        l[0] = 0
+        l.pop(1)
+        l.sort(reverse=True)
+    journal.rollback()
+
+    assert d == {"a": 1, "b": 2}
+    assert l == [1, 2, 3]
+
+def test_savepoint():
+    """Rolling back to a savepoint should only undo later mutations"""
+    l = JournaledList()
+    journal = Journal()
+    with journal:
+        l.append(1)
+        savepoint = journal.savepoint()
+        l.append(2)
+        l.append(3)
+    journal.rollback(savepoint)
+    assert l == [1]
+
+def test_commit():
+    """Mutations should not be tracked once committed or outside a journal"""
+    l = JournaledList()
+    journal = Journal()
+    with journal:
+        l.append(1)
+    journal.commit()
+    l.append(2)
+    journal.rollback()
+    assert l == [1, 2]
+
+def test_state_copy_on_read():
+    """Untracked values in a StateDict should be copied before being mutated
+    in a journal"""
+    original = [1, 2]
+    state = StateDict(key=original)
+
+    journal = Journal()
+    with journal:
+        state["key"].append(3)
+        state["key"].append(4)
+        assert state["key"] == [1, 2, 3, 4]
+    assert original == [1, 2]
+
+    journal.rollback()
+    assert state["key"] is original
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.ledger import Ledger
+from captable.persistence import TransactionLog
+from ._helpers import day
+
+
+def make_closure():
+    def txn(datetime_, state):
+        return state
+    return txn
+
+def issues(pg, count):
+    """Generator of entries issuing count certificates, ten a day"""
+    for n in range(count):
+        yield (day(1 + n // 10),
+               CommonStock.issue(holder=pg, amount=10, cert_no="CS-%s" % n))
+
+@pytest.fixture
+def table(tmpdir):
+    table = CapTable(ledger=Ledger(str(tmpdir.join("table.ledger")),
+                                   window=10, segment_size=7),
+                     checkpoint_interval=20)
+    table.pg = Person("Peter Gregory")
+    table.record(day(0), CommonStock.auth(100000))
+    table.record_many(issues(table.pg, 200))
+    return table
+
+
+def test_ledger(table):
+    """A ledger should act like a list, with only the latest entries kept in
+    memory"""
+    ledger = table.transactions
+    assert len(ledger) == 201
+    assert len(ledger._recent) == 10
+    assert len(ledger._offsets) == 29
+    assert ledger[0][1] == CommonStock.auth(100000)
+    assert ledger[-1][1].kwds["cert_no"] == "CS-199"
+    assert [entry[1].kwds["cert_no"] for entry in ledger[100:103]] == \
+        ["CS-99", "CS-100", "CS-101"]
+    assert [entry[1].kwds["cert_no"] for entry in ledger.iterate(187, 193)] \
+        == ["CS-%s" % n for n in range(186, 192)]
+    assert len(ledger._cached[1]) <= 7
+    assert list(ledger) == ledger[:]
+    assert table._datetimes[55] == day(6)
+    assert table._count_at(day(6)) == 61
+    assert table._count_at(day(0)) == 1
+    assert table._count_at(day(-1)) == 0
+    with pytest.raises(IndexError):
+        ledger[201]
+
+def test_as_of(table):
+    """Past states should be rebuilt by reading older entries back"""
+    assert table.as_of(day(3))[CommonStock].outstanding == 300
+    assert table.as_of(day(20))[CommonStock].outstanding == 2000
+    table.record(day(21), CommonStock.cancel("CS-0"))
+    assert table.as_of(day(20))[CommonStock].outstanding == 2000
+    assert table[CommonStock].outstanding == 1990
+
+def test_reopen(table, monkeypatch):
+    """A table given an existing ledger should pick up where it left off,
+    reading the file only once"""
+    path = table.transactions.path
+    table.transactions.close()
+    reads = []
+    read = TransactionLog._read
+    monkeypatch.setattr(TransactionLog, "_read", lambda self, *args:
+                        reads.append(args) or read(self, *args))
+    reopened = CapTable(ledger=Ledger(path, window=10, segment_size=7),
+                        checkpoint_interval=20)
+    assert reads == [(0, True)]
+    monkeypatch.undo()
+    assert len(reopened.transactions) == 201
+    assert reopened.datetime == day(20)
+    metastate = reopened[CommonStock]
+    assert metastate.outstanding == 2000
+    assert metastate["CS-0"].holder is metastate["CS-199"].holder
+    assert metastate["CS-0"].holder.name == "Peter Gregory"
+    assert [count for count, _ in reopened._checkpoints] == \
+        [count for count, _ in table._checkpoints]
+
+    # Appending to a reopened ledger keeps it readable
+    pg = metastate["CS-0"].holder
+    reopened.record(day(21), CommonStock.transfer("CS-0", Person("Gavin")))
+    reopened.record(day(21), CommonStock.issue(holder=pg, amount=10))
+    assert reopened.as_of(day(10))[CommonStock]["CS-0"].holder is pg
+    reopened.transactions.close()
+    again = CapTable(ledger=Ledger(path))
+    assert again[CommonStock].outstanding == 2010
+    assert again[CommonStock]["CS-0"].holder.name == "Gavin"
+
+def test_insert(table):
+    """Inserting should rewrite the ledger, leaving forks as they were"""
+    fork = table.fork()
+    table.insert(day(2), CommonStock.cancel("CS-0"))
+    assert len(table.transactions) == 202
+    assert table.transactions[21][1] == CommonStock.cancel("CS-0")
+    assert table[CommonStock].outstanding == 1990
+    assert table.as_of(day(1))[CommonStock].outstanding == 100
+
+    assert len(fork.transactions) == 201
+    assert fork.transactions[21][1].kwds["cert_no"] == "CS-20"
+    fork.record(day(21), CommonStock.cancel("CS-1"))
+    assert fork[CommonStock].outstanding == 1990
+    assert len(table.transactions) == 202
+
+    path = table.transactions.path
+    table.transactions.close()
+    assert CapTable(ledger=Ledger(path))[CommonStock].outstanding == 1990
+
+def test_unpicklable(table):
+    """An entry that can't be stored should roll back rather than fail after
+    changing the table"""
+    with pytest.raises(Exception):
+        table.record(day(21), CommonStock.cancel("CS-0"), make_closure())
+    with pytest.raises(Exception):
+        table.record_many([(day(21), [CommonStock.cancel("CS-1")]),
+                           (day(21), [make_closure()])], deferred=True)
+    assert len(table.transactions) == 202
+    assert table[CommonStock].outstanding == 1990
+    assert not table[CommonStock]["CS-0"].cancelled
+
+    path = table.transactions.path
+    table.transactions.close()
+    reopened = CapTable(ledger=Ledger(path))
+    assert len(reopened.transactions) == 202
+    assert reopened[CommonStock]["CS-1"].cancelled
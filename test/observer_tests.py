@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+import datetime
+import functools
+import pytest
+
+from captable import CapTable, CommonStock, Person, RecordError
+from captable.observers import Aggregator, Event, Histogram
+from ._helpers import StubTransaction
+
+
+def test_observer():
+    """Observers should receive an event for each phase of recording"""
+    events = []
+    table = CapTable(observer=events.append)
+    pg = Person("Peter Gregory")
+    table.record(datetime.datetime(2015, 5, 1), CommonStock.auth(1000))
+    assert [(e.kind, e.name) for e in events] == [
+        ("txn", "CommonStock.auth"),
+        ("validator", "check_auth"),
+        ("commit", None),
+        ("record", None)
+    ]
+    record = events[-1]
+    assert record.counters["failed"] is False
+    assert record.counters["journal_entries"] > 0
+    assert record.counters["state_keys"] == 1
+    assert record.wall >= 0 and record.cpu >= 0
+
+    del events[:]
+    with pytest.raises(AssertionError):
+        table.record(datetime.datetime(2015, 5, 2),
+                     CommonStock.issue(holder=pg, amount=2000))
+    assert [e.kind for e in events] == ["txn", "rollback", "record"]
+    assert events[-1].counters["failed"] is True
+
+def test_observer_names():
+    """Validators without a __name__ should be reported under their class
+    name, and not hide errors they raise"""
+    def at_most(limit, state):
+        assert StubTransaction.count(state) <= limit, "Too many stubs"
+    class Validator(object):
+        def __call__(self, state):
+            pass
+    events = []
+    table = CapTable(validators=[functools.partial(at_most, 1), Validator()],
+                     observer=events.append)
+    table.record(datetime.datetime(2015, 5, 1), StubTransaction())
+    assert [e.name for e in events if e.kind == "validator"] == \
+        ["partial", "Validator"]
+    with pytest.raises(AssertionError):
+        table.record(datetime.datetime(2015, 5, 2), StubTransaction())
+
+def test_observer_record_many():
+    """Observing deferred batches shouldn't change the index a RecordError
+    reports"""
+    def at_most_3(state):
+        assert StubTransaction.count(state) <= 3, "Too many stubs"
+    events = []
+    table = CapTable(validators=[at_most_3], observer=events.append)
+    entries = [(datetime.datetime(2015, 5, n), [StubTransaction()])
+               for n in range(1, 6)]
+    with pytest.raises(RecordError) as excinfo:
+        table.record_many(entries, deferred=True, batch_size=2)
+    assert excinfo.value.index == 3
+    assert len(table.transactions) == 3
+    assert [e.counters["failed"] for e in events if e.kind == "record"] == \
+        [False, True, False, True]
+
+def test_aggregator():
+    """The aggregator should count events and report on them"""
+    aggregator = Aggregator()
+    table = CapTable(observer=aggregator)
+    pg = Person("Peter Gregory")
+    table.record(datetime.datetime(2015, 5, 1), CommonStock.auth(1000))
+    table.record_many((datetime.datetime(2015, 5, 2),
+                       [CommonStock.issue(holder=pg, amount=10)])
+                      for n in range(20))
+    table.record_many([(datetime.datetime(2015, 5, 3), [StubTransaction()])],
+                      deferred=True)
+    with pytest.raises(Exception):
+        table.record(datetime.datetime(2015, 5, 4),
+                     CommonStock.issue(holder=pg, amount=1000))
+
+    assert aggregator.count("txn", "CommonStock.issue") == 21
+    assert aggregator.count("txn", "StubTransaction") == 1
+    assert aggregator.count("record") == 23
+    assert aggregator.count("rollback") == 1
+    assert aggregator.histograms[("record", None)].counters["failed"] == 1
+    report = aggregator.report()
+    assert "CommonStock.issue" in report
+    assert "check_auth" in report
+
+def test_histogram():
+    histogram = Histogram()
+    for micros in [1, 2, 3, 100, 1000]:
+        histogram.add(Event("txn", None, micros / 1e6, 0))
+    assert histogram.count == 5
+    assert histogram.percentile(0.5) == 4 / 1e6
+    assert histogram.percentile(1) == 1000 / 1e6
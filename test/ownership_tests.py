@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Entity, NaturalPerson, Stock
+from captable import ownership
+from ._helpers import day
+
+
+class PreferredStock(Stock):
+    name = "Preferred Stock"
+
+    class MetaState(Stock.MetaState):
+        CONVERSION_RATIO = 2
+
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = NaturalPerson("Peter Gregory")
+    table.gb = NaturalPerson("Gavin Belson")
+    table.hooli = Entity("Hooli")
+    table.record(day(0), CommonStock.auth(10000), PreferredStock.auth(1000))
+    table.record(day(1),
+                 CommonStock.issue(holder=table.pg, amount=600, cert_no="C1"),
+                 CommonStock.issue(holder=table.gb, amount=200, cert_no="C2"),
+                 PreferredStock.issue(holder=table.hooli, amount=100,
+                                      cert_no="P1"))
+    table.record(day(2), CommonStock.transfer("C1", table.gb))
+    return table
+
+
+def test_report(table):
+    """Reports should give as-converted shares and percentages"""
+    report = ownership.report(table)
+    assert report.outstanding == 1000
+    assert report.fully_diluted == 1000
+    assert report.shares[table.gb] == {"Common Stock": 800}
+    assert report.as_converted(table.hooli) == 200
+    assert report.percentage(table.hooli) == 0.2
+    assert report.fully_diluted_percentage(table.gb) == 0.8
+    assert table.pg not in report.shares
+    assert [row[0] for row in report.rows()] == [table.gb, table.hooli]
+
+def test_report_by_type(table):
+    """Holders can be grouped"""
+    report = ownership.report(table, by=type)
+    assert report.shares[NaturalPerson] == {"Common Stock": 800}
+    assert report.percentage(Entity) == 0.2
+
+def test_reports(table):
+    """Reports at many datetimes should match reports on as_of"""
+    datetimes = [day(2), day(0), day(1), day(5), day(1)]
+    reports = ownership.reports(table, datetimes)
+    for datetime_, report in zip(datetimes, reports):
+        expected = ownership.report(table.as_of(datetime_))
+        assert report.shares == expected.shares
+        assert report.outstanding == expected.outstanding
+        assert report.datetime == expected.datetime
+    assert reports[1].shares == {}
+    assert reports[2].percentage(table.pg) == 0.6
+    assert table[CommonStock].shares_held(table.gb) == 800
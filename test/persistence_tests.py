@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import pickle
+import pytest
+
+from captable import CapTable, CommonStock, Person, RecordError
+from captable.persistence import TransactionLog, load
+from captable.transactions import Transaction
+from ._helpers import day
+
+
+def make_closure():
+    def txn(datetime_, state):
+        return state
+    return txn
+
+
+def test_transactions_pickle():
+    """Transactions returned by security classes should survive pickling"""
+    pg = Person("Peter Gregory")
+    txn = CommonStock.issue(holder=pg, amount=100, cert_no="CS-1")
+    assert txn == Transaction(CommonStock, "issue", holder=pg, amount=100,
+                              cert_no="CS-1")
+    assert txn != CommonStock.issue(holder=pg, amount=200, cert_no="CS-1")
+
+    txn = CommonStock.auth(1000)
+    assert pickle.loads(pickle.dumps(txn, 2)) == txn
+    assert repr(txn) == "CommonStock.auth(amount=1000, delta=None)"
+
+def test_log_round_trip(tmpdir):
+    """Loading a log should rebuild the table, including insertions, with a
+    single object for each Person"""
+    path = str(tmpdir.join("table.log"))
+    table = load(path)
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(10000))
+    table.record_many([
+        (day(n), [CommonStock.issue(holder=pg, amount=100,
+                                    cert_no="CS-%s" % n)])
+        for n in range(1, 6)
+    ], deferred=True)
+    table.record(day(6), CommonStock.transfer("CS-1", gb))
+    table.insert(day(3), CommonStock.issue(holder=gb, amount=50,
+                                           cert_no="CS-X"))
+    table.log.close()
+
+    loaded = load(path)
+    assert [e[0] for e in loaded.transactions] == \
+        [e[0] for e in table.transactions]
+    metastate = loaded[CommonStock]
+    assert metastate.issued == 550
+    assert len(metastate.holders) == 2
+    pg2 = metastate["CS-2"].holder
+    gb2 = metastate["CS-X"].holder
+    assert pg2.name == "Peter Gregory"
+    assert metastate["CS-1"].holder is gb2
+    assert metastate.shares_held(pg2) == 400
+
+    # Loaded tables keep appending to the same log
+    loaded.record(day(7), CommonStock.transfer("CS-2", gb2))
+    loaded.log.close()
+    assert load(path)[CommonStock].shares_held(pg2) == 0
+
+def test_log_failures(tmpdir):
+    """Failed or unpicklable entries should not be logged"""
+    path = str(tmpdir.join("table.log"))
+    table = load(path)
+    pg = Person("Peter Gregory")
+    table.record(day(0), CommonStock.auth(100))
+    with pytest.raises(AssertionError):
+        table.record(day(1), CommonStock.issue(holder=pg, amount=1000))
+    with pytest.raises(Exception):
+        table.record(day(1), CommonStock.auth(200), make_closure())
+    assert table[CommonStock].authorized == 100
+    with pytest.raises(RecordError):
+        table.record_many([(day(2), [CommonStock.issue(holder=pg, amount=10)]),
+                           (day(3), [make_closure()])], deferred=True)
+    table.log.close()
+
+    loaded = load(path)
+    assert len(loaded.transactions) == 2
+    assert loaded[CommonStock].issued == 10
+
+def test_log_write_failure(tmpdir, monkeypatch):
+    """If writing the log fails, the entry should be rolled back rather than
+    recorded without a log entry"""
+    path = str(tmpdir.join("table.log"))
+    table = load(path)
+    pg = Person("Peter Gregory")
+    table.record(day(0), CommonStock.auth(100))
+    table.record(day(2), CommonStock.auth(300))
+
+    def fail(self, data):
+        raise IOError("Disk full")
+    monkeypatch.setattr(TransactionLog, "write", fail)
+    with pytest.raises(IOError):
+        table.record(day(3), CommonStock.issue(holder=pg, amount=10))
+    with pytest.raises(RecordError) as excinfo:
+        table.record_many([(day(3), [CommonStock.issue(holder=pg,
+                                                        amount=10)])],
+                          deferred=True)
+    assert isinstance(excinfo.value.error, IOError)
+    with pytest.raises(IOError):
+        table.insert(day(1), CommonStock.auth(200))
+    assert len(table.transactions) == 2
+    assert table[CommonStock].issued == 0
+    assert table.as_of(day(1))[CommonStock].authorized == 100
+
+    monkeypatch.undo()
+    table.record(day(4), CommonStock.issue(holder=pg, amount=10))
+    table.log.close()
+    loaded = load(path)
+    assert [e[0] for e in loaded.transactions] == [day(0), day(2), day(4)]
+    assert loaded[CommonStock].issued == 10
+
+def test_truncated_log(tmpdir):
+    """An incomplete last record should be ignored and overwritten"""
+    path = str(tmpdir.join("table.log"))
+    table = load(path)
+    table.record(day(0), CommonStock.auth(100))
+    table.record(day(1), CommonStock.auth(200))
+    table.log.close()
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-3])
+
+    loaded = load(path)
+    assert loaded[CommonStock].authorized == 100
+    loaded.record(day(2), CommonStock.auth(300))
+    loaded.log.close()
+    assert len(load(path).transactions) == 2
+
+def test_unread_log(tmpdir):
+    """Appending to an existing log without reading it should fail"""
+    path = str(tmpdir.join("table.log"))
+    table = load(path)
+    table.record(day(0), CommonStock.auth(100))
+    table.log.close()
+
+    table = CapTable(log=TransactionLog(path))
+    with pytest.raises(ValueError):
+        table.record(day(1), CommonStock.auth(200))
+    assert table.transactions == []
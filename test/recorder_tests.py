@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+
+import pytest
+import threading
+
+from captable import CapTable, CommonStock, Person
+from captable.observers import Aggregator
+
+asyncio = pytest.importorskip("asyncio")
+from captable.recorder import AsyncRecorder
+from ._helpers import day
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture(params=[False, True], ids=["loop", "threaded"])
+def threaded(request):
+    return request.param
+
+@pytest.fixture
+def table():
+    table = CapTable(observer=Aggregator())
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(10000))
+    return table
+
+def wait(loop, futures):
+    return loop.run_until_complete(
+        asyncio.gather(*futures, return_exceptions=True))
+
+
+def test_batches(loop, table, threaded):
+    """Submissions should be recorded in order of datetime, in as few
+    batches as possible"""
+    recorder = AsyncRecorder(table, loop=loop, threaded=threaded)
+    futures = [recorder.submit(day(n), CommonStock.issue(
+        holder=table.pg, amount=10, cert_no="C%s" % n))
+        for n in (3, 1, 2, 5, 4)]
+    assert recorder.pending == 5
+    assert wait(loop, futures) == [day(n) for n in (3, 1, 2, 5, 4)]
+    assert recorder.pending == 0
+    assert [entry[1].kwds["cert_no"] for entry in table.transactions[1:]] == \
+        ["C1", "C2", "C3", "C4", "C5"]
+    # One batch after the auth
+    assert table.observer.count("record") == 2
+
+def test_failures(loop, table, threaded):
+    """A failed submission should get its exception without affecting the
+    rest of its batch"""
+    recorder = AsyncRecorder(table, batch_size=2, loop=loop,
+                             threaded=threaded)
+    futures = [
+        recorder.submit(day(1), CommonStock.issue(holder=table.pg,
+                                                  amount=6000)),
+        recorder.submit(day(2), CommonStock.issue(holder=table.gb,
+                                                  amount=6000)),
+        recorder.submit(day(3), CommonStock.issue(holder=table.gb,
+                                                  amount=1000)),
+        recorder.submit(day(-1), CommonStock.issue(holder=table.gb,
+                                                   amount=1)),
+    ]
+    results = wait(loop, futures)
+    assert results[0] == day(1)
+    assert isinstance(results[1], AssertionError)
+    assert results[2] == day(3)
+    # Older than the table's last transaction
+    assert isinstance(results[3], ValueError)
+    assert table.shares_held(table.pg) == {CommonStock.name: 6000}
+    assert table.shares_held(table.gb) == {CommonStock.name: 1000}
+    with pytest.raises(ValueError):
+        recorder.submit(day(4))
+
+def test_cancelled(loop, table, threaded):
+    """Cancelled submissions shouldn't be recorded"""
+    recorder = AsyncRecorder(table, loop=loop, delay=0.01,
+                             threaded=threaded)
+    first = recorder.submit(day(1), CommonStock.issue(holder=table.pg,
+                                                      amount=10))
+    second = recorder.submit(day(2), CommonStock.issue(holder=table.gb,
+                                                       amount=10))
+    first.cancel()
+    wait(loop, [second])
+    assert table.shares_held(table.pg) == {}
+    assert len(table.transactions) == 2
+
+def test_threaded(loop, table):
+    """Threaded recorders should record batches off the loop's thread, one
+    at a time, while the loop keeps running"""
+    threads = []
+    release = threading.Event()
+    def blocking(datetime_, state):
+        threads.append(threading.current_thread())
+        release.wait(5)
+        return state
+    recorder = AsyncRecorder(table, loop=loop, batch_size=1, threaded=True)
+    futures = [recorder.submit(day(1), blocking),
+               recorder.submit(day(2), CommonStock.issue(holder=table.pg,
+                                                         amount=10))]
+    ticks = []
+    def tick():
+        ticks.append(recorder.pending)
+        release.set()
+    loop.call_later(0.01, tick)
+    assert wait(loop, futures) == [day(1), day(2)]
+    assert threads and threading.current_thread() not in threads
+    # The loop ran while the first batch was blocked, with the second
+    # still waiting its turn
+    assert ticks == [1]
+    assert table.shares_held(table.pg) == {CommonStock.name: 10}
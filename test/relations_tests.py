@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Entity, NaturalPerson, Stock
+from captable import relations
+from captable.relations import Relations
+from ._helpers import day
+
+
+class SuperVoting(Stock):
+    name = "Class B Common Stock"
+
+    class MetaState(Stock.MetaState):
+        VOTES_PER_SHARE = 10
+
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = NaturalPerson("Peter Gregory")
+    table.raviga = Entity("Raviga Capital")
+    table.fund = Entity("Raviga Fund I")
+    table.gb = NaturalPerson("Gavin Belson")
+    table.record(day(0), CommonStock.auth(10000), SuperVoting.auth(1000))
+    table.record(day(1),
+                 CommonStock.issue(holder=table.fund, amount=2000,
+                                   cert_no="C1"),
+                 CommonStock.issue(holder=table.gb, amount=3000,
+                                   cert_no="C2"),
+                 SuperVoting.issue(holder=table.pg, amount=100, cert_no="B1"))
+    return table
+
+
+def test_relate(table):
+    """Related persons should form a group with their combined votes"""
+    assert relations.voting_power(table, table.pg) == 1000
+    table.record(day(2), Relations.relate(table.raviga, table.fund,
+                                          "controls"),
+                 Relations.relate(table.pg, table.raviga, "controls"))
+    assert relations.voting_power(table, table.fund) == 3000
+    assert set(table[Relations].group(table.pg)) == \
+        set([table.pg, table.raviga, table.fund])
+    assert table[Relations].related(table.raviga) == \
+        {table.pg: "controls", table.fund: "controls"}
+    assert table[Relations].group(table.gb) == [table.gb]
+    assert relations.controlling(table) is None
+
+    table.record(day(3), CommonStock.transfer("C2", table.fund))
+    assert relations.voting_power(table, table.pg) == 6000
+    assert relations.voting_power(table, table.gb) == 0
+    assert set(relations.controlling(table)) == \
+        set([table.pg, table.raviga, table.fund])
+
+def test_incremental_votes(table):
+    """Issuing, transferring and cancelling should adjust group votes"""
+    table.record(day(2), Relations.relate(table.pg, table.fund))
+    table.record(day(3), SuperVoting.issue(holder=table.pg, amount=50,
+                                           cert_no="B2"),
+                 CommonStock.transfer("C1", table.gb))
+    assert relations.voting_power(table, table.pg) == 1500
+    table.record(day(4), SuperVoting.cancel("B1"),
+                 CommonStock.transfer("C2", None))
+    assert relations.voting_power(table, table.fund) == 500
+    assert table[Relations].votes[table[Relations].find(table.pg)] == \
+        relations.votes_held(table.state, table.pg)
+
+def test_rollback(table):
+    """A failed transaction should leave the groups and votes unchanged"""
+    table.record(day(2), Relations.relate(table.pg, table.fund))
+    with pytest.raises(AssertionError):
+        table.record(day(3), Relations.relate(table.gb, table.fund),
+                     CommonStock.transfer("C2", table.pg),
+                     CommonStock.issue(holder=table.gb, amount=100000))
+    assert relations.voting_power(table, table.pg) == 3000
+    assert table[Relations].group(table.gb) == [table.gb]
+
+def test_unrelate(table):
+    """Removing a relationship should split the group unless its members
+    remain connected"""
+    table.record(day(2), Relations.relate(table.pg, table.raviga),
+                 Relations.relate(table.raviga, table.fund),
+                 Relations.relate(table.pg, table.fund))
+    table.record(day(3), Relations.unrelate(table.pg, table.fund))
+    assert relations.voting_power(table, table.pg) == 3000
+
+    table.record(day(4), Relations.unrelate(table.raviga, table.fund))
+    assert relations.voting_power(table, table.pg) == 1000
+    assert relations.voting_power(table, table.fund) == 2000
+    assert table.fund not in table[Relations].roots
+    with pytest.raises(KeyError):
+        table.record(day(5), Relations.unrelate(table.raviga, table.fund))
+
+def test_control(table):
+    """Control should list every group holding votes, largest first"""
+    table.record(day(2), Relations.relate(table.pg, table.fund))
+    rows = relations.control(table)
+    assert set((frozenset(members), votes) for members, votes, _ in rows) == \
+        set([(frozenset([table.pg, table.fund]), 3000),
+             (frozenset([table.gb]), 3000)])
+    rows = relations.control(table.as_of(day(1)))
+    assert [(members, votes) for members, votes, _ in rows] == \
+        [([table.gb], 3000), ([table.fund], 2000), ([table.pg], 1000)]
+    assert rows[0][2] == 0.5
@@ -0,0 +1,137 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar
+from captable.validation import check_auth
+from ._helpers import day
+
+
+class ColumnarStock(CommonStock):
+    name = "Columnar Stock"
+
+    class MetaState(Columnar, CommonStock.MetaState):
+        pass
+
+
+class RetiringStock(CommonStock):
+    name = "Retiring Stock"
+
+    class MetaState(CommonStock.MetaState):
+        DEAUTH_RETIRED = True
+
+
+@pytest.fixture(params=[CommonStock, ColumnarStock])
+def table(request):
+    table = CapTable()
+    table.cls = request.param
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), table.cls.auth(10000),
+                 table.cls.reserve("2015 Plan", 2000))
+    return table
+
+
+def test_reserve(table):
+    """Reserved shares should be counted against the authorization"""
+    metastate = table[table.cls]
+    assert metastate.reserved == 2000
+    assert metastate.available("2015 Plan") == 2000
+    assert metastate.unreserved == 8000
+
+    table.record(day(1), table.cls.reserve("2015 Plan", delta=500),
+                 table.cls.reserve("Advisors", 100))
+    assert metastate.reserved == 2600
+    assert metastate.unreserved == 7400
+
+def test_issue_under_plan(table):
+    """Issuing under a plan should draw down its reservation, and cancelling
+    should return the shares to it"""
+    table.record(day(1), table.cls.issue(holder=table.pg, amount=1500,
+                                         cert_no="O1", plan="2015 Plan"),
+                 table.cls.issue(holder=table.gb, amount=1000, cert_no="C1"))
+    metastate = table[table.cls]
+    assert metastate.issued == 2500
+    assert metastate.reserved == 500
+    assert metastate.available("2015 Plan") == 500
+    assert metastate["O1"].plan == "2015 Plan"
+    assert metastate["C1"].plan is None
+
+    with pytest.raises(AssertionError):
+        table.record(day(2), table.cls.issue(holder=table.gb, amount=501,
+                                             plan="2015 Plan"))
+    with pytest.raises(ValueError):
+        table.record(day(2), table.cls.issue(holder=table.gb, amount=1,
+                                             plan="2016 Plan"))
+
+    table.record(day(2), table.cls.cancel("O1"))
+    assert metastate.reserved == 2000
+    assert metastate.available("2015 Plan") == 2000
+
+def test_reserved_not_issuable(table):
+    """Shares outside a plan shouldn't come out of reservations"""
+    with pytest.raises(AssertionError):
+        table.record(day(1), table.cls.issue(holder=table.pg, amount=8000))
+    table.record(day(1), table.cls.issue(holder=table.pg, amount=7999))
+
+def test_reservation_limits(table):
+    """Reservations can't exceed the authorization or drop below shares
+    already issued under them"""
+    with pytest.raises(AssertionError):
+        table.record(day(1), table.cls.reserve("Advisors", 8001))
+    table.record(day(1), table.cls.issue(holder=table.pg, amount=1500,
+                                         plan="2015 Plan"))
+    with pytest.raises(AssertionError):
+        table.record(day(2), table.cls.reserve("2015 Plan", delta=-501))
+    with pytest.raises(AssertionError):
+        table.record(day(2), table.cls.reserve("2015 Plan", 100, delta=-100))
+    with pytest.raises(ValueError):
+        table.record(day(2), table.cls.reserve("2015 Plan"))
+    table.record(day(2), table.cls.reserve("2015 Plan", 1500))
+    assert table[table.cls].reserved == 0
+
+def test_recount(table):
+    """Recounting should rebuild the plan counters"""
+    table.record(day(1), table.cls.issue(holder=table.pg, amount=1500,
+                                         plan="2015 Plan"))
+    metastate = table[table.cls]
+    metastate._reserved = 0
+    metastate.plan_issued.clear()
+    metastate._recount()
+    assert metastate.reserved == 500
+    assert metastate.available("2015 Plan") == 500
+    check_auth(table.state)
+
+def test_check_counts(table, monkeypatch):
+    """Checking counts should catch plan counters out of sync"""
+    monkeypatch.setattr(table.cls.MetaState, "CHECK_COUNTS", True)
+    table.record(day(1), table.cls.issue(holder=table.pg, amount=1500,
+                                         cert_no="O1", plan="2015 Plan"))
+    table.record(day(2), table.cls.cancel("O1"))
+    metastate = table[table.cls]
+    assert metastate.reserved == 2000
+    metastate.plan_issued["2015 Plan"] = 100
+    with pytest.raises(AssertionError):
+        metastate.issued
+    metastate._recount()
+    metastate._reserved -= 1
+    with pytest.raises(AssertionError):
+        metastate.reserved
+
+def test_retire_deauth():
+    """Retiring shares issued under a plan should shrink the plan's
+    reservation along with the authorization"""
+    table = CapTable()
+    pg = Person("Peter Gregory")
+    table.record(day(0), RetiringStock.auth(1000),
+                 RetiringStock.reserve("2015 Plan", 900))
+    table.record(day(1), RetiringStock.issue(holder=pg, amount=500,
+                                             cert_no="O1", plan="2015 Plan"))
+    table.record(day(2), RetiringStock.retire("O1"))
+    metastate = table[RetiringStock]
+    assert metastate.authorized == 500
+    assert metastate.plans["2015 Plan"] == 400
+    assert metastate.reserved == 400
+    assert metastate.available("2015 Plan") == 400
+    check_auth(table.state)
@@ -0,0 +1,70 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person, Stock
+from captable.columnar import Columnar
+from captable import scenarios
+from ._helpers import day
+
+
+class SeriesA(Stock):
+    name = "Series A Preferred"
+
+    class MetaState(Columnar, Stock.MetaState):
+        pass
+
+
+def holders(table):
+    """Summarize callable for run"""
+    return sorted(person.name for person in table[CommonStock].holders)
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(10000))
+    table.record(day(1), CommonStock.issue(holder=table.pg, amount=6000,
+                                           cert_no="C1"),
+                 CommonStock.issue(holder=table.gb, amount=2000,
+                                   cert_no="C2"))
+    return table
+
+def rounds(table):
+    investor = Person("Raviga Capital")
+    return [
+        [(day(2), SeriesA.auth(5000),
+          SeriesA.issue(holder=investor, amount=amount))]
+        for amount in (1000, 2000, 4000)
+    ] + [
+        # Too large, so the second entry fails
+        [(day(2), CommonStock.transfer("C2", table.pg)),
+         (day(3), CommonStock.issue(holder=investor, amount=5000))],
+        [],
+    ]
+
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_run(table, processes):
+    """Each scenario should be recorded on its own fork of the table"""
+    results = scenarios.run(table, rounds(table), processes=processes,
+                            summarize=holders)
+    assert [r.index for r in results] == list(range(5))
+    assert [r.ok for r in results] == [True, True, True, False, True]
+    assert [r.outstanding.get(SeriesA.name) for r in results] == \
+        [1000, 2000, 4000, None, None]
+    assert results[2].ownership.percentage(table.pg) == 0.5
+    assert results[4].outstanding == {CommonStock.name: 8000}
+
+    # Persons in the table come back as the same objects
+    failed = results[3]
+    assert failed.failed == 1
+    assert "AssertionError" in failed.error
+    assert failed.ownership.shares[table.pg] == {CommonStock.name: 8000}
+    assert failed.summary == ["Peter Gregory"]
+    assert failed.datetime == day(2)
+
+    # The base table is unchanged
+    assert len(table.transactions) == 2
+    assert SeriesA.name not in table.state[SeriesA.STATE_KEY]
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar
+from captable.persistence import load
+from ._helpers import day
+
+
+class PreferredStock(CommonStock):
+    name = "Preferred Stock"
+
+    class MetaState(Columnar, CommonStock.MetaState):
+        pass
+
+
+def build_table(**kwds):
+    """Returns a table with 1000 certificates of each class, half held by
+    each of two Persons"""
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+    table = CapTable(**kwds)
+    table.record(day(0), CommonStock.auth(100000), PreferredStock.auth(100000))
+    table.record_many((day(1), [
+        cls.issue(holder=(pg if n % 2 else gb), amount=10,
+                  cert_no="%s-%s" % (cls.name, n))
+        for cls in (CommonStock, PreferredStock)
+    ]) for n in range(1000))
+    table.record(day(2), CommonStock.cancel("Common Stock-0"),
+                 PreferredStock.transfer("Preferred Stock-0", pg))
+    return table, pg, gb
+
+
+@pytest.mark.parametrize("cls", [CommonStock, PreferredStock])
+def test_snapshot(tmpdir, cls):
+    """Loading a snapshot should restore state, reading issuances lazily"""
+    path = str(tmpdir.join("table.snapshot"))
+    table, pg, gb = build_table()
+    table.save_snapshot(path)
+
+    loaded = CapTable.load_snapshot(path)
+    assert loaded.datetime == day(2)
+    metastate = loaded[cls]
+    assert "_loader" in vars(metastate)
+    assert metastate.authorized == 100000
+    assert metastate.outstanding == table[cls].outstanding
+    assert "_loader" in vars(metastate)
+
+    # Persons are shared across classes
+    holders = metastate.holders
+    assert "_loader" not in vars(metastate)
+    assert sorted(p.name for p in holders) == ["Gavin Belson", "Peter Gregory"]
+    for holder in holders:
+        original = pg if holder.name == "Peter Gregory" else gb
+        assert loaded.shares_held(holder) == table.shares_held(original)
+    assert metastate["%s-1" % cls.name].holder in holders
+    assert len(metastate.issuances) == 1000
+    assert len(loaded.as_of(day(2))[cls].held_by(holders[0])) == \
+        len(metastate.held_by(holders[0]))
+
+def test_snapshot_rollback(tmpdir):
+    """Containers loaded during a failed transaction should stay loaded and
+    the transaction should be rolled back"""
+    path = str(tmpdir.join("table.snapshot"))
+    table, pg, gb = build_table()
+    table.save_snapshot(path)
+
+    loaded = CapTable.load_snapshot(path)
+    holder = loaded[CommonStock]["Common Stock-1"].holder
+    with pytest.raises(AssertionError):
+        loaded.record(day(3), CommonStock.issue(holder=holder, amount=10**6))
+    with pytest.raises(ValueError):
+        loaded.record(day(1), CommonStock.issue(holder=holder, amount=10))
+    assert loaded[CommonStock].issued == table[CommonStock].issued
+    assert len(loaded[CommonStock].issuances) == 1000
+
+    loaded.record(day(3), CommonStock.issue(holder=holder, amount=10))
+    assert loaded[CommonStock].issued == table[CommonStock].issued + 10
+    assert loaded.as_of(day(2))[CommonStock].issued == \
+        table[CommonStock].issued
+    with pytest.raises(ValueError):
+        loaded.as_of(day(1))
+
+def test_snapshot_with_log(tmpdir):
+    """A snapshot plus the rest of the log should match the full log"""
+    log_path = str(tmpdir.join("table.log"))
+    path = str(tmpdir.join("table.snapshot"))
+    table = load(log_path)
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(1000))
+    table.record(day(1), CommonStock.issue(holder=pg, amount=100,
+                                           cert_no="CS-1"))
+    table.save_snapshot(path)
+    table.record(day(2), CommonStock.issue(holder=gb, amount=200,
+                                           cert_no="CS-2"))
+    table.record(day(3), CommonStock.transfer("CS-1", gb))
+    table.log.close()
+
+    loaded = load(log_path, snapshot=path)
+    assert len(loaded.transactions) == 2
+    metastate = loaded[CommonStock]
+    gb2 = metastate["CS-2"].holder
+    assert metastate["CS-1"].holder is gb2
+    assert metastate.shares_held(gb2) == 300
+
+    # The log keeps working
+    loaded.record(day(4), CommonStock.transfer("CS-2", None))
+    loaded.log.close()
+    assert load(log_path)[CommonStock].outstanding == 100
+
+def test_not_a_snapshot(tmpdir):
+    path = tmpdir.join("table.snapshot")
+    path.write("Not a snapshot" * 10)
+    with pytest.raises(ValueError):
+        CapTable.load_snapshot(str(path))
@@ -208,3 +208,108 @@ def test_retire_stock_deauth():
     assert metastate.issued == 0
     assert metastate.outstanding == 0
     assert metastate.issuable == 4000
+
+def test_issuance_rollback():
+    """A failed multi-transaction should undo issuances, transfers and
+    cancellations made to existing certificates"""
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+
+    table = CapTable()
+    table.record(None, CommonStock.auth(5000))
+    table.record(None, CommonStock.issue(holder=pg, 
+                                         amount=1000, cert_no="CS-1"))
+
+    with pytest.raises(AssertionError):
+        table.record(None,
+                     CommonStock.transfer(cert_no="CS-1", to=gb),
+                     CommonStock.cancel(cert_no="CS-1"),
+                     CommonStock.issue(holder=gb, amount=2000, cert_no="CS-2"),
+                     CommonStock.issue(holder=gb, amount=9000, cert_no="CS-3"))
+
+    metastate = table[CommonStock]
+    assert "CS-2" not in metastate
+    assert "CS-3" not in metastate
+    assert len(metastate.issuances) == 1
+
+    cs1 = metastate["CS-1"]
+    assert cs1.holder == pg
+    assert not cs1.cancelled
+    assert metastate.issued == 1000
+    assert metastate.outstanding == 1000
+
+def test_share_counts():
+    """Running share counts should match a full recount after issuance,
+    transfer, cancellation and retirement"""
+    class CheckedStock(CommonStock):
+        class MetaState(CommonStock.MetaState):
+            CHECK_COUNTS = True
+
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+
+    table = CapTable()
+    table.record(None, CheckedStock.auth(10000))
+    table.record(None, CheckedStock.issue(holder=pg, amount=1000, 
+                                          cert_no="CS-1"))
+    table.record(None, CheckedStock.issue(holder=gb, amount=2000, 
+                                          cert_no="CS-2"))
+    table.record(None, CheckedStock.issue(holder=gb, amount=3000, 
+                                          cert_no="CS-3"))
+    table.record(None, CheckedStock.transfer(cert_no="CS-1", to=None))
+    table.record(None, CheckedStock.cancel(cert_no="CS-1"))
+    table.record(None, CheckedStock.transfer(cert_no="CS-1", to=gb))
+    table.record(None, CheckedStock.retire(cert_no="CS-2"))
+    table.record(None, CheckedStock.cancel(cert_no="CS-2"))
+
+    metastate = table[CheckedStock]
+    assert metastate.issued == 3000
+    assert metastate.outstanding == 3000
+    assert metastate.cancelled == 3000
+
+    # Modifying issuances directly should be caught
+    metastate["CS-3"].cancelled = True
+    with pytest.raises(AssertionError):
+        metastate.issued
+
+def test_holder_index():
+    """Should be able to look up live certificates and outstanding shares by
+    holder, and lookups should reflect rolled back transactions"""
+    class PreferredStock(CommonStock):
+        name = "Preferred Stock"
+
+    pg = Person("Peter Gregory")
+    gb = Person("Gavin Belson")
+
+    table = CapTable()
+    table.record(None, CommonStock.auth(5000), PreferredStock.auth(5000))
+    table.record(None, CommonStock.issue(holder=pg, amount=1000, 
+                                         cert_no="CS-1"))
+    table.record(None, CommonStock.issue(holder=pg, amount=500, 
+                                         cert_no="CS-2"))
+    table.record(None, PreferredStock.issue(holder=pg, amount=200, 
+                                            cert_no="PS-1"))
+    table.record(None, CommonStock.transfer(cert_no="CS-2", to=gb))
+
+    metastate = table[CommonStock]
+    assert metastate.held_by(pg) == [metastate["CS-1"]]
+    assert metastate.held_by(gb) == [metastate["CS-2"]]
+    assert metastate.shares_held(pg) == 1000
+    assert metastate.shares_held(gb) == 500
+    assert table.shares_held(pg) == {CommonStock.name: 1000,
+                                     PreferredStock.name: 200}
+
+    # Cancellation and transfers to treasury remove live certificates
+    table.record(None, CommonStock.cancel(cert_no="CS-1"))
+    table.record(None, PreferredStock.transfer(cert_no="PS-1", to=None))
+    assert table.held_by(pg) == {}
+    assert table.shares_held(pg) == {}
+    assert set(metastate.holders) == set([gb])
+
+    # Failed transactions roll back the index
+    with pytest.raises(AssertionError):
+        table.record(None, 
+                     CommonStock.transfer(cert_no="CS-2", to=pg),
+                     CommonStock.issue(holder=pg, amount=9000))
+    assert table.shares_held(gb) == {CommonStock.name: 500}
+    assert table.shares_held(pg) == {}
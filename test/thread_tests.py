@@ -0,0 +1,245 @@
+from __future__ import absolute_import
+
+import gc
+import pytest
+import threading
+import weakref
+
+from captable import CapTable, CommonStock, Person
+from captable.persistence import TransactionLog, load
+from captable.relations import Relations, votes_held, voting_power
+from ._helpers import day
+
+
+class PreferredStock(CommonStock):
+    name = "Preferred Stock"
+
+
+class Convert(object):
+    """Converts a preferred stock certificate into common stock"""
+    classes = (CommonStock, PreferredStock)
+
+    def __init__(self, cert_no):
+        self.cert_no = cert_no
+
+    def __call__(self, datetime_, state):
+        issuance = PreferredStock._in(state)[self.cert_no]
+        state = PreferredStock._cancel(datetime_, state, self.cert_no)
+        return CommonStock._issue(datetime_, state, holder=issuance.holder,
+                                  amount=issuance.amount,
+                                  cert_no="C" + self.cert_no)
+
+    def __eq__(self, other):
+        return isinstance(other, Convert) and other.cert_no == self.cert_no
+
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(100000))
+    table.record_many((day(1), [
+        CommonStock.issue(holder=(table.pg if n % 2 else table.gb),
+                          amount=10, cert_no="CS-%s" % n)
+    ]) for n in range(200))
+    return table
+
+
+def test_committed(table):
+    """A committed view should keep the state it was created with, and be
+    shared until the next commit"""
+    view = table.committed()
+    assert table.committed() is view
+    assert view.datetime == day(1)
+    assert view.state == table.state
+
+    table.record(day(2), CommonStock.transfer("CS-0", table.pg),
+                 CommonStock.cancel("CS-1"))
+    assert view[CommonStock]["CS-0"].holder is table.gb
+    assert not view[CommonStock]["CS-1"].cancelled
+    assert view[CommonStock].shares_held(table.pg) == 1000
+    latest = table.committed()
+    assert latest is not view
+    assert latest.datetime == day(2)
+    assert latest[CommonStock]["CS-0"].holder is table.pg
+    assert latest[CommonStock].shares_held(table.pg) == 1000
+
+def test_rolled_back(table):
+    """Failed transactions shouldn't affect or replace the committed view"""
+    view = table.committed()
+    with pytest.raises(AssertionError):
+        table.record(day(2), CommonStock.transfer("CS-0", table.pg),
+                     CommonStock.issue(holder=table.pg, amount=10 ** 6))
+    assert view[CommonStock]["CS-0"].holder is table.gb
+    assert table.committed().state == view.state
+
+def test_read_only(table):
+    """Reading a committed view shouldn't copy anything in it"""
+    table.record(day(2), CommonStock.transfer("CS-0", table.pg))
+    view = table.committed()
+    metastate = view[CommonStock]
+    assert view[CommonStock] is metastate
+    assert metastate["CS-2"] is metastate["CS-2"]
+    assert metastate["CS-2"] is table[CommonStock]["CS-2"]
+    assert metastate.held_by(table.pg)
+
+def test_freed(table):
+    """Views should be freed once nothing refers to them"""
+    ref = weakref.ref(table.committed().state)
+    gc.collect()
+    assert ref() is not None
+    table.record(day(2), CommonStock.cancel("CS-0"))
+    gc.collect()
+    assert ref() is None
+
+def test_threads(table):
+    """Readers in other threads should only ever see committed states while
+    a writer records"""
+    errors = []
+    done = threading.Event()
+
+    def read():
+        try:
+            while not done.is_set():
+                view = table.committed()
+                metastate = view[CommonStock]
+                count = len(metastate.issuances)
+                assert metastate.outstanding == 10 * count
+                assert sum(view.shares_held(person).get(CommonStock.name, 0)
+                           for person in (table.pg, table.gb)) == 10 * count
+                assert view[CommonStock]["CS-%s" % (count - 1)].amount == 10
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for n in range(200, 400):
+            table.record(day(2), CommonStock.issue(
+                holder=table.pg, amount=10, cert_no="CS-%s" % n))
+            table.record(day(2), CommonStock.transfer("CS-%s" % (n - 200),
+                                                      table.gb))
+
+            # Fails after issuing, so readers must not see the issuance
+            with pytest.raises(AssertionError):
+                table.record(day(2), CommonStock.issue(
+                    holder=table.pg, amount=10, cert_no="X-%s" % n),
+                    CommonStock.issue(holder=table.pg, amount=10 ** 6))
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+    assert not errors
+    assert table.committed()[CommonStock].outstanding == 4000
+
+def test_snapshot(table, tmpdir):
+    """Threads reading a view of a table loaded from a snapshot should each
+    see the classes loaded once"""
+    path = str(tmpdir.join("table.snapshot"))
+    table.save_snapshot(path)
+    view = CapTable.load_snapshot(path).committed()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        (view[CommonStock]["CS-0"], view[CommonStock].outstanding)))
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    assert len(set(id(issuance) for issuance, _ in results)) == 1
+    assert set(outstanding for _, outstanding in results) == set([2000])
+
+
+def entries(table):
+    return [(entry[0],) + tuple((txn.security, txn.name, txn.args[:1])
+                                for txn in entry[1:])
+            for entry in table.transactions]
+
+def record_classes(table, n, start=0, when=day(2)):
+    """Record n issues and transfers of each class, from a thread per
+    class. Returns the list of exceptions raised."""
+    errors = []
+
+    def record(cls):
+        try:
+            for i in range(start, start + n):
+                cert_no = "%s-%s" % (cls.name, i)
+                table.record(when, cls.issue(holder=table.pg, amount=10,
+                                             cert_no=cert_no))
+                table.record(when, cls.transfer(cert_no, table.gb))
+                with pytest.raises(AssertionError):
+                    table.record(when, cls.cancel(cert_no),
+                                 cls.issue(holder=table.pg, amount=10 ** 6))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=record, args=(cls,))
+               for cls in (CommonStock, PreferredStock)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+@pytest.fixture
+def concurrent(tmpdir):
+    table = CapTable(concurrent=True, checkpoint_interval=50,
+                     log=TransactionLog(str(tmpdir.join("table.log"))))
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(0), CommonStock.auth(100000), PreferredStock.auth(50000))
+    return table
+
+def test_concurrent(concurrent):
+    """Transactions on different classes should be recorded from different
+    threads as if one at a time"""
+    table = concurrent
+    assert record_classes(table, 100) == []
+    assert len(table.transactions) == 401
+    for cls in (CommonStock, PreferredStock):
+        assert table[cls].outstanding == 1000
+        assert table[cls].shares_held(table.gb) == 1000
+        assert "%s-99" % cls.name in table[cls]
+    counts = [count for count, _ in table._checkpoints]
+    assert len(counts) > 5
+    assert all(b - a >= 50 for a, b in zip(counts, counts[1:]))
+    assert table.as_of(day(2))[CommonStock].holders == [table.gb]
+
+    # The log has every transaction in the order recorded
+    table.log.close()
+    loaded = load(table.log.path)
+    assert entries(loaded) == entries(table)
+    for cls in (CommonStock, PreferredStock):
+        assert [holder.name for holder in loaded[cls].holders] == \
+            [table.gb.name]
+
+def test_concurrent_order(concurrent):
+    """A transaction can't be older than one being recorded"""
+    table = concurrent
+    table.record(day(2), CommonStock.issue(holder=table.pg, amount=10))
+    with pytest.raises(ValueError):
+        table.record(day(1), PreferredStock.issue(holder=table.pg, amount=10))
+    table.record(day(2), PreferredStock.issue(holder=table.pg, amount=10))
+
+def test_concurrent_cross_class(concurrent):
+    """Transactions declaring the classes they touch should lock all of
+    them, and others should lock the whole table"""
+    table = concurrent
+    assert record_classes(table, 20) == []
+    assert table._locks_for([Convert("Preferred Stock-0")]) == \
+        [table._class_locks[name] for name in
+         (CommonStock.name, PreferredStock.name)]
+    table.record(day(3), Convert("Preferred Stock-0"))
+    assert table[CommonStock]["CPreferred Stock-0"].holder is table.gb
+    assert table[PreferredStock]["Preferred Stock-0"].cancelled
+
+    table.record(day(3), Relations.relate(table.pg, table.gb))
+    assert table._locks_for([Relations.relate(table.pg, table.gb)]) is None
+    assert table._locks_for([CommonStock.cancel("Common Stock-0")])[-1] is \
+        table._class_locks[None]
+    assert record_classes(table, 20, start=20, when=day(4)) == []
+    assert voting_power(table, table.pg) == 800 == \
+        votes_held(table.state, table.pg) + votes_held(table.state, table.gb)
@@ -89,4 +89,101 @@ def test_multi_txn_rollback():
 
     # Neither txn_1 nor txn_2 should have processed
     assert len(table.transactions) == 0
-    StubTransaction.check(table.state)
\ No newline at end of file
+    StubTransaction.check(table.state)
+
+def test_untracked_state_rollback():
+    """Failed transaction should not modify untracked values that existed in
+    state prior to the transaction"""
+    table = captable.CapTable()
+    txn_1 = StubTransaction()
+    txn_2 = StubTransaction()
+    txn_3 = ErrorTransaction()
+    table.record(datetime.datetime(2015, 5, 1), txn_1)
+
+    with pytest.raises(RuntimeError):
+        table.record(datetime.datetime(2015, 5, 2), txn_2, txn_3)
+
+    # The stub list created by txn_1 should not have txn_2 or txn_3 in it
+    StubTransaction.check(table.state, txn_1)
+
+@pytest.mark.parametrize("deferred", [False, True])
+def test_record_many(deferred):
+    """Should be able to record many transactions from a generator"""
+    table = captable.CapTable()
+    txns = [StubTransaction() for i in range(10)]
+    entries = ((datetime.datetime(2015, 5, i + 1), [txn])
+               for i, txn in enumerate(txns))
+    assert table.record_many(entries, deferred=deferred, batch_size=3) == 10
+
+    assert table.transactions == [
+        (datetime.datetime(2015, 5, i + 1), txn) for i, txn in enumerate(txns)]
+    StubTransaction.check(table.state, *txns)
+
+def test_record_many_transactions_format():
+    """Entries in the same format as the transactions attribute should be
+    accepted, e.g. to copy one table's transactions into another"""
+    table = captable.CapTable()
+    table.record(datetime.datetime(2015, 5, 1), StubTransaction())
+    table.record(datetime.datetime(2015, 5, 2), StubTransaction(),
+                 StubTransaction())
+
+    copied = captable.CapTable()
+    copied.record_many(table.transactions)
+    assert copied.transactions == table.transactions
+
+@pytest.mark.parametrize("deferred", [False, True])
+def test_record_many_failure(deferred):
+    """A failing entry should be reported and rolled back, leaving prior
+    entries recorded"""
+    def max_4_stubs(state):
+        assert StubTransaction.count(state) <= 4, "Too many stubs"
+    table = captable.CapTable(validators=[max_4_stubs])
+    txns = [StubTransaction() for i in range(3)]
+    entries = [
+        (datetime.datetime(2015, 5, 1), [txns[0]]),
+        (datetime.datetime(2015, 5, 2), [txns[1], txns[2]]),
+        (datetime.datetime(2015, 5, 3), [ErrorTransaction()]),
+        (datetime.datetime(2015, 5, 4), [StubTransaction()])
+    ]
+
+    with pytest.raises(captable.RecordError) as excinfo:
+        table.record_many(entries, deferred=deferred)
+    assert excinfo.value.index == 2
+    assert isinstance(excinfo.value.error, RuntimeError)
+    assert len(table.transactions) == 2
+    StubTransaction.check(table.state, *txns)
+
+    # Validation failures in a deferred batch are attributed to the entry
+    # that caused them
+    entries = [
+        (datetime.datetime(2015, 5, 5), [StubTransaction()]),
+        (datetime.datetime(2015, 5, 6), [StubTransaction()]),
+        (datetime.datetime(2015, 5, 7), [StubTransaction()])
+    ]
+    with pytest.raises(captable.RecordError) as excinfo:
+        table.record_many(entries, deferred=deferred)
+    assert excinfo.value.index == 1
+    assert isinstance(excinfo.value.error, AssertionError)
+    assert len(table.transactions) == 3
+    assert StubTransaction.count(table.state) == 4
+
+def test_record_many_interrupted():
+    """A deferred batch interrupted by a non-Exception (e.g. Ctrl-C) should
+    be rolled back and the interruption raised, without retrying entries"""
+    calls = []
+    class Interrupt(StubTransaction):
+        def __call__(self, *args, **kwds):
+            super(Interrupt, self).__call__(*args, **kwds)
+            calls.append(self)
+            raise KeyboardInterrupt()
+    table = captable.CapTable()
+    table.record(datetime.datetime(2015, 5, 1), StubTransaction())
+    entries = [
+        (datetime.datetime(2015, 5, 2), [StubTransaction()]),
+        (datetime.datetime(2015, 5, 3), [Interrupt()])
+    ]
+    with pytest.raises(KeyboardInterrupt):
+        table.record_many(entries, deferred=True)
+    assert len(calls) == 1
+    assert len(table.transactions) == 1
+    assert StubTransaction.count(table.state) == 1
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import captable
+import captable.validation
 import datetime
 import pytest
 from ._helpers import StubTransaction
@@ -46,3 +47,64 @@ def test_amount_validator():
 
     with pytest.raises(AssertionError):
         table.record(None, TestStock.auth())
+
+
+def test_validator_dependencies():
+    "Validators should be skipped if none of their dependencies were touched"
+    calls = []
+
+    @captable.validation.validator(depends_on=["stubs_processed"])
+    def stub_validator(state):
+        calls.append(StubTransaction.count(state))
+
+    table = captable.CapTable(validators=[stub_validator])
+    table.record(None, captable.CommonStock.auth(1000))
+    table.record(None, StubTransaction())
+    table.record(None, captable.CommonStock.auth(2000))
+    table.record(None, StubTransaction())
+    assert calls == [1, 2]
+
+
+def test_incremental_validator():
+    "Incremental validators should be told which securities were touched"
+    class ClassACommon(captable.CommonStock):
+        name = "Class A Common Stock"
+
+    class ClassBCommon(captable.CommonStock):
+        name = "Class B Common Stock"
+
+    changed = []
+
+    @captable.validation.validator(incremental=True)
+    def record_changes(state, changes):
+        changed.append(changes.securities)
+
+    table = captable.CapTable(validators=[record_changes])
+    table.record(None, ClassACommon.auth(1000), ClassBCommon.auth(1000))
+    table.record(None, ClassBCommon.auth(2000))
+    table.record(None, StubTransaction())
+    assert changed == [set([ClassACommon.name, ClassBCommon.name]),
+                       set([ClassBCommon.name]),
+                       set()]
+
+
+def test_check_auth_incremental():
+    "check_auth should only check classes touched by a transaction"
+    class ClassACommon(captable.CommonStock):
+        name = "Class A Common Stock"
+
+    class ClassBCommon(captable.CommonStock):
+        name = "Class B Common Stock"
+
+    table = captable.CapTable()
+    table.record(None, ClassACommon.auth(1000), ClassBCommon.auth(1000))
+
+    # Sneak an invalid change in outside of a transaction
+    table[ClassACommon].authorized = -1
+    table.record(None, ClassBCommon.auth(2000))
+    with pytest.raises(AssertionError):
+        table.record(None, ClassACommon.auth(delta=0))
+
+    # Full scan still works
+    with pytest.raises(AssertionError):
+        captable.validation.check_auth(table.state)
@@ -0,0 +1,125 @@
+from __future__ import absolute_import
+
+import datetime
+import pickle
+import pytest
+
+from captable import CapTable, CommonStock, Person
+from captable.columnar import Columnar
+from captable.vesting import Schedule, VestingTable
+
+
+class ColumnarStock(CommonStock):
+    name = "Columnar Stock"
+
+    class MetaState(Columnar, CommonStock.MetaState):
+        pass
+
+
+START = datetime.date(2015, 1, 31)
+
+FOUR_YEARS = Schedule(START, months=48, cliff=12,
+                      triggers={"change_of_control": 0.5, "ipo": 1})
+
+
+def day(year, month, day_):
+    return datetime.datetime(year, month, day_)
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(day(2015, 1, 1), CommonStock.auth(100000),
+                 ColumnarStock.auth(100000))
+    table.record(day(2015, 1, 31),
+                 CommonStock.issue(holder=table.pg, amount=4800,
+                                   cert_no="C1", vesting=FOUR_YEARS),
+                 CommonStock.issue(holder=table.gb, amount=1000,
+                                   cert_no="C2"),
+                 ColumnarStock.issue(holder=table.gb, amount=1200,
+                                     cert_no="X1",
+                                     vesting=Schedule(months=12, every=3)))
+    return table
+
+
+def test_schedule_steps():
+    """Installments should respect the cliff and clamp to month ends"""
+    steps = FOUR_YEARS.steps(4800)
+    assert len(steps) == 37
+    assert steps[0] == (datetime.date(2016, 1, 31).toordinal(), 1200)
+    assert steps[1] == (datetime.date(2016, 2, 29).toordinal(), 1300)
+    assert steps[-1] == (datetime.date(2019, 1, 31).toordinal(), 4800)
+
+def test_uneven_schedule():
+    """A last installment shorter than the others should still vest in
+    full"""
+    schedule = Schedule(START, months=10, every=3)
+    assert [vested for _, vested in schedule.steps(1000)] == \
+        [300, 600, 900, 1000]
+
+def test_bad_schedules():
+    with pytest.raises(ValueError):
+        Schedule(START, months=12, cliff=24)
+    with pytest.raises(ValueError):
+        Schedule(START, months=12, every=0)
+    with pytest.raises(ValueError):
+        Schedule(START, triggers={"ipo": 2})
+
+def test_schedule_value():
+    """Schedules should compare and pickle by value"""
+    copy = pickle.loads(pickle.dumps(FOUR_YEARS, 2))
+    assert copy == FOUR_YEARS
+    assert hash(copy) == hash(FOUR_YEARS)
+    assert copy != Schedule(START, months=48)
+    assert CommonStock.issue(holder=None, amount=1, vesting=copy) == \
+        CommonStock.issue(holder=None, amount=1, vesting=FOUR_YEARS)
+
+def test_vested(table):
+    """Vested shares should be looked up per holder and in total"""
+    vesting = VestingTable(table)
+    assert vesting.vested(day(2015, 12, 31)) == {table.pg: 0,
+                                                 table.gb: 1900}
+    assert vesting.vested(day(2016, 1, 31), table.pg) == 1200
+    assert vesting.vested(day(2015, 7, 31), table.gb) == 1600
+    assert vesting.unvested(day(2015, 7, 31), table.gb) == 600
+    assert vesting.total(day(2016, 3, 1)) == 1300 + 2200
+    assert vesting.total(day(2014, 1, 1)) == 0
+    assert vesting.vesting_between(day(2016, 1, 1), day(2016, 3, 31)) == \
+        {table.pg: 1400, table.gb: 300}
+    assert vesting.amounts == {table.pg: 4800, table.gb: 2200}
+
+def test_classes(table):
+    """Tables can be limited to some classes of stock"""
+    vesting = VestingTable(table, classes=[ColumnarStock])
+    assert vesting.vested(day(2015, 4, 30)) == {table.gb: 300}
+
+def test_accelerate(table):
+    """Acceleration should vest a fraction of the unvested shares, with later
+    installments shrinking to match"""
+    table.record(day(2017, 1, 31), CommonStock.accelerate(
+        "C1", "change_of_control"))
+    steps = table[CommonStock]["C1"].accelerations
+    assert steps == ((day(2017, 1, 31), "change_of_control"),)
+
+    vesting = VestingTable(table)
+    assert vesting.vested(day(2017, 1, 30), table.pg) == 2300
+    assert vesting.vested(day(2017, 1, 31), table.pg) == 2400 + 1200
+    assert vesting.vested(day(2018, 1, 31), table.pg) == 3600 + 600
+    assert vesting.vested(day(2019, 1, 31), table.pg) == 4800
+
+    # Before the acceleration was recorded
+    vesting = VestingTable(table.as_of(day(2016, 12, 31)))
+    assert vesting.vested(day(2017, 1, 31), table.pg) == 2400
+
+def test_full_acceleration(table):
+    table.record(day(2015, 6, 1), CommonStock.accelerate("C1", "ipo"))
+    assert VestingTable(table).vested(day(2015, 6, 1), table.pg) == 4800
+
+def test_bad_acceleration(table):
+    """Acceleration should require a schedule with the trigger"""
+    with pytest.raises(ValueError):
+        table.record(day(2016, 1, 1), CommonStock.accelerate("C2", "ipo"))
+    with pytest.raises(ValueError):
+        table.record(day(2016, 1, 1), ColumnarStock.accelerate("X1", "ipo"))
+    assert table[CommonStock]["C2"].accelerations == ()
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+
+import datetime
+import pytest
+
+from captable import CapTable, CommonStock, Person, Stock
+from captable.waterfall import Waterfall
+
+
+class SeriesA(Stock):
+    name = "Series A"
+
+    class MetaState(Stock.MetaState):
+        LIQUIDATION_PREFERENCE = 1
+        SENIORITY = 1
+
+
+class SeriesB(Stock):
+    name = "Series B"
+
+    class MetaState(Stock.MetaState):
+        LIQUIDATION_PREFERENCE = 2
+        SENIORITY = 2
+        PARTICIPATING = True
+        PARTICIPATION_CAP = 6
+
+
+@pytest.fixture
+def table():
+    table = CapTable()
+    table.pg = Person("Peter Gregory")
+    table.gb = Person("Gavin Belson")
+    table.record(datetime.datetime(2015, 5, 1), CommonStock.auth(10000),
+                 SeriesA.auth(10000), SeriesB.auth(10000))
+    table.record(datetime.datetime(2015, 5, 2),
+                 CommonStock.issue(holder=table.pg, amount=600),
+                 CommonStock.issue(holder=table.gb, amount=400),
+                 CommonStock.issue(holder=table.pg, amount=5000,
+                                   cert_no="CS-T"),
+                 CommonStock.transfer("CS-T", None),
+                 SeriesA.issue(holder=table.pg, amount=500),
+                 SeriesB.issue(holder=table.gb, amount=250))
+    return table
+
+
+@pytest.mark.parametrize("exit_value,expected", [
+    (0, (0, 0, 0)),
+    (300, (0, 0, 300)),                 # Series B preference first
+    (700, (0, 200, 500)),               # Then Series A
+    (1000, (0, 500, 500)),
+    (1625, (500, 500, 625)),            # Series B participates
+    (9000, (5000, 2500, 1500)),         # Series A converts, B capped
+    (17500, (10000, 5000, 2500)),       # Series B converts
+])
+def test_payouts(table, exit_value, expected):
+    """Proceeds should follow preferences, participation and conversion"""
+    payouts = Waterfall(table).payouts(exit_value)
+    assert set(payouts) == set(["Common Stock", "Series A", "Series B"])
+    for name, amount in zip(["Common Stock", "Series A", "Series B"],
+                            expected):
+        assert payouts[name] == pytest.approx(amount)
+    assert sum(payouts.values()) == pytest.approx(exit_value)
+
+def test_curves(table):
+    """Curves should match payouts at each exit value"""
+    waterfall = Waterfall(table)
+    exit_values = [n * 25 for n in range(1000)]
+    curves = waterfall.curves(exit_values)
+    for i in range(0, 1000, 37):
+        payouts = waterfall.payouts(exit_values[i])
+        for name, curve in curves.items():
+            assert curve[i] == pytest.approx(payouts[name])
+
+        # Payout curves never go down
+        if i:
+            for curve in curves.values():
+                assert curve[i] >= curve[i - 1] - 1e-9
+
+def test_holder_payouts(table):
+    payouts = Waterfall(table).holder_payouts(9000)
+    assert payouts[table.pg] == pytest.approx(3000 + 2500)
+    assert payouts[table.gb] == pytest.approx(2000 + 1500)
+    with pytest.raises(ValueError):
+        Waterfall(table).payouts(-1)